@@ -1,19 +1,28 @@
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
+from functools import partial
+import click
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
 from config import Config
-
-db = SQLAlchemy()
-migrate = Migrate()
+from app.assets import asset_urls, load_manifest
+from app.avatars import AvatarStore
+from app.cache import LRUCache, TTLCache
+from app.follow_graph import FollowGraph
+from app.fragments import book_fragment
+from app.replica import RoutingSQLAlchemy
+from app.profiling import SQLProfiler
+from app.metrics import Metrics
+from app.ratelimit import Admission
+from app.passwords import HashPool
+from app.lazy import LazyClient, elasticsearch_client, recommendations, http_session
+
+db = RoutingSQLAlchemy()
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = _l('Please log in to access this page.')
@@ -21,19 +30,29 @@ mail = Mail()
 bootstrap = Bootstrap()
 moment = Moment()
 babel = Babel()
+profiler = SQLProfiler()
+metrics = Metrics()
+admission = Admission()
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    # first, so that rejected requests run no other hook
+    admission.init_app(app)
     db.init_app(app)
-    migrate.init_app(app, db)
+    if click.get_current_context(silent=True) is not None:
+        # alembic is slow to import and only the flask db commands need it
+        from flask_migrate import Migrate
+        Migrate(app, db)
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
+    profiler.init_app(app)
+    metrics.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -44,13 +63,26 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
-    app.jinja_env.globals.update(isfile=os.path.isfile)
+    app.elasticsearch = LazyClient(partial(elasticsearch_client, app.config['ELASTICSEARCH_URL'])) \
+        if app.config['ELASTICSEARCH_URL'] else None
+    app.fragment_cache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'])
+    app.follow_graph = FollowGraph(app.config['FOLLOW_GRAPH_TTL'])
+    app.identity_cache = TTLCache(app.config['IDENTITY_CACHE_TTL'])
+    app.popup_cache = TTLCache(app.config['POPUP_CACHE_TTL'])
+    app.recommendations = LazyClient(partial(recommendations, app.config['RECS_PATH']))
+    app.http = LazyClient(partial(http_session, app.config['HTTP_POOL_SIZE']))
+    app.avatars = AvatarStore(app.config['AVATAR_PATH'], app.http, app.config['GRAVATAR_URL'],
+                              app.config['AVATAR_FETCH_WORKERS'], app.config['AVATAR_REFRESH'],
+                              app.config['GRAVATAR_TIMEOUT'])
+    app.password_pool = HashPool(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'],
+                                 app.config['PASSWORD_HASH_PER_USER'], app.config['PASSWORD_HASH_TIMEOUT'])
+    # in debug mode the source files are served, so edits show up without a build
+    app.asset_manifest = load_manifest(app.static_folder) if not app.debug else {}
+    app.jinja_env.globals.update(isfile=os.path.isfile, book_fragment=book_fragment, asset_urls=asset_urls)
 
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
-
     if not app.debug and not app.testing:
         if app.config['MAIL_SERVER']:
             auth = None
@@ -84,6 +116,20 @@ def create_app(config_class=Config):
     return app
 
 
+def after_fork(app):
+    """Run in each gunicorn worker when the app was preloaded in the master,
+    so that no connection or client is shared between processes."""
+    with app.app_context():
+        for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or {}):
+            db.get_engine(app, bind).dispose()
+    if app.elasticsearch is not None:
+        app.elasticsearch.reset()
+    app.recommendations.reset()
+    app.http.reset()
+    app.password_pool.reset()
+    app.avatars.reset()
+
+
 @babel.localeselector
 def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
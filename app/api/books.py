@@ -0,0 +1,65 @@
+from flask import request, jsonify
+from app import db
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.conditional import make_etag, is_fresh, with_etag, not_modified
+from app.models import Book
+
+MAX_IDS = 100
+
+
+def requested_fields():
+    fields = request.args.get('fields')
+    return set(fields.split(',')) if fields else None
+
+
+def serialize(books, fields):
+    # aggregates come from book_stats (joined) and one grouped comment count
+    counts = {}
+    if not fields or 'comment_count' in fields:
+        counts = Book.comment_counts([book.id for book in books]) if books else {}
+    return [book.to_dict(comment_count=counts.get(book.id, 0), fields=fields) for book in books]
+
+
+def books_etag(books, *parts):
+    return make_etag(request.full_path, [(book.id, book.version) for book in books], *parts)
+
+
+@bp.route('/books/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_book(id):
+    book = Book.query.options(db.joinedload(Book.stats)).filter_by(id=id).first_or_404()
+    etag = books_etag([book])
+    if is_fresh(etag):
+        return not_modified(etag)
+    return with_etag(jsonify(serialize([book], requested_fields())[0]), etag)
+
+
+@bp.route('/books', methods=['GET'])
+@token_auth.login_required
+def get_books():
+    fields = requested_fields()
+    query = Book.query.options(db.joinedload(Book.stats))
+    if 'ids' in request.args:
+        try:
+            ids = [int(id) for id in request.args['ids'].split(',') if id]
+        except ValueError:
+            return bad_request('ids must be a comma separated list of integers')
+        if len(ids) > MAX_IDS:
+            return bad_request('at most %d ids per request' % MAX_IDS)
+        found = {book.id: book for book in query.filter(Book.id.in_(ids))} if ids else {}
+        books = [found[id] for id in ids if id in found]
+        etag = books_etag(books)
+        if is_fresh(etag):
+            return not_modified(etag)
+        return with_etag(jsonify({'items': serialize(books, fields)}), etag)
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    resources = query.order_by(Book.time.desc(), Book.id.desc()).paginate(page, per_page, False)
+    etag = books_etag(resources.items, resources.total)
+    if is_fresh(etag):
+        return not_modified(etag)
+    kwargs = {'fields': request.args['fields']} if 'fields' in request.args else {}
+    return with_etag(jsonify(Book.pagination_to_dict(
+        resources, 'api.get_books', items=serialize(resources.items, fields), **kwargs)), etag)
@@ -11,4 +11,4 @@ def error_response(status_code, message=None):
 
 
 def bad_request(message):
-    error_response(400, message)
\ No newline at end of file
+    return error_response(400, message)
\ No newline at end of file
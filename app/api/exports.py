@@ -0,0 +1,18 @@
+from flask import Response, request, stream_with_context
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.exporter import EXPORTS, FORMATS, export_lines
+
+
+@bp.route('/export/<name>', methods=['GET'])
+@token_auth.login_required
+def export(name):
+    if name not in EXPORTS:
+        return bad_request('can only export %s' % ', '.join(sorted(EXPORTS)))
+    format = request.args.get('format', 'jsonl')
+    if format not in FORMATS:
+        return bad_request('format must be jsonl or csv')
+    response = Response(stream_with_context(export_lines(name, format)), mimetype=FORMATS[format])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (name, format)
+    return response
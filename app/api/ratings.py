@@ -0,0 +1,39 @@
+from flask import request, jsonify
+from app import db
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.models import Book, Rating
+
+MAX_RATINGS = 100
+
+
+@bp.route('/ratings', methods=['PUT'])
+@token_auth.login_required
+def put_ratings():
+    data = request.get_json() or {}
+    items = data.get('ratings')
+    if not isinstance(items, list) or not items:
+        return bad_request('must include a non empty ratings list')
+    if len(items) > MAX_RATINGS:
+        return bad_request('at most %d ratings per request' % MAX_RATINGS)
+    scores = {}
+    for item in items:
+        try:
+            book_id, score = int(item['book']), int(item['score'])
+        except (KeyError, TypeError, ValueError):
+            return bad_request('each rating needs an integer book and score')
+        if not Rating.MIN_SCORE <= score <= Rating.MAX_SCORE:
+            return bad_request('score must be between %d and %d' % (Rating.MIN_SCORE, Rating.MAX_SCORE))
+        # the last score for a book wins, as it would with separate requests
+        scores[book_id] = score
+    known = {id for id, in db.session.query(Book.id).filter(Book.id.in_(list(scores)))}
+    unknown = sorted(set(scores) - known)
+    if unknown:
+        return bad_request('unknown books: %s' % ', '.join(map(str, unknown)))
+    changed = Rating.upsert(token_auth.current_user().id, scores)
+    db.session.commit()
+    return jsonify({
+        'items': [{'book': book_id, 'score': score} for book_id, score in scores.items()],
+        'changed': changed
+    })
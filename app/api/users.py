@@ -4,20 +4,35 @@ from app import db
 from flask import abort, url_for, request, jsonify
 from app.models import User
 from app.api.errors import bad_request
+from app.conditional import make_etag, is_fresh, with_etag, not_modified
+
+
+def user_etag(user):
+    return make_etag(user.id, user.version, user.last_seen)
+
+def users_response(query, page, per_page, endpoint, **kwargs):
+    resources = query.paginate(page, per_page, False)
+    etag = make_etag(request.full_path, resources.total, [user_etag(u) for u in resources.items])
+    if is_fresh(etag):
+        return not_modified(etag)
+    return with_etag(jsonify(User.pagination_to_dict(resources, endpoint, **kwargs)), etag)
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    user = User.query.get_or_404(id)
+    etag = user_etag(user)
+    if is_fresh(etag):
+        return not_modified(etag)
+    return with_etag(jsonify(user.to_dict()), etag)
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    return users_response(User.query, page, per_page, 'api.get_users')
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
@@ -25,8 +40,7 @@ def get_followers(id):
     user = User.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page, 'api.get_followers', id=id)
-    return jsonify(data)
+    return users_response(user.followers, page, per_page, 'api.get_followers', id=id)
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
@@ -35,8 +49,7 @@ def get_followed(id):
     user = User.query.get_or_404(id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page, 'api.get_followed', id=id)
-    return jsonify(data)
+    return users_response(user.followed, page, per_page, 'api.get_followed', id=id)
 
 @bp.route('/users', methods=['POST'])
 @token_auth.login_required
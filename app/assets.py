@@ -0,0 +1,155 @@
+import gzip
+import json
+import os
+import re
+import threading
+from hashlib import sha1
+from flask import current_app, url_for
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bundle name -> files under app/static, in the order they are loaded
+BUNDLES = {
+    'app.css': ['starrr.css'],
+    'app.js': ['starrr.js', 'js/bibliophilia.js'],
+}
+OUTPUT = 'dist'
+MANIFEST = 'manifest.json'
+# a / after one of these, or after one of the keywords, starts a regex
+REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+# no space is needed next to these; + - / and . are left out, a + +b and a / /re/ need theirs
+TIGHT = set('{}()[];,=:<>?&|!*%^~')
+REGEX_KEYWORDS = {'return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete', 'void', 'throw'}
+
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r' ?([{};,>]) ?', r'\1', css)
+    css = re.sub(r': ', ':', css)
+    return css.replace(';}', '}').strip() + '\n'
+
+
+def minify_js(js):
+    """Drop comments, indentation and blank lines. Strings and regular
+    expressions are copied as they are and line breaks are kept, so that
+    semicolon insertion works as in the source."""
+    out, i, n = [], 0, len(js)
+    while i < n:
+        c = js[i]
+        if c in '\'"`':
+            end = i + 1
+            while end < n and js[end] != c:
+                end += 2 if js[end] == '\\' else 1
+            out.append(js[i:end + 1])
+            i = end + 1
+        elif js.startswith('//', i):
+            end = js.find('\n', i)
+            i = n if end == -1 else end
+        elif js.startswith('/*', i):
+            end = js.find('*/', i + 2)
+            end = n if end == -1 else end + 2
+            if js.startswith('/*!', i):
+                out.append(js[i:end])
+            i = end
+        elif c == '/' and is_regex_start(''.join(out[-20:])):
+            end, in_class = i + 1, False
+            while end < n and (js[end] != '/' or in_class):
+                if js[end] == '\\':
+                    end += 1
+                elif js[end] == '[':
+                    in_class = True
+                elif js[end] == ']':
+                    in_class = False
+                end += 1
+            out.append(js[i:end + 1])
+            i = end + 1
+        elif c.isspace():
+            end = i
+            while end < n and js[end].isspace():
+                end += 1
+            if '\n' in js[i:end]:
+                out.append('\n')
+            elif out and end < n and out[-1][-1] not in TIGHT and js[end] not in TIGHT:
+                out.append(' ')
+            i = end
+        else:
+            out.append(c)
+            i += 1
+    lines = (line.strip() for line in ''.join(out).split('\n'))
+    return '\n'.join(line for line in lines if line) + '\n'
+
+
+def is_regex_start(before):
+    before = before.rstrip()
+    if not before:
+        return True
+    if before[-1] in REGEX_AFTER:
+        return True
+    word = re.search(r'[\w$]+$', before)
+    return word is not None and word.group() in REGEX_KEYWORDS
+
+
+def write(path, data):
+    # written next to the target and renamed, a half written file is never served
+    tmp = '%s.%d-%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, OUTPUT, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def build(static_folder, echo=print):
+    """Bundle and minify the files of each bundle into static/dist, named
+    after a hash of the content, with .gz (and .br when the brotli module is
+    installed) copies for nginx. The files of the previous build are kept
+    for the pages still pointing at them, older ones are removed."""
+    output = os.path.join(static_folder, OUTPUT)
+    os.makedirs(output, exist_ok=True)
+    previous = load_manifest(static_folder)
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        base, ext = os.path.splitext(name)
+        parts = []
+        for source in sources:
+            with open(os.path.join(static_folder, source), encoding='utf-8') as f:
+                parts.append(f.read())
+        if ext == '.js':
+            # a file without a trailing semicolon must not run into the next
+            data = minify_js(';\n'.join(parts)).encode('utf-8')
+        else:
+            data = minify_css('\n'.join(parts)).encode('utf-8')
+        filename = '%s.%s%s' % (base, sha1(data).hexdigest()[:12], ext)
+        path = os.path.join(output, filename)
+        write(path, data)
+        write(path + '.gz', gzip.compress(data, 9, mtime=0))
+        if brotli is not None:
+            write(path + '.br', brotli.compress(data, quality=11))
+        manifest[name] = OUTPUT + '/' + filename
+        echo('%s: %d bytes from %d, %d gzipped' % (
+            manifest[name], len(data), sum(len(part.encode('utf-8')) for part in parts),
+            os.path.getsize(path + '.gz')))
+    write(os.path.join(output, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    keep = {os.path.basename(path) for path in list(manifest.values()) + list(previous.values())}
+    for filename in os.listdir(output):
+        if filename != MANIFEST and re.sub(r'\.(gz|br)$', '', filename) not in keep:
+            os.remove(os.path.join(output, filename))
+    return manifest
+
+
+def asset_urls(name):
+    """The urls to load a bundle from: the built file when there is one,
+    otherwise each of its source files."""
+    manifest = current_app.asset_manifest
+    if name in manifest:
+        return [url_for('static', filename=manifest[name])]
+    return [url_for('static', filename=source) for source in BUNDLES[name]]
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from app.assets import write
+from app.metrics import outbound
+
+# requested sizes are rounded up to one of these, so that a digest has a
+# handful of files on disk at most
+SIZES = (32, 64, 70, 128, 256, 512)
+IMAGE_TYPES = ((b'\x89PNG', 'image/png'), (b'\xff\xd8', 'image/jpeg'), (b'GIF8', 'image/gif'))
+
+
+def email_digest(email):
+    return md5(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+def round_size(size):
+    for allowed in SIZES:
+        if size <= allowed:
+            return allowed
+    return SIZES[-1]
+
+
+def identicon(digest):
+    """A 5x5 mirrored grid coloured after the digest, as SVG so that one
+    file serves every size."""
+    color = '#' + digest[-6:]
+    cells = []
+    for row in range(5):
+        for column in range(3):
+            if int(digest[row * 3 + column], 16) % 2 == 0:
+                for x in {column, 4 - column}:
+                    cells.append('<rect x="%d" y="%d" width="1" height="1"/>' % (x, row))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" viewBox="-0.5 -0.5 6 6" shape-rendering="crispEdges">'
+            '<rect x="-0.5" y="-0.5" width="6" height="6" fill="#f0f0f0"/>'
+            '<g fill="%s">%s</g></svg>' % (color, ''.join(cells))).encode('ascii')
+
+
+def image_type(data):
+    for magic, mimetype in IMAGE_TYPES:
+        if data.startswith(magic):
+            return mimetype
+
+
+class AvatarStore(object):
+    """Avatars kept on disk under path, one directory per digest prefix.
+
+    Only the digests of users are passed in, so that files are written
+    and Gravatar is asked for these alone. Every digest gets an identicon
+    made here. When gravatar_url is set, the Gravatar image is fetched in
+    the background by a few threads, and is served instead of the
+    identicon once it is on disk. A digest Gravatar doesn't know gets a
+    marker file, so it is asked again only after `refresh` seconds, like
+    the images themselves.
+    """
+
+    def __init__(self, path, http, gravatar_url, workers, refresh, timeout):
+        self.path = path
+        self.http = http
+        self.gravatar_url = gravatar_url
+        self.workers = workers
+        self.refresh = refresh
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.executor = None
+
+    def reset(self):
+        # threads don't survive a fork
+        with self.lock:
+            self.executor = None
+            self.pending = set()
+
+    def filename(self, digest, suffix):
+        return os.path.join(self.path, digest[:2], digest + suffix)
+
+    def get(self, digest, size):
+        """Return (path, mimetype, final) for the avatar to serve now; final
+        is False while the Gravatar image may still replace it."""
+        gravatar = self.filename(digest, '-%d' % size)
+        missing = self.filename(digest, '.missing')
+        for path in (gravatar, missing):
+            if os.path.exists(path):
+                # a stale file is served once more, but not cached for long
+                stale = self.gravatar_url and time.time() - os.path.getmtime(path) > self.refresh
+                if stale:
+                    self.fetch(digest, size)
+                if path == gravatar:
+                    with open(path, 'rb') as f:
+                        return path, image_type(f.read(8)), not stale
+                return self.identicon(digest), 'image/svg+xml', not stale
+        if self.gravatar_url:
+            self.fetch(digest, size)
+        return self.identicon(digest), 'image/svg+xml', not self.gravatar_url
+
+    def identicon(self, digest):
+        path = self.filename(digest, '.svg')
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write(path, identicon(digest))
+        return path
+
+    def fetch(self, digest, size):
+        with self.lock:
+            if (digest, size) in self.pending:
+                return
+            self.pending.add((digest, size))
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers)
+            executor = self.executor
+        executor.submit(self.download, digest, size)
+
+    def download(self, digest, size):
+        try:
+            with outbound('gravatar', 'avatar'):
+                rv = self.http.get().get('%s%s' % (self.gravatar_url, digest), params={'s': size, 'd': '404'},
+                                         timeout=self.timeout)
+            os.makedirs(os.path.join(self.path, digest[:2]), exist_ok=True)
+            if rv.status_code == 404:
+                write(self.filename(digest, '.missing'), b'')
+                if os.path.exists(self.filename(digest, '-%d' % size)):
+                    os.remove(self.filename(digest, '-%d' % size))
+            elif rv.status_code == 200 and image_type(rv.content):
+                write(self.filename(digest, '-%d' % size), rv.content)
+        except Exception:
+            # the identicon is served meanwhile, the next request retries
+            pass
+        finally:
+            with self.lock:
+                self.pending.discard((digest, size))
@@ -0,0 +1,184 @@
+import json
+import random
+import re
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import db
+from app.models import User, Book, Comment, Rating
+from app.seed import WORDS
+
+# endpoint name -> url, filled in with random ids of the seeded data
+ENDPOINTS = {
+    'index': lambda ids: '/index',
+    'explore': lambda ids: '/explore?page=%d' % random.randint(1, 5),
+    'explore_top': lambda ids: '/explore?sort=top',
+    'book': lambda ids: '/book/%d' % ids.pick(Book),
+    'comment': lambda ids: '/comment/%d' % ids.pick(Comment),
+    'search': lambda ids: '/search?q=%s' % random.choice(WORDS),
+    'api_users': lambda ids: '/api/users?page=%d' % random.randint(1, 5),
+    'api_user': lambda ids: '/api/users/%d' % ids.pick(User),
+    'api_books': lambda ids: '/api/books?ids=%s' % ','.join(str(ids.pick(Book)) for _ in range(20)),
+}
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+class IdRange(object):
+    def __init__(self):
+        self.ranges = {}
+
+    def pick(self, model):
+        if model not in self.ranges:
+            self.ranges[model] = db.session.query(db.func.min(model.id), db.func.max(model.id)).one()
+        low, high = self.ranges[model]
+        return random.randint(low or 0, high or 0)
+
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+class TestClientTarget(object):
+    """Requests served in process, with queries counted on the engine."""
+
+    name = 'test_client'
+
+    def __init__(self, app, user, token):
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+        self.headers = {'Authorization': 'Bearer ' + token}
+        self.queries = 0
+        event.listen(Engine, 'before_cursor_execute', self.count_query)
+
+    def count_query(self, *args):
+        self.queries += 1
+
+    def close(self):
+        event.remove(Engine, 'before_cursor_execute', self.count_query)
+
+    def get(self, url):
+        self.queries = 0
+        rv = self.client.get(url, headers=self.headers if url.startswith('/api/') else {})
+        db.session.remove()
+        return rv.status_code, self.queries
+
+
+class HTTPTarget(object):
+    """Requests sent to a running server, e.g. a local gunicorn. Query counts
+    are read from the Server-Timing header, which needs SQL_PROFILING."""
+
+    def __init__(self, app, url, user, token):
+        import requests
+        self.name = url
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        cookie = app.session_interface.get_signing_serializer(app).dumps({'_user_id': str(user.id), '_fresh': True})
+        self.session.cookies.set(app.session_cookie_name, cookie)
+        self.headers = {'Authorization': 'Bearer ' + token}
+
+    def close(self):
+        self.session.close()
+
+    def get(self, url):
+        rv = self.session.get(self.url + url, headers=self.headers if url.startswith('/api/') else {},
+                              allow_redirects=False)
+        match = SERVER_TIMING_QUERIES.search(rv.headers.get('Server-Timing', ''))
+        return rv.status_code, int(match.group(1)) if match else None
+
+
+def run_endpoint(target, url_for_request, requests, warmup, concurrency):
+    for _ in range(warmup):
+        target.get(url_for_request())
+    urls = [url_for_request() for _ in range(requests)]
+
+    def timed_get(url):
+        start = time.perf_counter()
+        status, queries = target.get(url)
+        return time.perf_counter() - start, status, queries
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(timed_get, urls))
+    else:
+        results = [timed_get(url) for url in urls]
+    elapsed = time.perf_counter() - start
+    latencies = [latency * 1000 for latency, _, _ in results]
+    queries = [count for _, _, count in results if count is not None]
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, status, _ in results if status >= 400),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'queries_per_request': sum(queries) / len(queries) if queries else None,
+        'throughput_rps': requests / elapsed if elapsed else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=current_app.root_path,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(endpoints=None, requests=200, warmup=10, url=None, concurrency=1, echo=print):
+    """Benchmark the given endpoints against the data in the database and
+    return the results, ready to be saved as JSON and compared."""
+    user = User.query.order_by(User.id).first()
+    if user is None:
+        raise ValueError('the database is empty, run flask bench seed first')
+    token = user.get_token()
+    db.session.commit()
+    app = current_app._get_current_object()
+    # the test client shares one app context, so it is driven from one thread
+    concurrency = concurrency if url else 1
+    target = HTTPTarget(app, url, user, token) if url else TestClientTarget(app, user, token)
+    ids = IdRange()
+    results = {
+        'commit': git_commit(),
+        'created': datetime.utcnow().isoformat() + 'Z',
+        'target': target.name,
+        'concurrency': concurrency,
+        'dataset': {model.__tablename__: db.session.query(db.func.count(model.id)).scalar()
+                    for model in (User, Book, Rating, Comment)},
+        'endpoints': {},
+    }
+    try:
+        for name in endpoints or ENDPOINTS:
+            result = run_endpoint(target, lambda: ENDPOINTS[name](ids), requests, warmup, concurrency)
+            results['endpoints'][name] = result
+            echo('%-12s p50 %7.1fms  p95 %7.1fms  p99 %7.1fms  %6.1f queries  %7.1f req/s' % (
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['queries_per_request'] or 0, result['throughput_rps']))
+    finally:
+        target.close()
+    return results
+
+
+def compare(old, new, echo=print):
+    echo('%-12s %12s %12s %8s' % ('endpoint', 'old p95', 'new p95', 'change'))
+    for name, result in new['endpoints'].items():
+        before = old['endpoints'].get(name)
+        if before is None:
+            continue
+        change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+        echo('%-12s %10.1fms %10.1fms %+7.1f%%' % (name, before['p95_ms'], result['p95_ms'], change))
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
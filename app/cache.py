@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class LRUCache(object):
+    """Size-capped LRU cache for rendered strings.
+
+    max_size is the total length of the cached values; 0 disables caching.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_size:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'items': len(self._items),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate()
+        }
+
+
+class TTLCache(object):
+    """Per-process cache of small values, e.g. user snapshots.
+
+    Entries expire after ttl seconds, which bounds how long a change made in
+    another worker process stays invisible here; changes committed in this
+    process invalidate the entry right away. At most max_size entries are
+    kept, the oldest are dropped first; a ttl of 0 disables caching.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time() - item[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time(), value)
+            while len(self._items) > self.max_size:
+                del self._items[next(iter(self._items))]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
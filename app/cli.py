@@ -33,3 +33,126 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def recs():
+        """Book recommendation commands."""
+        pass
+
+    @recs.command()
+    def build():
+        """Rebuild the similar books table from all ratings."""
+        from app.recs import build
+        count = build(app.config['RECS_PATH'], app.config['RECS_K'])
+        click.echo('Computed neighbours for %d books' % count)
+
+    @recs.command()
+    def refresh():
+        """Recompute books whose ratings changed since the last build."""
+        from app.recs import refresh
+        count = refresh(app.config['RECS_PATH'], app.config['RECS_K'])
+        click.echo('Recomputed neighbours for %d books' % count)
+
+    @app.cli.group()
+    def books():
+        """Book catalogue commands."""
+        pass
+
+    @books.command('import')
+    @click.argument('path')
+    @click.option('--user', 'username', required=True, help='Username the books are posted by.')
+    @click.option('--format', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+    @click.option('--batch-size', default=5000, help='Rows per transaction.')
+    @click.option('--workers', type=int, help='Language detection processes, 0 to detect inline.')
+    @click.option('--dry-run', is_flag=True, help='Validate the file without writing anything.')
+    @click.option('--resume', is_flag=True, help='Continue an interrupted import of the same file.')
+    def import_books(path, username, format, batch_size, workers, dry_run, resume):
+        """Import books from a CSV or JSON Lines file."""
+        from app.importer import import_books
+        from app.models import User
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter('no such user', param_hint='--user')
+        result = import_books(path, user, format=format, batch_size=batch_size, workers=workers,
+                              dry_run=dry_run, resume=resume, echo=click.echo)
+        click.echo('Done: %(read)d read, %(imported)d imported, %(skipped)d skipped' % result)
+
+    @app.cli.command()
+    @click.argument('name', type=click.Choice(['books', 'ratings', 'comments']))
+    @click.option('--format', type=click.Choice(['jsonl', 'csv']), default='jsonl')
+    @click.option('--output', type=click.File('w'), default='-', help='Defaults to stdout.')
+    def export(name, format, output):
+        """Stream a table out as JSON Lines or CSV."""
+        from app.exporter import export_lines
+        for chunk in export_lines(name, format):
+            output.write(chunk)
+
+    @app.cli.group()
+    def notifications():
+        """Notification store commands."""
+        pass
+
+    @notifications.command()
+    @click.option('--max-age', type=int, help='Seconds, defaults to NOTIFICATION_MAX_AGE.')
+    @click.option('--batch-size', default=10000, help='Rows per transaction.')
+    def purge(max_age, batch_size):
+        """Delete notifications nobody polled for in a long time."""
+        from app.models import Notification
+        count = Notification.purge(max_age or app.config['NOTIFICATION_MAX_AGE'], batch_size)
+        click.echo('Deleted %d notifications' % count)
+
+    @app.cli.group()
+    def assets():
+        """Static asset commands."""
+        pass
+
+    @assets.command('build')
+    def build_assets():
+        """Bundle, minify and compress the CSS and JavaScript."""
+        from app.assets import build
+        build(app.static_folder, echo=click.echo)
+
+    @app.cli.group()
+    def bench():
+        """Benchmark data and endpoint benchmarks."""
+        pass
+
+    @bench.command()
+    @click.option('--users', default=100000)
+    @click.option('--books', 'n_books', default=1000000)
+    @click.option('--ratings', default=10000000)
+    @click.option('--comments', default=1000000)
+    @click.option('--follows', default=20, help='Average number of users each user follows.')
+    @click.option('--seed', default=42, help='Random seed, the same seed gives the same data.')
+    @click.option('--batch-size', default=10000, help='Rows per transaction.')
+    def seed(users, n_books, ratings, comments, follows, seed, batch_size):
+        """Fill the database with synthetic users, books, ratings and comments."""
+        from app.seed import Seeder
+        Seeder(seed=seed, batch_size=batch_size, echo=click.echo).run(users, n_books, ratings, comments, follows)
+
+    @bench.command()
+    @click.option('--endpoint', 'endpoints', multiple=True, help='Defaults to all of them.')
+    @click.option('--requests', default=200, help='Measured requests per endpoint.')
+    @click.option('--warmup', default=10, help='Unmeasured requests per endpoint.')
+    @click.option('--url', help='Base url of a running server, defaults to the Flask test client.')
+    @click.option('--concurrency', default=1, help='Parallel requests, only with --url.')
+    @click.option('--output', help='Save the results as JSON.')
+    def run(endpoints, requests, warmup, url, concurrency, output):
+        """Measure latency, queries per request and throughput per endpoint."""
+        from app.bench import ENDPOINTS, run, save
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise click.BadParameter(', '.join(sorted(unknown)), param_hint='--endpoint')
+        results = run(endpoints, requests=requests, warmup=warmup, url=url, concurrency=concurrency,
+                      echo=click.echo)
+        if output:
+            save(results, output)
+
+    @bench.command()
+    @click.argument('old', type=click.File())
+    @click.argument('new', type=click.File())
+    def compare(old, new):
+        """Compare the p95 latencies of two saved runs."""
+        import json
+        from app.bench import compare
+        compare(json.load(old), json.load(new), echo=click.echo)
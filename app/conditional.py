@@ -0,0 +1,45 @@
+from hashlib import sha1
+from time import time
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+
+
+def make_etag(*parts):
+    return sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def viewer_tag():
+    # everything base.html renders for the logged in user
+    if not current_user.is_authenticated:
+        return None
+    return (current_user.id, current_user.version, current_user.new_messages())
+
+
+def csrf_epoch():
+    # pages embedding a CSRF token must not be revalidated once the token
+    # gets close to expiring, so the epoch is half the token lifetime
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    return int(time() // (limit / 2)) if limit else 0
+
+
+def page_etag(*parts):
+    return make_etag(request.full_path, getattr(g, 'locale', None), viewer_tag(), csrf_epoch(), *parts)
+
+
+def is_fresh(etag):
+    # a pending flash message has to be rendered, whatever the client has
+    if '_flashes' in session:
+        return False
+    return etag in request.if_none_match
+
+
+def with_etag(rv, etag):
+    response = make_response(rv)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag):
+    return with_etag(('', 304), etag)
@@ -1,10 +1,11 @@
 from threading import Thread
 from flask_mail import Message
 from app import mail
+from app.metrics import outbound
 from flask import current_app
 
 def send_async_email(app, message):
-    with app.app_context():
+    with app.app_context(), outbound('smtp', 'send'):
         mail.send(message)
 
 def send_email(subject, sender, recipients, text_body, html_body):
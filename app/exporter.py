@@ -0,0 +1,47 @@
+import csv
+import io
+import json
+from datetime import datetime
+from app import db
+from app.models import Book, Rating, Comment
+
+EXPORTS = {
+    'books': [Book.id, Book.isbn, Book.title, Book.author, Book.description, Book.language, Book.time,
+              Book.user_id],
+    'ratings': [Rating.id, Rating.user_id, Rating.book_id, Rating.score],
+    'comments': [Comment.id, Comment.author_id, Comment.book_id, Comment.parent_id, Comment.body,
+                 Comment.language, Comment.time]
+}
+FORMATS = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+CHUNK_ROWS = 1000
+
+
+def _value(value):
+    return value.isoformat() + 'Z' if isinstance(value, datetime) else value
+
+
+def export_rows(name):
+    """Plain row tuples, streamed from a server side cursor."""
+    columns = EXPORTS[name]
+    return db.session.query(*columns).order_by(columns[0]).yield_per(CHUNK_ROWS)
+
+
+def export_lines(name, format):
+    """Serialized export, yielded in chunks of CHUNK_ROWS rows so a table
+    of any size is written with constant memory."""
+    keys = [column.key for column in EXPORTS[name]]
+    buffer = io.StringIO()
+    if format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(keys)
+        write = lambda row: writer.writerow([_value(value) for value in row])
+    else:
+        write = lambda row: buffer.write(json.dumps(dict(zip(keys, map(_value, row)))) + '\n')
+    for i, row in enumerate(export_rows(name), 1):
+        write(row)
+        if i % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,81 @@
+from array import array
+from bisect import bisect_left
+from time import time
+
+
+def _contains(ids, id):
+    i = bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+
+def _insert(ids, id):
+    i = bisect_left(ids, id)
+    if i < len(ids) and ids[i] == id:
+        return False
+    ids.insert(i, id)
+    return True
+
+
+def _remove(ids, id):
+    i = bisect_left(ids, id)
+    if i < len(ids) and ids[i] == id:
+        del ids[i]
+        return True
+    return False
+
+
+class FollowGraph(object):
+    """Per-process follow index.
+
+    Both directions of the followers table are kept as sorted arrays of
+    user ids, so membership is a binary search and counts are len().
+    The graph is rebuilt from the database once it is older than ttl
+    seconds, which bounds how long writes made by other worker processes
+    stay invisible.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.loaded_at = None
+        self.followed = {}
+        self.followers = {}
+
+    def load(self, edges):
+        followed, followers = {}, {}
+        for follower_id, followed_id in edges:
+            followed.setdefault(follower_id, []).append(followed_id)
+            followers.setdefault(followed_id, []).append(follower_id)
+        self.followed = {id: array('i', sorted(set(ids))) for id, ids in followed.items()}
+        self.followers = {id: array('i', sorted(set(ids))) for id, ids in followers.items()}
+        self.loaded_at = time()
+
+    def is_loaded(self):
+        return self.loaded_at is not None
+
+    def is_stale(self):
+        if self.loaded_at is None:
+            return True
+        return bool(self.ttl) and time() - self.loaded_at > self.ttl
+
+    def add(self, follower_id, followed_id):
+        if _insert(self.followed.setdefault(follower_id, array('i')), followed_id):
+            _insert(self.followers.setdefault(followed_id, array('i')), follower_id)
+
+    def remove(self, follower_id, followed_id):
+        if _remove(self.followed.get(follower_id, array('i')), followed_id):
+            _remove(self.followers.get(followed_id, array('i')), follower_id)
+
+    def is_following(self, follower_id, followed_id):
+        return _contains(self.followed.get(follower_id, ()), followed_id)
+
+    def is_mutual(self, a, b):
+        return self.is_following(a, b) and self.is_following(b, a)
+
+    def followed_count(self, id):
+        return len(self.followed.get(id, ()))
+
+    def follower_count(self, id):
+        return len(self.followers.get(id, ()))
+
+    def edge_count(self):
+        return sum(len(ids) for ids in self.followed.values())
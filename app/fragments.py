@@ -0,0 +1,13 @@
+from flask import current_app, g, render_template
+from markupsafe import Markup
+
+
+def book_fragment(book, part):
+    """Render the viewer independent part of a book card, cached per book version and locale."""
+    key = ('book', part, book.id, book.version, g.locale)
+    cache = current_app.fragment_cache
+    html = cache.get(key)
+    if html is None:
+        html = Markup(render_template('_book_%s.html' % part, book=book))
+        cache.set(key, html)
+    return html
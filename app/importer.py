@@ -0,0 +1,133 @@
+import csv
+import json
+import os
+from itertools import islice
+from multiprocessing import Pool
+from guess_language import guess_language
+from flask import current_app
+from flask_sqlalchemy import get_debug_queries
+from app import db
+from app.models import Book, BookStats, ImportProgress
+from app.search import add_to_index_bulk
+
+FIELDS = ['title', 'author', 'isbn', 'description']
+
+
+def detect_language(text):
+    language = guess_language(text) if text else 'UNKNOWN'
+    if language == 'UNKNOWN' or len(language) > 5:
+        language = ''
+    return language
+
+
+def read_records(f, format):
+    if format == 'csv':
+        for row in csv.DictReader(f):
+            yield row
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def clean(record):
+    book = {}
+    for field in FIELDS:
+        value = record.get(field) or ''
+        book[field] = str(value).strip()[:Book.__table__.c[field].type.length]
+    if not book['title'] or not book['author']:
+        return None
+    return book
+
+
+class Checkpoint(object):
+    """Progress of an import, saved in the transaction of every batch so an
+    interrupted import is resumed right after the last committed batch."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.records = 0
+        self.first_id = None
+
+    def load(self):
+        progress = ImportProgress.query.get(self.path)
+        if progress is not None:
+            self.records, self.first_id = progress.records, progress.first_id
+        return self
+
+    def save(self):
+        # committed by the caller, together with the batch
+        db.session.merge(ImportProgress(path=self.path, records=self.records, first_id=self.first_id))
+
+    def remove(self):
+        ImportProgress.query.filter_by(path=self.path).delete()
+        db.session.commit()
+
+
+def insert_batch(books):
+    books_table, stats_table = Book.__table__, BookStats.__table__
+    floor = db.session.query(db.func.max(Book.id)).scalar() or 0
+    db.session.execute(books_table.insert(), books)
+    # the batch bypasses the ORM, so the leaderboard rows are added here
+    db.session.execute(stats_table.insert().from_select(
+        ['book_id', 'rating_count', 'rating_sum', 'top_score', 'trending_score'],
+        db.select([books_table.c.id, db.literal(0), db.literal(0),
+                   db.literal(current_app.config['LEADERBOARD_PRIOR_MEAN']), db.literal(0)]).where(
+            books_table.c.id > floor).where(~db.exists().where(stats_table.c.book_id == books_table.c.id))))
+    return floor + 1
+
+
+def import_books(path, user, format=None, batch_size=5000, workers=None, dry_run=False, resume=False,
+                 echo=print):
+    """Stream books from a CSV or JSON Lines file into the database.
+
+    Rows are inserted in batches of batch_size, one transaction each, with
+    language detection spread over a process pool. Search indexing is done
+    in a single bulk pass once every batch is committed.
+    """
+    format = format or ('csv' if path.endswith('.csv') else 'jsonl')
+    checkpoint = Checkpoint(path)
+    if resume:
+        checkpoint.load()
+        echo('Resuming after %d records' % checkpoint.records)
+    pool = Pool(workers) if workers != 0 else None
+    read, imported, skipped = 0, 0, 0
+    user_id = user.id
+    try:
+        with open(path, newline='', encoding='utf-8') as f:
+            records = islice(read_records(f, format), checkpoint.records, None)
+            while True:
+                batch = list(islice(records, batch_size))
+                if not batch:
+                    break
+                read += len(batch)
+                books = [book for book in map(clean, batch) if book is not None]
+                skipped += len(batch) - len(books)
+                texts = [book['description'] or book['title'] for book in books]
+                languages = pool.map(detect_language, texts, chunksize=256) if pool else map(detect_language, texts)
+                for book, language in zip(books, languages):
+                    book['language'] = language
+                    book['user_id'] = user_id
+                if not dry_run:
+                    if books:
+                        first_id = insert_batch(books)
+                        if checkpoint.first_id is None:
+                            checkpoint.first_id = first_id
+                    checkpoint.records += len(batch)
+                    checkpoint.save()
+                    db.session.commit()
+                    # in debug mode Flask-SQLAlchemy keeps every query with its
+                    # parameters for the lifetime of the app context
+                    del get_debug_queries()[:]
+                imported += len(books)
+                echo('%d records read, %d books %s' % (read, imported, 'valid' if dry_run else 'imported'))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if not dry_run:
+        if checkpoint.first_id is not None:
+            new_books = Book.query.filter(Book.id >= checkpoint.first_id).order_by(Book.id)
+            add_to_index_bulk(Book.__tablename__, new_books.yield_per(1000))
+        checkpoint.remove()
+    return {'read': read, 'imported': imported, 'skipped': skipped}
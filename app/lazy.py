@@ -0,0 +1,42 @@
+class LazyClient(object):
+    """Stands in for a client that is only built, and its module only
+    imported, when it is first used. reset() drops it, e.g. after a fork."""
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_client', None)
+
+    def get(self):
+        if self._client is None:
+            object.__setattr__(self, '_client', self._factory())
+        return self._client
+
+    def reset(self):
+        object.__setattr__(self, '_client', None)
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+
+
+def elasticsearch_client(url):
+    from elasticsearch import Elasticsearch
+    return Elasticsearch([url])
+
+
+def recommendations(path):
+    from app.recs import Recommendations
+    return Recommendations(path)
+
+
+def http_session(pool_size):
+    # one keep-alive pool for outbound HTTP calls, shared by the threads or
+    # greenlets of a worker
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -1,46 +1,79 @@
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, abort
+from datetime import datetime, timedelta
+from time import time
+import re
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, abort, send_file, \
+    session
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
+from flask_wtf.csrf import generate_csrf
 from guess_language import guess_language
 from app import db
 from app.main.forms import EditProfileForm, EmptyForm, BookForm, SearchForm, MessageForm, CommentForm
-from app.models import User, Book, Rating, Message, Notification, Comment
-from app.translate import translate
+from app.models import User, Book, BookStats, Rating, Message, Notification, Comment, Conversation, follow_graph
+from app.translate import translate_many
+from app.avatars import identicon, round_size
+from app.conditional import page_etag, make_etag, csrf_epoch, is_fresh, with_etag, not_modified
+from app.sqlite import retry_locked
 from app.main import bp
 from werkzeug.utils import secure_filename
 import os
 
+MAX_TRANSLATIONS = 20
+
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        # a write per request would also pin every read to the primary
+        now = datetime.utcnow()
+        interval = timedelta(seconds=current_app.config['LAST_SEEN_INTERVAL'])
+        if current_user.last_seen is None or now - current_user.last_seen >= interval:
+            update_last_seen(now)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+@retry_locked
+def update_last_seen(now):
+    current_user.last_seen = now
+    db.session.commit()
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
     page = request.args.get('page', 1, type=int)
     books = current_user.followed_books().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    etag = page_etag(books.total, [(b.id, b.version) for b in books.items])
+    if is_fresh(etag):
+        return not_modified(etag)
     next_url = url_for('main.index', page=books.next_num) if books.has_next else None
     prev_url = url_for('main.index', page=books.prev_num) if books.has_prev else None
-    return render_template('index.html', title=_('Home'), books=books.items, next_url=next_url, prev_url=prev_url)
+    return with_etag(render_template('index.html', title=_('Home'), books=books.items, next_url=next_url, prev_url=prev_url), etag)
 
 
 @bp.route('/explore')
 @login_required
 def explore():
     page = request.args.get('page', 1, type=int)
-    books = Book.query.order_by(Book.time.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=books.next_num) if books.has_next else None
-    prev_url = url_for('main.explore', page=books.prev_num) if books.has_prev else None
-    return render_template('index.html', title=_('Explore'), books=books.items, next_url=next_url, prev_url=prev_url)
+    sort = request.args.get('sort', '')
+    if sort == 'top':
+        query = Book.query.join(BookStats).order_by(BookStats.top_score.desc(), BookStats.book_id.desc())
+    elif sort == 'trending':
+        query = Book.query.join(BookStats).order_by(BookStats.trending_score.desc(), BookStats.book_id.desc())
+    else:
+        sort = ''
+        query = Book.query.order_by(Book.time.desc())
+    books = query.paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    etag = page_etag(books.total, [(b.id, b.version) for b in books.items])
+    if is_fresh(etag):
+        return not_modified(etag)
+    next_url = url_for('main.explore', sort=sort or None, page=books.next_num) if books.has_next else None
+    prev_url = url_for('main.explore', sort=sort or None, page=books.prev_num) if books.has_prev else None
+    sorts = [('', _('Latest')), ('top', _('Top rated')), ('trending', _('Trending'))]
+    return with_etag(render_template('index.html', title=_('Explore'), books=books.items, sort=sort, sorts=sorts,
+                                     next_url=next_url, prev_url=prev_url), etag)
 
 
 @bp.route('/user/<username>')
@@ -50,10 +83,16 @@ def user(username):
     page = request.args.get('page', 1, type=int)
     books = user.books.order_by(Book.time.desc()).paginate(
         page, current_app.config['POSTS_PER_PAGE'], False)
+    graph = follow_graph()
+    etag = page_etag(user.id, user.version, user.last_seen, books.total, [(b.id, b.version) for b in books.items],
+                     graph.follower_count(user.id), graph.followed_count(user.id),
+                     graph.is_following(current_user.id, user.id))
+    if is_fresh(etag):
+        return not_modified(etag)
     next_url = url_for('main.user', username=user.username, page=books.next_num) if books.has_next else None
     prev_url = url_for('main.user', username=user.username, page=books.prev_num) if books.has_prev else None
     form = EmptyForm()
-    return render_template('user.html', user=user, books=books.items, next_url=next_url, prev_url=prev_url, form=form)
+    return with_etag(render_template('user.html', user=user, books=books.items, next_url=next_url, prev_url=prev_url, form=form), etag)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -86,6 +125,7 @@ def follow(username):
             return redirect(url_for('main.user', username=username))
         current_user.follow(user)
         db.session.commit()
+        session['follows_written'] = time()
         flash(_('You are following %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -106,6 +146,7 @@ def unfollow(username):
             return redirect(url_for('main.user', username=username))
         current_user.unfollow(user)
         db.session.commit()
+        session['follows_written'] = time()
         flash(_('You are not following %(username)s.', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -115,13 +156,12 @@ def unfollow(username):
 @bp.route('/translate', methods=['POST'])
 @login_required
 def translate_text():
-    return jsonify({
-        'text': translate(
-            request.form['text'],
-            request.form['source_language'],
-            request.form['dest_language']
-        )
-    })
+    # several text fields are translated concurrently
+    texts = request.form.getlist('text')[:MAX_TRANSLATIONS]
+    if not texts:
+        abort(400)
+    translations = translate_many(texts, request.form['source_language'], request.form['dest_language'])
+    return jsonify({'text': translations[0], 'texts': translations})
 
 @bp.route('/search')
 @login_required
@@ -131,20 +171,66 @@ def search():
     page = request.args.get('page', 1, type=int)
     books, total = Book.search(g.search_form.q.data, page,
                                 current_app.config['POSTS_PER_PAGE'])
+    books = books.all()
+    etag = page_etag(total, [(b.id, b.version) for b in books])
+    if is_fresh(etag):
+        return not_modified(etag)
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
         if page > 1 else None
-    return render_template('search.html', title=_('Search'), books=books,
-                           next_url=next_url, prev_url=prev_url)
+    return with_etag(render_template('search.html', title=_('Search'), books=books,
+                                     next_url=next_url, prev_url=prev_url), etag)
+
+
+@bp.route('/avatar/<digest>')
+def avatar(digest):
+    if not re.match(r'^[0-9a-f]{32}$', digest):
+        abort(404)
+    if db.session.query(User.id).filter_by(avatar_hash=digest).first() is None:
+        # anyone can ask for any digest, only those of users are fetched and kept on disk
+        response = current_app.response_class(identicon(digest), mimetype='image/svg+xml')
+        response.set_etag(digest)
+        response = response.make_conditional(request)
+        response.cache_control.max_age = current_app.config['AVATAR_MAX_AGE']
+    else:
+        path, mimetype, final = current_app.avatars.get(digest, round_size(request.args.get('s', 80, type=int)))
+        max_age = current_app.config['AVATAR_MAX_AGE' if final else 'AVATAR_PENDING_MAX_AGE']
+        response = send_file(path, mimetype=mimetype, conditional=True, cache_timeout=max_age)
+    response.cache_control.public = True
+    return response
 
 
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    form = EmptyForm()
-    return render_template('user_popup.html', user=user, form=form)
+    # the user row is cached by username, the counts and the follow button
+    # come from the in-memory follow graph, so most hovers run no query
+    user = current_app.popup_cache.get(username)
+    if user is None:
+        row = User.query.filter_by(username=username).first_or_404()
+        user = {'id': row.id, 'username': row.username, 'about': row.about, 'avatar': row.avatar(64),
+                'last_seen': row.last_seen.isoformat() + 'Z' if row.last_seen else None}
+        current_app.popup_cache.set(username, user)
+    graph = follow_graph()
+    counts = graph.follower_count(user['id']), graph.followed_count(user['id'])
+    following = None if user['id'] == current_user.id else graph.is_following(current_user.id, user['id'])
+    etag = make_etag(user, counts, following, current_user.id, g.locale, csrf_epoch())
+    if not is_fresh(etag):
+        follow = None
+        if following is not None:
+            follow = {'url': url_for('main.unfollow' if following else 'main.follow', username=username),
+                      'label': _('Unfollow') if following else _('Follow'), 'csrf_token': generate_csrf()}
+        response = jsonify(dict(
+            user, url=url_for('main.user', username=username), last_seen_label=_('Last seen on'),
+            counts='%s, %s' % (_('%(count)d followers', count=counts[0]), _('%(count)d following', count=counts[1])),
+            follow=follow))
+    else:
+        response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['POPUP_MAX_AGE']
+    return response
 
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
@@ -153,12 +239,11 @@ def send_message(recipient):
     user = User.query.filter_by(username=recipient).first_or_404()
     form = MessageForm()
     if form.validate_on_submit():
-        message = Message(author=current_user, recipient=user, body=form.message.data)
-        db.session.add(message)
+        Conversation.send(current_user.get_user(), user, form.message.data)
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
         flash(_('Your message has been sent.'))
-        return redirect(url_for('main.user', username=recipient))
+        return redirect(url_for('main.conversation', username=recipient))
     return render_template('send_message.html', title=_('Send Message'), form=form, recipient=recipient)
 
 @bp.route('/messages')
@@ -167,17 +252,44 @@ def messages():
     current_user.last_message_read_time = datetime.utcnow()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
+    # pages follow the last conversation shown, not an offset
+    before = request.args.get('before', type=datetime.fromisoformat)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    conversations = Conversation.inbox(current_user.id, before, per_page)
+    users, last_messages = {}, {}
+    if conversations:
+        users = {user.id: user for user in User.query.filter(
+            User.id.in_({c.other_id(current_user.id) for c in conversations}))}
+        last_messages = {message.id: message for message in Message.query.filter(
+            Message.id.in_([c.last_message_id for c in conversations]))}
+    inbox = [(users[c.other_id(current_user.id)], last_messages[c.last_message_id], c.unread(current_user.id))
+             for c in conversations]
+    next_url = url_for('main.messages', before=conversations[-1].last_time.isoformat()) \
+        if len(conversations) == per_page else None
+    prev_url = url_for('main.messages') if before else None
+    return render_template('messages.html', inbox=inbox, next_url=next_url, prev_url=prev_url)
+
+@bp.route('/messages/<username>')
+@login_required
+def conversation(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    conversation = Conversation.find(current_user.id, user.id).first_or_404()
+    if conversation.unread(current_user.id):
+        conversation.mark_read(current_user.id)
+        db.session.commit()
     page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(Message.time.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.messages', page=messages.next_num) if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items, next_url=next_url, prev_url=prev_url)
+    messages = conversation.messages.order_by(Message.time.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    next_url = url_for('main.conversation', username=username, page=messages.next_num) if messages.has_next else None
+    prev_url = url_for('main.conversation', username=username, page=messages.prev_num) if messages.has_prev else None
+    return render_template('conversation.html', user=user, messages=messages.items, next_url=next_url,
+                           prev_url=prev_url)
 
 @bp.route('/notifications')
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
+    # by id, so that the poll does not load the user row
+    notifications = Notification.query.filter(Notification.user_id == current_user.id,
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
     return jsonify([{
         'name': n.name,
@@ -194,7 +306,7 @@ def new_book():
         language = guess_language(form.description.data)
         if language == 'UNKNOWN' or len(language) > 5:
             language = ''
-        book = Book(description=form.description.data, isbn=form.isbn.data, title=form.title.data, author=form.author.data, poster=current_user, language=language)
+        book = Book(description=form.description.data, isbn=form.isbn.data, title=form.title.data, author=form.author.data, poster=current_user.get_user(), language=language)
         db.session.add(book)
         db.session.commit()
         f = form.photo.data
@@ -224,6 +336,7 @@ def edit_book(id):
             f = form.photo.data
             filename = secure_filename(f.filename)
             f.save(os.path.join(current_app.static_folder, 'book_covers', str(book.id)))
+            book.bump_version()
         db.session.commit()
         flash(_('Your book edited'))
         return redirect(url_for('main.index'))
@@ -238,22 +351,26 @@ def edit_book(id):
 @bp.route('/book/<int:id>', methods=['GET', 'POST'])
 def book(id):
     book = Book.query.get_or_404(id)
-    current_rating = Rating.query.filter_by(author=current_user, book=book).first()
     form = CommentForm()
     if form.validate_on_submit():
         language = guess_language(form.body.data)
         if language == 'UNKNOWN' or len(language) > 5:
             language = ''
-        comment = Comment(body=form.body.data, book=book, author=current_user._get_current_object(), language=language)
+        comment = Comment(body=form.body.data, book=book, author=current_user.get_user(), language=language)
         comment.save()
         flash('Your comment has been published.')
         return redirect(url_for('main.book', id=book.id, page=1))
     page = request.args.get('page', 1, type=int)
     comments = book.comments.order_by(Comment.time.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    comments_count = book.comments.count()
+    also_liked = book.also_liked(current_app.config['RECS_PER_BOOK'])
+    etag = page_etag(book.id, book.version, [(c.id, c.version) for c in comments.items],
+                     [(b.id, b.version) for b in also_liked])
+    if request.method == 'GET' and is_fresh(etag):
+        return not_modified(etag)
+    comments_count = comments.total
     next_url = url_for('main.book', id=book.id, page=comments.next_num) if comments.has_next else None
     prev_url = url_for('main.book', id=book.id, page=comments.prev_num) if comments.has_prev else None
-    return render_template('book.html', title=_('book'), comments_count=comments_count, books=[book], form=form, comments=comments.items, prev_url=prev_url, next_url=next_url)
+    return with_etag(render_template('book.html', title=_('book'), comments_count=comments_count, books=[book], also_liked=also_liked, form=form, comments=comments.items, prev_url=prev_url, next_url=next_url), etag)
 
 
 @bp.route('/edit_comment/<int:id>', methods=['GET', 'POST'])
@@ -281,34 +398,39 @@ def edit_comment(id):
 def comment(id):
     comment = Comment.query.get_or_404(id)
     parents = comment.get_parents(comment)
-    parent_book = Book.query.filter_by(id=parents[0].book_id)
+    parent_book = Book.query.filter_by(id=parents[0].book_id).all()
     form = CommentForm()
     if form.validate_on_submit():
         language = guess_language(form.body.data)
         if language == 'UNKNOWN' or len(language) > 5:
             language = ''
-        comment_reply = Comment(body=form.body.data, parent=comment, author=current_user._get_current_object(), language=language)
+        comment_reply = Comment(body=form.body.data, parent=comment, author=current_user.get_user(), language=language)
         comment_reply.save()
         flash('Your comment has been published.')
         return redirect(url_for('main.comment', id=comment.id, page=1))
     page = request.args.get('page', 1, type=int)
-    comments = Comment.query.filter_by(id=comment.id).first().replies.paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-    comments_count = Comment.query.filter_by(id=comment.id).first().replies.count()
+    comments = comment.replies.paginate(page, current_app.config['POSTS_PER_PAGE'], False)
+    etag = page_etag([(b.id, b.version) for b in parent_book], [(c.id, c.version) for c in parents],
+                     [(c.id, c.version) for c in comments.items])
+    if request.method == 'GET' and is_fresh(etag):
+        return not_modified(etag)
+    comments_count = comments.total
     next_url = url_for('main.comment', id=comment.id, page=comments.next_num) if comments.has_next else None
     prev_url = url_for('main.comment', id=comment.id, page=comments.prev_num) if comments.has_prev else None
-    return render_template('comment.html', title=_('comment'), parent_book=parent_book, parents=parents, comments_count=comments_count, comment=[comment], form=form, comments=comments.items, prev_url=prev_url, next_url=next_url)
+    return with_etag(render_template('comment.html', title=_('comment'), parent_book=parent_book, parents=parents, comments_count=comments_count, comment=[comment], form=form, comments=comments.items, prev_url=prev_url, next_url=next_url), etag)
 
 
 @bp.route('/echo', methods=['POST'])
+@login_required
 def hello():
-    rate_updating = request.json['rating']
-    book = Book.query.filter_by(id=request.json['book']).first()
-    rating = Rating.query.filter_by(author=current_user, book=book).first()
-    if rating:
-        rating.score = rate_updating
-    else:
-        new_rating = Rating(author=current_user._get_current_object(), book=book, score=rate_updating)
-        db.session.add(new_rating)
-        db.session.commit()
+    data = request.get_json(silent=True) or {}
+    try:
+        book_id, score = int(data['book']), int(data['rating'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    if not Rating.MIN_SCORE <= score <= Rating.MAX_SCORE:
+        abort(400)
+    book = Book.query.get_or_404(book_id)
+    Rating.upsert(current_user.id, {book.id: score})
     db.session.commit()
     return redirect(url_for('main.book', id=book.id))
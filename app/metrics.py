@@ -0,0 +1,98 @@
+import os
+import time
+from contextlib import contextmanager
+from flask import Response, current_app, g, has_request_context, request
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# with gunicorn, prometheus_multiproc_dir must be set (and emptied) before the
+# workers start, so that every worker writes its samples to shared files
+MULTIPROCESS_DIR = 'prometheus_multiproc_dir'
+
+REQUEST_LATENCY = Histogram(
+    'bibliophilia_request_duration_seconds', 'Request latency', ['endpoint', 'method'])
+REQUESTS = Counter(
+    'bibliophilia_requests_total', 'Requests by response status', ['endpoint', 'method', 'status'])
+REQUEST_QUERIES = Histogram(
+    'bibliophilia_request_db_queries', 'Database queries per request', ['endpoint'],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+OUTBOUND_LATENCY = Histogram(
+    'bibliophilia_outbound_duration_seconds', 'Calls to other services', ['service', 'operation'])
+OUTBOUND_ERRORS = Counter(
+    'bibliophilia_outbound_errors_total', 'Failed calls to other services', ['service', 'operation'])
+CACHE_REQUESTS = Counter(
+    'bibliophilia_cache_requests_total', 'Cache lookups', ['cache', 'result'])
+REJECTED = Counter(
+    'bibliophilia_rejected_requests_total', 'Requests turned away by admission control', ['endpoint', 'reason'])
+
+
+@contextmanager
+def outbound(service, operation):
+    """Time a call to Elasticsearch, the translation API or the mail server."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        OUTBOUND_ERRORS.labels(service, operation).inc()
+        raise
+    finally:
+        OUTBOUND_LATENCY.labels(service, operation).observe(time.perf_counter() - start)
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'metrics_start' in g:
+        g.metrics_queries += 1
+
+
+class Metrics(object):
+    """Request, database, outbound call and cache metrics, served in the
+    Prometheus text format at /metrics."""
+
+    def __init__(self):
+        # cache counters already exported by this process
+        self._cache_seen = {}
+
+    def init_app(self, app):
+        if not event.contains(Engine, 'before_cursor_execute', count_query):
+            event.listen(Engine, 'before_cursor_execute', count_query)
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
+
+    @staticmethod
+    def start():
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+
+    def finish(self, response):
+        if 'metrics_start' not in g:
+            return response
+        endpoint = request.endpoint or 'none'
+        REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - g.pop('metrics_start'))
+        REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+        REQUEST_QUERIES.labels(endpoint).observe(g.pop('metrics_queries'))
+        self.export_cache('fragments', current_app.fragment_cache)
+        self.export_cache('identity', current_app.identity_cache)
+        self.export_cache('popups', current_app.popup_cache)
+        return response
+
+    def export_cache(self, name, cache):
+        # the caches keep plain per process totals, only the increase since
+        # the last request is added to the shared counters
+        hits, misses = self._cache_seen.get((id(cache), name), (0, 0))
+        if cache.hits > hits:
+            CACHE_REQUESTS.labels(name, 'hit').inc(cache.hits - hits)
+        if cache.misses > misses:
+            CACHE_REQUESTS.labels(name, 'miss').inc(cache.misses - misses)
+        self._cache_seen[(id(cache), name)] = (cache.hits, cache.misses)
+
+    @staticmethod
+    def metrics():
+        if os.environ.get(MULTIPROCESS_DIR):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -1,15 +1,14 @@
 from datetime import datetime, timedelta
-from hashlib import md5
 from time import time
-from flask import current_app, url_for
+from flask import current_app, has_app_context, has_request_context, session, url_for
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-import jwt
 import json
 import base64
+import math
 import os
-import statistics
 from app import db, login
+from app.avatars import email_digest
+from app.passwords import hash_password, verify_password, needs_rehash
 from app.search import add_to_index, remove_from_index, query_index
 
 
@@ -17,8 +16,13 @@ class PaginatedAPIMixin(object):
     @staticmethod
     def to_collection_dict(query, page, per_page, endpoint, **kwargs):
         resources = query.paginate(page, per_page, False)
+        return PaginatedAPIMixin.pagination_to_dict(resources, endpoint, **kwargs)
+
+    @staticmethod
+    def pagination_to_dict(resources, endpoint, items=None, **kwargs):
+        page, per_page = resources.page, resources.per_page
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': items if items is not None else [item.to_dict() for item in resources.items],
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -75,15 +79,104 @@ db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 
+class VersionedMixin(object):
+    # Row version used to build cheap ETags. Only changes to the attributes
+    # listed in __versioned__ bump it, so e.g. the per-request last_seen
+    # update does not invalidate every page for that user.
+    __versioned__ = []
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    def has_versioned_changes(self):
+        attrs = db.inspect(self).attrs
+        return any(attrs[key].history.has_changes() for key in self.__versioned__)
+
+    def version_parents(self):
+        return []
+
+    def bump_version(self):
+        self.version = (self.version or 0) + 1
+
+    @classmethod
+    def before_flush(cls, session, flush_context, instances):
+        touched = set()
+        for obj in session.dirty:
+            if isinstance(obj, VersionedMixin) and obj.has_versioned_changes():
+                touched.add(obj)
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            parents = getattr(obj, 'version_parents', None)
+            if parents is not None:
+                touched.update(p for p in parents() if p is not None and p not in session.deleted)
+        for obj in touched:
+            if obj not in session.new:
+                obj.bump_version()
+
+db.event.listen(db.session, 'before_flush', VersionedMixin.before_flush)
+
+
 followers = db.Table('followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
-class User(PaginatedAPIMixin, db.Model, UserMixin):
+
+def follow_graph():
+    graph = current_app.follow_graph
+    # a viewer who has just followed or unfollowed someone may land on a
+    # worker whose graph predates that write, it then reloads once
+    written = session.get('follows_written', 0) if has_request_context() else 0
+    if graph.is_stale() or written > graph.loaded_at:
+        graph.load(db.session.query(followers.c.follower_id, followers.c.followed_id))
+    return graph
+
+
+class FollowGraphSync(object):
+    # Follow edges changed by a flush are applied to this process' graph
+    # once the transaction commits.
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        changes = getattr(session, '_follow_changes', None) or {}
+        for obj in list(session.new) + list(session.dirty):
+            if not isinstance(obj, User):
+                continue
+            attrs = db.inspect(obj).attrs
+            for user in attrs.followed.history.added:
+                changes[(obj.id, user.id)] = True
+            for user in attrs.followed.history.deleted:
+                changes[(obj.id, user.id)] = False
+            for user in attrs.followers.history.added:
+                changes[(user.id, obj.id)] = True
+            for user in attrs.followers.history.deleted:
+                changes[(user.id, obj.id)] = False
+        session._follow_changes = changes
+
+    @classmethod
+    def after_commit(cls, session):
+        changes = getattr(session, '_follow_changes', None)
+        session._follow_changes = None
+        graph = current_app.follow_graph
+        if not changes or not graph.is_loaded():
+            return
+        for (follower_id, followed_id), added in changes.items():
+            if added:
+                graph.add(follower_id, followed_id)
+            else:
+                graph.remove(follower_id, followed_id)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session._follow_changes = None
+
+db.event.listen(db.session, 'after_flush', FollowGraphSync.after_flush)
+db.event.listen(db.session, 'after_commit', FollowGraphSync.after_commit)
+db.event.listen(db.session, 'after_rollback', FollowGraphSync.after_rollback)
+
+class User(VersionedMixin, PaginatedAPIMixin, db.Model, UserMixin):
+    __versioned__ = ['username', 'email', 'about', 'followed']
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(128), index=True, unique=True)
+    avatar_hash = db.Column(db.String(32), index=True)
     password_hash = db.Column(db.String(128))
     about = db.Column(db.String(200))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
@@ -103,33 +196,61 @@ class User(PaginatedAPIMixin, db.Model, UserMixin):
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
     ratings = db.relationship('Rating', backref='author', lazy='dynamic')
 
+    def version_parents(self):
+        # following someone changes the counts shown for both users
+        history = db.inspect(self).attrs.followed.history
+        return list(history.added) + list(history.deleted)
+
+    @db.validates('email')
+    def update_avatar_hash(self, key, email):
+        self.avatar_hash = email_digest(email) if email else None
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/%s?d=identicon&s=%s' %(digest, size)
+        return avatar_url(self.avatar_hash, size)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not verify_password(self.id, self.password_hash, password):
+            return False
+        if needs_rehash(self.password_hash):
+            # hashed with older parameters, the caller commits the new hash
+            self.set_password(password)
+        return True
 
     def follow(self, user):
-        if not self.is_following(user):
+        # writes check the database, the graph may lag behind other workers
+        if not self.follows_in_db(user):
             self.followed.append(user)
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self.follows_in_db(user):
             self.followed.remove(user)
 
-    def is_following(self, user):
+    def follows_in_db(self, user):
         return self.followed.filter(followers.c.followed_id == user.id).count() > 0
 
+    def is_following(self, user):
+        return follow_graph().is_following(self.id, user.id)
+
+    def is_mutual(self, user):
+        return follow_graph().is_mutual(self.id, user.id)
+
+    def follower_count(self):
+        return follow_graph().follower_count(self.id)
+
+    def followed_count(self):
+        return follow_graph().followed_count(self.id)
+
     def followed_books(self):
         followed = Book.query.join(followers, (followers.c.followed_id == Book.user_id)).filter(followers.c.follower_id == self.id)
         own = Book.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Book.time.desc())
 
     def get_reset_password_token(self, expires_in=600):
+        import jwt
         return jwt.encode(
             {
                 'reset_password' : self.id,
@@ -140,14 +261,11 @@ class User(PaginatedAPIMixin, db.Model, UserMixin):
 
     def new_messages(self):
         last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
+        return Message.query.filter_by(recipient_id=self.id).filter(
             Message.time > last_read_time).count()
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        Notification.upsert(self.id, name, data)
 
     def to_dict(self, include_email=False):
         data = {
@@ -156,8 +274,8 @@ class User(PaginatedAPIMixin, db.Model, UserMixin):
             'last_seen': self.last_seen.isoformat() + 'Z',
             'about': self.about,
             'book_count': self.books.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
+            'follower_count': self.follower_count(),
+            'followed_count': self.followed_count(),
             '_links': {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
@@ -190,6 +308,7 @@ class User(PaginatedAPIMixin, db.Model, UserMixin):
 
     @staticmethod
     def verify_reset_password_token(token):
+        import jwt
         try:
             id = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])['reset_password']
         except:
@@ -207,13 +326,102 @@ class User(PaginatedAPIMixin, db.Model, UserMixin):
         return user
 
 
+def avatar_url(digest, size):
+    return url_for('main.avatar', digest=digest or email_digest(''), s=size)
+
+
+class UserSnapshot(UserMixin):
+    """The parts of the logged in user that most requests need, kept in the
+    identity cache so that they don't query the user table. Anything else
+    loads the User row, at most once per request; use get_user() where a
+    User instance is needed, e.g. for relationships."""
+
+    def __init__(self, fields):
+        self.__dict__.update(fields, _user=None)
+
+    @staticmethod
+    def fields(user):
+        return {'id': user.id, 'username': user.username, 'avatar_hash': user.avatar_hash,
+                'version': user.version, 'last_seen': user.last_seen,
+                'last_message_read_time': user.last_message_read_time}
+
+    def get_user(self):
+        if self._user is None:
+            self.__dict__['_user'] = User.query.get(self.id)
+        return self._user
+
+    def avatar(self, size):
+        return avatar_url(self.avatar_hash, size)
+
+    # these only need the id and the snapshot fields
+    is_following = User.is_following
+    is_mutual = User.is_mutual
+    follower_count = User.follower_count
+    followed_count = User.followed_count
+    followed_books = User.followed_books
+    new_messages = User.new_messages
+
+    def __getattr__(self, name):
+        return getattr(self.get_user(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_user(), name, value)
+        if name in self.__dict__:
+            self.__dict__[name] = value
+
+    def __repr__(self):
+        return 'User %s' % self.username
+
+
+class IdentitySync(object):
+    # drops the cached snapshot and popup of users changed in a committed
+    # transaction: profile edits, passwords, tokens, last_seen and versions
+    @staticmethod
+    def after_flush(session, flush_context):
+        ids = session.info.setdefault('identity_changes', set())
+        usernames = session.info.setdefault('popup_changes', set())
+        for obj in list(session.dirty) + list(session.deleted):
+            if isinstance(obj, User):
+                ids.add(obj.id)
+                # the old name too, when the user was renamed
+                usernames.update(db.inspect(obj).attrs.username.history.sum())
+
+    @staticmethod
+    def after_commit(session):
+        ids = session.info.pop('identity_changes', ())
+        usernames = session.info.pop('popup_changes', ())
+        if has_app_context():
+            for id in ids:
+                current_app.identity_cache.invalidate(id)
+            for username in usernames:
+                current_app.popup_cache.invalidate(username)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('identity_changes', None)
+        session.info.pop('popup_changes', None)
+
+db.event.listen(db.session, 'after_flush', IdentitySync.after_flush)
+db.event.listen(db.session, 'after_commit', IdentitySync.after_commit)
+db.event.listen(db.session, 'after_rollback', IdentitySync.after_rollback)
+
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    id = int(id)
+    fields = current_app.identity_cache.get(id)
+    if fields is None:
+        user = User.query.get(id)
+        if user is None:
+            return None
+        fields = UserSnapshot.fields(user)
+        current_app.identity_cache.set(id, fields)
+    return UserSnapshot(fields)
 
 
-class Book(SearchableMixin, db.Model):
+class Book(VersionedMixin, PaginatedAPIMixin, SearchableMixin, db.Model):
     __searchable__ = ['title']
+    __versioned__ = ['isbn', 'title', 'description', 'author', 'language']
     id = db.Column(db.Integer, primary_key=True)
     isbn = db.Column(db.String(15), index=True)
     title = db.Column(db.String(450))
@@ -224,10 +432,52 @@ class Book(SearchableMixin, db.Model):
     language = db.Column(db.String(5))
     comments = db.relationship('Comment', backref='book', lazy='dynamic')
     ratings = db.relationship('Rating', backref='book', lazy='dynamic')
+    stats = db.relationship('BookStats', backref='book', uselist=False)
+    __table_args__ = (db.Index('ix_book_user_id_time', 'user_id', 'time'),)
+
+    def version_parents(self):
+        return [self.poster]
 
-    def return_average(self):
-        average = statistics.mean([int(str(i)) for i in self.ratings.all()]) if self.ratings.all() else 0
-        return average
+    def also_liked(self, limit):
+        ids = current_app.recommendations.similar(self.id, limit)
+        if not ids:
+            return []
+        books = {book.id: book for book in Book.query.filter(Book.id.in_(ids))}
+        return [books[id] for id in ids if id in books]
+
+    @staticmethod
+    def comment_counts(ids):
+        counts = db.session.query(Comment.book_id, db.func.count(Comment.id)).filter(
+            Comment.book_id.in_(ids)).group_by(Comment.book_id)
+        return dict(counts)
+
+    def to_dict(self, comment_count=0, fields=None):
+        stats = self.stats
+        data = {
+            'id': self.id,
+            'isbn': self.isbn,
+            'title': self.title,
+            'author': self.author,
+            'description': self.description,
+            'language': self.language,
+            'time': self.time.isoformat() + 'Z' if self.time else None,
+            'rating_count': stats.rating_count if stats else 0,
+            'rating_average': self.average_rating(),
+            'comment_count': comment_count,
+            '_links': {
+                'self': url_for('api.get_book', id=self.id),
+                'poster': url_for('api.get_user', id=self.user_id) if self.user_id else None,
+                'page': url_for('main.book', id=self.id)
+            }
+        }
+        if fields:
+            data = {key: value for key, value in data.items() if key in fields or key == 'id'}
+        return data
+
+    def average_rating(self):
+        # from the counters in book_stats, not from the rating rows
+        stats = self.stats
+        return stats.rating_sum / stats.rating_count if stats and stats.rating_count else 0
 
     def __repr__(self):
         return '<Book %s>' % self.title
@@ -238,22 +488,162 @@ class Message(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     body = db.Column(db.String(400))
     time = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'))
+    __table_args__ = (
+        db.Index('ix_message_recipient_id_time', 'recipient_id', 'time'),
+        db.Index('ix_message_conversation_id_time', 'conversation_id', 'time'),
+    )
 
     def __repr__(self):
         return 'Message %s' % self.body
 
+
+class Conversation(db.Model):
+    # Summary of the messages between two users, user1_id < user2_id, kept
+    # up to date by send(), so the inbox never reads the message table.
+    id = db.Column(db.Integer, primary_key=True)
+    user1_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user2_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id', use_alter=True,
+                                                          name='fk_conversation_last_message_id'))
+    last_time = db.Column(db.DateTime)
+    unread1 = db.Column(db.Integer, nullable=False, default=0)
+    unread2 = db.Column(db.Integer, nullable=False, default=0)
+    messages = db.relationship('Message', foreign_keys=[Message.conversation_id], backref='conversation',
+                               lazy='dynamic')
+    last_message = db.relationship('Message', foreign_keys=[last_message_id], post_update=True)
+    __table_args__ = (
+        db.Index('ix_conversation_user1_id_user2_id', 'user1_id', 'user2_id', unique=True),
+        db.Index('ix_conversation_user1_id_last_time', 'user1_id', 'last_time'),
+        db.Index('ix_conversation_user2_id_last_time', 'user2_id', 'last_time'),
+    )
+
+    def other_id(self, user_id):
+        return self.user2_id if user_id == self.user1_id else self.user1_id
+
+    def unread(self, user_id):
+        return self.unread1 if user_id == self.user1_id else self.unread2
+
+    def mark_read(self, user_id):
+        if self.unread(user_id):
+            if user_id == self.user1_id:
+                self.unread1 = 0
+            else:
+                self.unread2 = 0
+
+    @staticmethod
+    def find(user_id, other_id):
+        user1_id, user2_id = sorted((user_id, other_id))
+        return Conversation.query.filter_by(user1_id=user1_id, user2_id=user2_id)
+
+    @staticmethod
+    def between(user_id, other_id):
+        """The conversation of two users, created on first use. The insert
+        ignores a row created meanwhile by the other user's first message."""
+        user1_id, user2_id = sorted((user_id, other_id))
+        conversation = Conversation.find(user_id, other_id).first()
+        if conversation is None:
+            connection = db.session.connection()
+            statement = Conversation.__table__.insert().prefix_with('OR IGNORE', dialect='sqlite').prefix_with(
+                'IGNORE', dialect='mysql')
+            if connection.dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+                statement = insert(Conversation.__table__).on_conflict_do_nothing()
+            connection.execute(statement, {'user1_id': user1_id, 'user2_id': user2_id, 'unread1': 0, 'unread2': 0})
+            conversation = Conversation.find(user_id, other_id).one()
+        return conversation
+
+    @staticmethod
+    def send(sender, recipient, body):
+        conversation = Conversation.between(sender.id, recipient.id)
+        message = Message(author=sender, recipient=recipient, body=body, time=datetime.utcnow(),
+                          conversation=conversation)
+        db.session.add(message)
+        conversation.last_message = message
+        conversation.last_time = message.time
+        # incremented in SQL, two senders can't lose an update
+        if recipient.id == conversation.user1_id:
+            conversation.unread1 = Conversation.unread1 + 1
+        else:
+            conversation.unread2 = Conversation.unread2 + 1
+        return message
+
+    @staticmethod
+    def inbox(user_id, before=None, limit=20):
+        """The user's conversations, newest first. Each side of the pair has
+        its own index, so this merges two index range reads."""
+        def side(column):
+            query = Conversation.query.filter(column == user_id)
+            if before is not None:
+                query = query.filter(Conversation.last_time < before)
+            return query.order_by(Conversation.last_time.desc()).limit(limit).all()
+        merged = side(Conversation.user1_id) + side(Conversation.user2_id)
+        return sorted(merged, key=lambda c: c.last_time, reverse=True)[:limit]
+
 class Notification(db.Model):
+    # one row per user and name, overwritten by every new event
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     timestamp = db.Column(db.Float, index=True, default=time)
     payload_json = db.Column(db.Text)
+    __table_args__ = (
+        db.Index('ix_notification_user_id_name', 'user_id', 'name', unique=True),
+        db.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+    )
 
     def get_data(self):
         return json.loads(str(self.payload_json))
 
-class Comment(db.Model):
+    @staticmethod
+    def upsert_statement(dialect):
+        table = Notification.__table__
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            statement = insert(table)
+            return statement.on_conflict_do_update(
+                index_elements=['user_id', 'name'],
+                set_={'timestamp': statement.excluded.timestamp, 'payload_json': statement.excluded.payload_json})
+        if dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            statement = insert(table)
+            return statement.on_duplicate_key_update(timestamp=statement.inserted.timestamp,
+                                                     payload_json=statement.inserted.payload_json)
+        return db.text('INSERT INTO notification (user_id, name, timestamp, payload_json) '
+                       'VALUES (:user_id, :name, :timestamp, :payload_json) '
+                       'ON CONFLICT (user_id, name) DO UPDATE SET '
+                       'timestamp = excluded.timestamp, payload_json = excluded.payload_json')
+
+    @staticmethod
+    def upsert(user_id, name, data):
+        """Replace the user's notification called name, inside the current
+        transaction."""
+        # GET /messages writes too, the statement must not go to the replica
+        db.session.info['wrote'] = True
+        connection = db.session.connection()
+        connection.execute(Notification.upsert_statement(connection.dialect.name), {
+            'user_id': user_id, 'name': name, 'timestamp': time(), 'payload_json': json.dumps(data)})
+
+    @staticmethod
+    def purge(max_age, batch_size=10000):
+        """Delete notifications older than max_age seconds, a batch per
+        transaction so that writers are never blocked for long. Returns the
+        number of rows deleted."""
+        table = Notification.__table__
+        cutoff = time() - max_age
+        deleted = 0
+        while True:
+            ids = [id for id, in db.session.execute(db.select([table.c.id]).where(
+                table.c.timestamp < cutoff).limit(batch_size))]
+            if not ids:
+                return deleted
+            db.session.execute(table.delete().where(table.c.id.in_(ids)))
+            db.session.commit()
+            deleted += len(ids)
+
+class Comment(VersionedMixin, db.Model):
     _N = 6
+    __versioned__ = ['body', 'language']
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(400))
@@ -264,6 +654,10 @@ class Comment(db.Model):
     parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
     replies = db.relationship('Comment', backref=db.backref('parent', remote_side=[id]), lazy='dynamic')
     path = db.Column(db.Text, index=True)
+    __table_args__ = (
+        db.Index('ix_comment_book_id_time', 'book_id', 'time'),
+        db.Index('ix_comment_parent_id', 'parent_id'),
+    )
 
     def save(self):
         db.session.add(self)
@@ -272,6 +666,16 @@ class Comment(db.Model):
         self.path = prefix + '{:0{}d}'.format(self.id, self._N)
         db.session.commit()
 
+    def version_parents(self):
+        # the comment count of a book and the reply count of a comment
+        return [self.book, self.parent]
+
+    def root_book_id(self):
+        comment = self
+        while comment.book_id is None and comment.parent is not None:
+            comment = comment.parent
+        return comment.book_id
+
     def level(self):
         return len(self.path) // self._N - 1
 
@@ -293,10 +697,165 @@ class Comment(db.Model):
         return 'Comment %s' %(self.body)
 
 class Rating(db.Model):
+    MIN_SCORE = 1
+    MAX_SCORE = 5
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     book_id = db.Column(db.Integer, db.ForeignKey('book.id'))
     score = db.Column(db.Integer)
+    __table_args__ = (
+        db.Index('ix_rating_user_id_book_id', 'user_id', 'book_id', unique=True),
+        db.Index('ix_rating_book_id_user_id', 'book_id', 'user_id'),
+    )
+
+    def version_parents(self):
+        return [self.book]
+
+    @staticmethod
+    def upsert_statement(dialect):
+        table = Rating.__table__
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            statement = insert(table)
+            return statement.on_conflict_do_update(
+                index_elements=['user_id', 'book_id'], set_={'score': statement.excluded.score})
+        if dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            statement = insert(table)
+            return statement.on_duplicate_key_update(score=statement.inserted.score)
+        return db.text('INSERT INTO rating (user_id, book_id, score) VALUES (:user_id, :book_id, :score) '
+                       'ON CONFLICT (user_id, book_id) DO UPDATE SET score = excluded.score')
+
+    @staticmethod
+    def upsert(user_id, scores):
+        """Set the user's score for every {book_id: score} in one statement,
+        inside the current transaction. Returns the ids of the books whose
+        score changed."""
+        if not scores:
+            return []
+        table = Rating.__table__
+        connection = db.session.connection()
+        old = dict(connection.execute(db.select([table.c.book_id, table.c.score]).where(
+            table.c.user_id == user_id).where(table.c.book_id.in_(list(scores)))).fetchall())
+        connection.execute(Rating.upsert_statement(connection.dialect.name), [
+            {'user_id': user_id, 'book_id': book_id, 'score': score} for book_id, score in scores.items()])
+        changed = [book_id for book_id, score in scores.items() if old.get(book_id) != score]
+        if changed:
+            BookStats.recount(connection, changed)
+            weight = current_app.config['TRENDING_RATING_WEIGHT']
+            BookStats.apply(connection, events={book_id: weight for book_id in changed})
+            connection.execute(Book.__table__.update().where(Book.id.in_(changed)).values(
+                version=Book.__table__.c.version + 1))
+        return changed
 
     def __repr__(self):
         return '%d' %(self.score)
+
+
+class BookStats(db.Model):
+    # Leaderboard scores, maintained incrementally on every flush that
+    # touches a book, a rating or a comment.
+    TRENDING_EPOCH = 1577836800.0
+
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    top_score = db.Column(db.Float, index=True, nullable=False, default=0)
+    trending_score = db.Column(db.Float, index=True, nullable=False, default=0)
+
+    @staticmethod
+    def trending_weight(weight, when):
+        # log2 of an exponentially decayed weight, measured in half-lives
+        # since a fixed epoch, so stored scores never need to be decayed
+        half_life = current_app.config['TRENDING_HALF_LIFE']
+        return (when - BookStats.TRENDING_EPOCH) / half_life + math.log2(weight)
+
+    @staticmethod
+    def add_log2(a, b):
+        high, low = max(a, b), min(a, b)
+        return high + math.log2(1 + 2 ** (low - high))
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        config = current_app.config
+        books, ratings, events = set(), {}, {}
+
+        def rated(book_id, count, total):
+            old_count, old_total = ratings.get(book_id, (0, 0))
+            ratings[book_id] = (old_count + count, old_total + total)
+
+        def happened(book_id, weight):
+            events[book_id] = events.get(book_id, 0) + weight
+
+        for obj in session.new:
+            if isinstance(obj, Book):
+                books.add(obj.id)
+            elif isinstance(obj, Rating) and obj.book_id and obj.score is not None:
+                rated(obj.book_id, 1, obj.score)
+                happened(obj.book_id, config['TRENDING_RATING_WEIGHT'])
+            elif isinstance(obj, Comment):
+                book_id = obj.root_book_id()
+                if book_id:
+                    happened(book_id, config['TRENDING_COMMENT_WEIGHT'])
+        for obj in session.dirty:
+            if isinstance(obj, Rating) and obj.book_id:
+                history = db.inspect(obj).attrs.score.history
+                if history.has_changes():
+                    rated(obj.book_id, 0, sum(history.added or [0]) - sum(history.deleted or [0]))
+                    happened(obj.book_id, config['TRENDING_RATING_WEIGHT'])
+        for obj in session.deleted:
+            if isinstance(obj, Rating) and obj.book_id and obj.score is not None:
+                rated(obj.book_id, -1, -obj.score)
+        if books or ratings or events:
+            cls.apply(session.connection(), books, ratings, events)
+
+    @classmethod
+    def apply(cls, connection, books=(), ratings=None, events=None):
+        config = current_app.config
+        ratings, events = ratings or {}, events or {}
+        table = cls.__table__
+        prior_count = config['LEADERBOARD_PRIOR_COUNT']
+        prior_total = float(prior_count * config['LEADERBOARD_PRIOR_MEAN'])
+        for book_id in set(books) | set(ratings) | set(events):
+            row = connection.execute(
+                db.select([table.c.trending_score]).where(table.c.book_id == book_id)).first()
+            if row is None:
+                connection.execute(table.insert().values(
+                    book_id=book_id, rating_count=0, rating_sum=0, trending_score=0,
+                    top_score=config['LEADERBOARD_PRIOR_MEAN']))
+            values = {}
+            if book_id in ratings:
+                # counters are updated in SQL so concurrent writers don't lose votes
+                count, total = ratings[book_id]
+                values['rating_count'] = table.c.rating_count + count
+                values['rating_sum'] = table.c.rating_sum + total
+                values['top_score'] = (prior_total + table.c.rating_sum + total) / \
+                    (prior_count + table.c.rating_count + count)
+            if book_id in events:
+                current = row[0] if row is not None else 0
+                values['trending_score'] = cls.add_log2(current, cls.trending_weight(events[book_id], time()))
+            if values:
+                connection.execute(table.update().where(table.c.book_id == book_id).values(**values))
+
+    @classmethod
+    def recount(cls, connection, book_ids):
+        # absolute recount, safe when concurrent writers raced on the same rows
+        table = cls.__table__
+        config = current_app.config
+        prior_count = config['LEADERBOARD_PRIOR_COUNT']
+        prior_total = float(prior_count * config['LEADERBOARD_PRIOR_MEAN'])
+        count = db.select([db.func.count(Rating.id)]).where(Rating.book_id == table.c.book_id).as_scalar()
+        total = db.select([db.func.coalesce(db.func.sum(Rating.score), 0)]).where(
+            Rating.book_id == table.c.book_id).as_scalar()
+        connection.execute(table.update().where(table.c.book_id.in_(book_ids)).values(
+            rating_count=count, rating_sum=total, top_score=(prior_total + total) / (prior_count + count)))
+
+db.event.listen(db.session, 'after_flush', BookStats.after_flush)
+
+
+class ImportProgress(db.Model):
+    # how far an import of a file got, committed with each of its batches
+    path = db.Column(db.String(255), primary_key=True)
+    records = db.Column(db.Integer, nullable=False, default=0)
+    first_id = db.Column(db.Integer)
@@ -0,0 +1,81 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashPool(object):
+    """Runs the password KDF for one worker in a pool of processes.
+
+    At most `queue` hashes wait or run at a time, a request that cannot get
+    a slot within `timeout` seconds gets a 503, and at most `per_user`
+    checks for the same account run at once, others get a 429. With no
+    workers the hash runs inline, with the same limits.
+    """
+
+    def __init__(self, workers, queue, per_user, timeout):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(queue)
+        self.per_user = per_user
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.running = {}
+        self.executor = None
+
+    def reset(self):
+        # the processes of the master can't be used from a forked worker
+        with self.lock:
+            self.executor = None
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def submit(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.workers)
+            executor = self.executor
+        return executor.submit(func, *args).result()
+
+    def run(self, user, func, *args):
+        if user is not None:
+            with self.lock:
+                if self.running.get(user, 0) >= self.per_user:
+                    raise TooManyRequests(retry_after=1)
+                self.running[user] = self.running.get(user, 0) + 1
+        try:
+            if not self.slots.acquire(timeout=self.timeout):
+                raise ServiceUnavailable(retry_after=1)
+            try:
+                return self.submit(func, *args)
+            finally:
+                self.slots.release()
+        finally:
+            if user is not None:
+                with self.lock:
+                    self.running[user] -= 1
+                    if not self.running[user]:
+                        del self.running[user]
+
+
+def hash_password(password):
+    config = current_app.config
+    return current_app.password_pool.run(None, generate_password_hash, password,
+                                         config['PASSWORD_HASH_METHOD'], config['PASSWORD_SALT_LENGTH'])
+
+
+def verify_password(user, password_hash, password):
+    if not password_hash:
+        return False
+    return current_app.password_pool.run(user, check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    # the method part of the hash holds the algorithm and its iterations
+    return password_hash.split('$', 1)[0] != current_app.config['PASSWORD_HASH_METHOD']
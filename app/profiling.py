@@ -0,0 +1,96 @@
+import heapq
+import json
+import random
+import time
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and g.get('sql_profile') is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_app_context() or g.get('sql_profile') is None or not conn.info.get('query_start'):
+        return
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    g.sql_profile.add(elapsed, statement)
+
+
+def handle_error(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+class RequestProfile(object):
+    def __init__(self, keep):
+        self.start = time.perf_counter()
+        self.keep = keep
+        self.count = 0
+        self.db_time = 0.0
+        self.slowest = []
+
+    def add(self, elapsed, statement):
+        self.count += 1
+        self.db_time += elapsed
+        # a bounded min-heap, so the slowest statements survive
+        entry = (elapsed, self.count, statement)
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, entry)
+        elif elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def server_timing(self, total):
+        return 'db;dur=%.1f;desc="%d queries", app;dur=%.1f' % (self.db_time * 1000, self.count, total * 1000)
+
+    def log_record(self, response, total):
+        return {
+            'event': 'slow_request',
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round(total * 1000, 1),
+            'db_ms': round(self.db_time * 1000, 1),
+            'queries': self.count,
+            'slowest': [{'ms': round(elapsed * 1000, 1), 'statement': ' '.join(statement.split())}
+                        for elapsed, _, statement in sorted(self.slowest, reverse=True)],
+        }
+
+
+class SQLProfiler(object):
+    """Opt-in per request SQL profile: query count, time spent in the
+    database and the slowest statements, sent back in a Server-Timing header
+    and logged as JSON for requests slower than SLOW_REQUEST_SECONDS.
+
+    SQL_PROFILING_SAMPLE_RATE profiles only a fraction of the requests; the
+    others pay for one dictionary lookup per query.
+    """
+
+    def init_app(self, app):
+        if not app.config['SQL_PROFILING']:
+            return
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_error)
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    @staticmethod
+    def start():
+        if random.random() < current_app.config['SQL_PROFILING_SAMPLE_RATE']:
+            g.sql_profile = RequestProfile(current_app.config['SQL_PROFILING_SLOWEST'])
+
+    @staticmethod
+    def finish(response):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.start
+        response.headers.add('Server-Timing', profile.server_timing(total))
+        if total >= current_app.config['SLOW_REQUEST_SECONDS']:
+            current_app.logger.warning(json.dumps(profile.log_record(response, total)))
+        return response
@@ -0,0 +1,146 @@
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from flask import current_app, g, request, session
+from app.metrics import REJECTED
+
+
+def per_page_cost():
+    # a page of 100 users costs as much as ten of the default size
+    return min(request.args.get('per_page', 10, type=int), 100) / 10.0
+
+
+COSTS = {
+    'api.get_users': per_page_cost,
+    'api.get_followers': per_page_cost,
+    'api.get_followed': per_page_cost,
+}
+# buckets untouched for this long are full again and can be dropped
+PURGE_AFTER = 3600
+
+
+class Buckets(object):
+    """Token buckets kept in a sqlite file, so that every gunicorn worker
+    on the host draws from the same budgets. Each thread (or greenlet) of a
+    worker opens its own connection."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        # connections must not cross a fork
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def take(self, buckets, cost, now=None):
+        """Take cost tokens from every (key, rate, burst) bucket, or from none
+        of them. Returns 0 when admitted, otherwise the seconds to wait."""
+        now = time.time() if now is None else now
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            levels, wait = [], 0.0
+            for key, rate, burst in buckets:
+                row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                levels.append((key, tokens))
+                if tokens < cost:
+                    wait = max(wait, (cost - tokens) / rate)
+            connection.executemany('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                                   [(key, tokens if wait else tokens - cost, now) for key, tokens in levels])
+            if random.random() < 0.001:
+                connection.execute('DELETE FROM bucket WHERE updated < ?', (now - PURGE_AFTER,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+def client_key():
+    # who is asking, without loading the user from the database. Only the
+    # signed session cookie is trusted here: API credentials aren't checked
+    # yet, and made up ones would each get a fresh budget
+    if '_user_id' in session:
+        return 'user:' + session['_user_id']
+    return 'ip:' + request.headers.get('X-Real-IP', request.remote_addr or '')
+
+
+def queue_seconds():
+    # nginx stamps X-Request-Start with t=<epoch seconds> when it accepts the
+    # request; the difference is the time spent waiting for a free worker
+    value = request.headers.get('X-Request-Start', '')
+    try:
+        return time.time() - float(value[2:] if value.startswith('t=') else value)
+    except ValueError:
+        return 0.0
+
+
+class Admission(object):
+    """Admission control, run before any other request hook so that rejected
+    requests never reach the database.
+
+    The endpoints in RATE_LIMITS get a token bucket per client and one for
+    the endpoint as a whole, and are answered with 429 when either is empty.
+    Any request is shed with 503 when it waited in the listen queue longer
+    than SHED_MAX_QUEUE_SECONDS, or when the worker already serves
+    SHED_MAX_INFLIGHT requests (which matters for the gevent workers).
+    """
+
+    def __init__(self):
+        self.inflight = 0
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        app.rate_buckets = Buckets(app.config['RATE_LIMIT_DB']) if app.config['RATE_LIMIT_DB'] else None
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def admit(self):
+        if request.endpoint in (None, 'static', 'metrics'):
+            return
+        config = current_app.config
+        if config['SHED_MAX_QUEUE_SECONDS'] and queue_seconds() > config['SHED_MAX_QUEUE_SECONDS']:
+            return self.reject(503, 'queue', config['SHED_RETRY_AFTER'])
+        limits = config['RATE_LIMITS'].get(request.endpoint)
+        if limits and current_app.rate_buckets is not None:
+            key = client_key()
+            cost = COSTS[request.endpoint]() if request.endpoint in COSTS else 1
+            wait = current_app.rate_buckets.take([('%s:%s' % (request.endpoint, key),) + limits['client'],
+                                      (request.endpoint,) + limits['endpoint']], cost)
+            if wait:
+                return self.reject(429, 'rate', wait)
+        with self.lock:
+            if config['SHED_MAX_INFLIGHT'] and self.inflight >= config['SHED_MAX_INFLIGHT']:
+                return self.reject(503, 'inflight', config['SHED_RETRY_AFTER'])
+            self.inflight += 1
+        g.admitted = True
+
+    def release(self, exc):
+        if g.pop('admitted', False):
+            with self.lock:
+                self.inflight -= 1
+
+    @staticmethod
+    def reject(status, reason, retry_after):
+        from app.api.errors import error_response
+        from app.errors.handlers import wants_json_response
+        REJECTED.labels(request.endpoint, reason).inc()
+        message = 'Too many requests' if status == 429 else 'The server is busy'
+        if request.blueprint == 'api' or wants_json_response():
+            response = error_response(status, message)
+        else:
+            response = current_app.response_class(message, status, mimetype='text/plain')
+        response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+        return response
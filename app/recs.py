@@ -0,0 +1,149 @@
+import os
+from array import array
+import numpy as np
+from scipy import sparse
+from app import db
+from app.models import Book, Rating
+
+CHUNK = 512
+
+
+def table_dtype(k):
+    return np.dtype([('version', 'i4'), ('neighbors', 'i4', (k,)), ('scores', 'f4', (k,))])
+
+
+def ratings_matrix(user_ids, book_ids, scores, n_books):
+    """Users x books matrix with L2 normalized columns, so that the dot
+    product of two columns is the cosine similarity of two books."""
+    n_users = int(user_ids.max()) + 1 if len(user_ids) else 0
+    matrix = sparse.csc_matrix((scores.astype(np.float32), (user_ids, book_ids)),
+                               shape=(n_users, n_books))
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))).ravel()
+    norms[norms == 0] = 1
+    return (matrix @ sparse.diags(1 / norms).astype(np.float32)).tocsc()
+
+
+def top_k(matrix, books, k):
+    """Top k most similar books for each of the given books."""
+    neighbors = np.full((len(books), k), -1, dtype=np.int32)
+    scores = np.zeros((len(books), k), dtype=np.float32)
+    by_book = matrix.T.tocsr()
+    for start in range(0, len(books), CHUNK):
+        chunk = books[start:start + CHUNK]
+        similar = (by_book[chunk] @ matrix).tocsr()
+        for i, book in enumerate(chunk):
+            lo, hi = similar.indptr[i], similar.indptr[i + 1]
+            ids, values = similar.indices[lo:hi], similar.data[lo:hi]
+            keep = ids != book
+            ids, values = ids[keep], values[keep]
+            if len(values) > k:
+                best = np.argpartition(-values, k)[:k]
+                ids, values = ids[best], values[best]
+            order = np.argsort(-values, kind='stable')
+            neighbors[start + i, :len(order)] = ids[order]
+            scores[start + i, :len(order)] = values[order]
+    return neighbors, scores
+
+
+def load_ratings():
+    user_ids, book_ids, scores = array('i'), array('i'), array('f')
+    query = db.session.query(Rating.user_id, Rating.book_id, Rating.score).filter(
+        Rating.user_id.isnot(None), Rating.book_id.isnot(None), Rating.score.isnot(None))
+    for user_id, book_id, score in query.yield_per(50000):
+        user_ids.append(user_id)
+        book_ids.append(book_id)
+        scores.append(score)
+    return (np.frombuffer(user_ids, dtype=np.int32), np.frombuffer(book_ids, dtype=np.int32),
+            np.frombuffer(scores, dtype=np.float32))
+
+
+def load_versions():
+    rows = db.session.query(Book.id, Book.version).all()
+    n_books = max([id for id, _ in rows], default=0) + 1
+    versions = np.zeros(n_books, dtype=np.int32)
+    for id, version in rows:
+        versions[id] = version
+    return versions
+
+
+def save_table(path, table):
+    # workers memory map the file, so it is replaced atomically
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, table)
+    os.replace(tmp, path)
+
+
+def build(path, k):
+    """Compute the top k neighbours of every book and write them to path."""
+    versions = load_versions()
+    user_ids, book_ids, scores = load_ratings()
+    n_books = max(len(versions), int(book_ids.max()) + 1 if len(book_ids) else 0)
+    matrix = ratings_matrix(user_ids, book_ids, scores, n_books)
+    table = np.zeros(n_books, dtype=table_dtype(k))
+    table['version'][:len(versions)] = versions
+    table['neighbors'] = -1
+    rated = np.unique(book_ids)
+    table['neighbors'][rated], table['scores'][rated] = top_k(matrix, rated, k)
+    save_table(path, table)
+    return len(rated)
+
+
+def refresh(path, k):
+    """Recompute only the books whose version changed since the last build,
+    together with every book that shares a reader with one of them."""
+    if not os.path.exists(path):
+        return build(path, k)
+    old = np.load(path)
+    if old.dtype != table_dtype(k):
+        return build(path, k)
+    versions = load_versions()
+    n_books = max(len(versions), len(old))
+    table = np.zeros(n_books, dtype=old.dtype)
+    table['neighbors'] = -1
+    table[:len(old)] = old
+    known = np.zeros(n_books, dtype=np.int32)
+    known[:len(old)] = old['version']
+    current = np.zeros(n_books, dtype=np.int32)
+    current[:len(versions)] = versions
+    changed = np.nonzero(known != current)[0]
+    if not len(changed):
+        return 0
+    user_ids, book_ids, scores = load_ratings()
+    n_books = max(n_books, int(book_ids.max()) + 1 if len(book_ids) else 0)
+    if n_books > len(table):
+        return build(path, k)
+    matrix = ratings_matrix(user_ids, book_ids, scores, n_books)
+    readers = np.unique(matrix[:, changed].nonzero()[0])
+    affected = np.union1d(changed, np.unique(matrix[readers].nonzero()[1])).astype(np.int32)
+    table['neighbors'][affected], table['scores'][affected] = top_k(matrix, affected, k)
+    table['version'] = current
+    save_table(path, table)
+    return len(affected)
+
+
+class Recommendations(object):
+    """Read side of the recommendation table, memory mapped per worker and
+    reopened whenever the builder replaces the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._table = None
+        self._mtime = None
+
+    def table(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            self._table = np.load(self.path, mmap_mode='r')
+            self._mtime = mtime
+        return self._table
+
+    def similar(self, book_id, limit):
+        table = self.table()
+        if table is None or book_id >= len(table):
+            return []
+        row = table[book_id]
+        return [int(id) for id in row['neighbors'][:limit] if id >= 0]
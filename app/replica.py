@@ -0,0 +1,60 @@
+from time import time
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# queue pool arguments, which the sqlite pools do not accept
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+def reads_from_replica(db_session):
+    """Reads of a GET request go to the replica, unless this request or one
+    from the same browser in the last REPLICA_STICKY_SECONDS wrote something,
+    so users always see their own writes."""
+    if not has_request_context() or request.method not in READ_METHODS:
+        return False
+    if 'replica' not in (current_app.config['SQLALCHEMY_BINDS'] or {}):
+        return False
+    return not db_session.info.get('wrote') and session.get('_primary_until', 0) < time()
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and reads_from_replica(self):
+            return get_state(self.app).db.get_engine(self.app, bind='replica')
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    @staticmethod
+    def after_flush(db_session, flush_context):
+        db_session.info['wrote'] = True
+
+    @staticmethod
+    def after_commit(db_session):
+        # Core statements (e.g. Rating.upsert) do not flush, so every commit
+        # of a write request counts as a write too
+        if not has_request_context():
+            return
+        if db_session.info.get('wrote') or request.method not in READ_METHODS:
+            session['_primary_until'] = time() + current_app.config['REPLICA_STICKY_SECONDS']
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with an optional read replica, configured as the
+    'replica' bind, and pool options that are safe to share with sqlite."""
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'after_flush', RoutingSession.after_flush)
+        event.listen(factory, 'after_commit', RoutingSession.after_commit)
+        return factory
+
+    def create_engine(self, sa_url, engine_opts):
+        if sa_url.drivername.startswith('sqlite'):
+            engine_opts = {key: value for key, value in engine_opts.items() if key not in QUEUE_POOL_OPTIONS}
+        engine = super(RoutingSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        config = self.get_app().config
+        if sa_url.drivername.startswith('sqlite') and (config['SQLITE_WAL'] or config['SQLITE_SERIALIZE_WRITES']):
+            from app.sqlite import tune_engine
+            tune_engine(engine, config)
+        return engine
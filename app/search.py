@@ -1,4 +1,5 @@
 from flask import current_app
+from app.metrics import outbound
 
 def add_to_index(index, model):
     if not current_app.elasticsearch:
@@ -6,19 +7,34 @@ def add_to_index(index, model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    with outbound('elasticsearch', 'index'):
+        current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+
+def add_to_index_bulk(index, models):
+    if not current_app.elasticsearch:
+        return
+    from elasticsearch.helpers import bulk
+    actions = ({
+        '_index': index,
+        '_id': model.id,
+        '_source': {field: getattr(model, field) for field in model.__searchable__}
+    } for model in models)
+    with outbound('elasticsearch', 'bulk'):
+        bulk(current_app.elasticsearch.get(), actions, chunk_size=1000)
 
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    with outbound('elasticsearch', 'delete'):
+        current_app.elasticsearch.delete(index=index, id=model.id)
 
 def query_index(index, query, page, per_page):
     if not current_app.elasticsearch:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
+    with outbound('elasticsearch', 'search'):
+        search = current_app.elasticsearch.search(
+            index=index,
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page})
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     return ids, search['hits']['total']['value']
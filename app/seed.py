@@ -0,0 +1,201 @@
+import random
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import accumulate
+from flask import current_app
+from flask_sqlalchemy import get_debug_queries
+from werkzeug.security import generate_password_hash
+from app import db
+from app.avatars import email_digest
+from app.models import User, Book, BookStats, Comment, Rating, followers
+
+WORDS = ['night', 'river', 'silent', 'garden', 'empire', 'stranger', 'winter', 'glass', 'kingdom', 'letters',
+         'shadow', 'city', 'ocean', 'memory', 'fire', 'secret', 'summer', 'house', 'road', 'mountain',
+         'orchard', 'clock', 'island', 'forest', 'dream', 'lantern', 'harbor', 'crown', 'storm', 'bridge']
+NAMES = ['Ava', 'Omid', 'Lena', 'Ravi', 'Sara', 'Kai', 'Nora', 'Dario', 'Mina', 'Theo', 'Leila', 'Ivan']
+SPAN = timedelta(days=730)
+EPOCH = datetime(1970, 1, 1)
+
+
+def zipf_weights(n, exponent=1.0):
+    # cumulative weights for rng.choices: a few users and books get most of
+    # the follows, ratings and comments, like on the real site
+    return list(accumulate(1.0 / (rank + 1) ** exponent for rank in range(n)))
+
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def insert(table, rows):
+    if rows:
+        db.session.execute(table.insert(), rows)
+        db.session.commit()
+        del get_debug_queries()[:]
+        del rows[:]
+
+
+def sync_sequences(tables):
+    # ids are assigned here, so postgres sequences have to catch up
+    if db.engine.dialect.name == 'postgresql':
+        for table in tables:
+            db.session.execute("SELECT setval(pg_get_serial_sequence('\"%s\"', 'id'), MAX(id)) FROM \"%s\""
+                               % (table, table))
+        db.session.commit()
+
+
+class Seeder(object):
+    """Synthetic data set for benchmarks: users with a skewed follow graph,
+    books, ratings with a per book quality and threaded comments.
+
+    Rows are written with Core inserts in batches and ids are assigned here,
+    so the generated data is the same for the same seed. The search index is
+    not updated.
+    """
+
+    def __init__(self, seed=42, batch_size=10000, echo=print):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.echo = echo
+        self.now = datetime.utcnow()
+
+    def random_time(self, after=None):
+        start = after or self.now - SPAN
+        return start + (self.now - start) * self.rng.random()
+
+    def users(self, n):
+        first = next_id(User)
+        password_hash = generate_password_hash('password')
+        rows = []
+        for i in range(first, first + n):
+            email = 'user%d@example.com' % i
+            rows.append({'id': i, 'username': 'user%d' % i, 'email': email, 'avatar_hash': email_digest(email),
+                         'password_hash': password_hash, 'about': 'Reader number %d' % i,
+                         'last_seen': self.random_time()})
+            if len(rows) == self.batch_size:
+                insert(User.__table__, rows)
+        insert(User.__table__, rows)
+        self.echo('%d users' % n)
+        return range(first, first + n)
+
+    def follows(self, users, per_user):
+        weights = zipf_weights(len(users))
+        order = list(users)
+        self.rng.shuffle(order)
+        rows, total = [], 0
+        for user in users:
+            count = min(len(users) - 1, int(self.rng.expovariate(1.0 / per_user)))
+            followed = {order[rank] for rank in self.rng.choices(range(len(users)), cum_weights=weights, k=count)}
+            followed.discard(user)
+            for other in followed:
+                rows.append({'follower_id': user, 'followed_id': other})
+            total += len(followed)
+            if len(rows) >= self.batch_size:
+                insert(followers, rows)
+        insert(followers, rows)
+        self.echo('%d follows' % total)
+
+    def books(self, users, n):
+        first = next_id(Book)
+        weights = zipf_weights(len(users))
+        authors = ['%s %s' % (self.rng.choice(NAMES), self.rng.choice(WORDS).title()) for _ in range(max(1, n // 5))]
+        times = array('d')
+        rows = []
+        for i in range(first, first + n):
+            when = self.random_time()
+            times.append((when - EPOCH).total_seconds())
+            title = ' '.join(self.rng.sample(WORDS, self.rng.randint(1, 4))).capitalize()
+            rows.append({'id': i, 'title': title, 'author': self.rng.choice(authors), 'isbn': '%013d' % i,
+                         'description': 'A story of %s and %s.' % tuple(self.rng.sample(WORDS, 2)),
+                         'language': 'en', 'time': when,
+                         'user_id': users[self.rng.choices(range(len(users)), cum_weights=weights)[0]]})
+            if len(rows) == self.batch_size:
+                insert(Book.__table__, rows)
+        insert(Book.__table__, rows)
+        self.echo('%d books' % n)
+        return range(first, first + n), times
+
+    def ratings(self, users, books, n):
+        weights = zipf_weights(len(books))
+        popular = list(books)
+        self.rng.shuffle(popular)
+        quality = array('f', (min(5.0, max(1.0, self.rng.gauss(3.5, 0.7))) for _ in books))
+        counts, sums = array('i', bytes(4 * len(books))), array('i', bytes(4 * len(books)))
+        rows, total = [], 0
+        mean = max(1.0, n / len(users))
+        for user in users:
+            if total >= n:
+                break
+            count = min(len(books), n - total, int(self.rng.expovariate(1.0 / mean)) + 1)
+            rated = {popular[rank] for rank in self.rng.choices(range(len(books)), cum_weights=weights, k=count)}
+            for book in rated:
+                index = book - books[0]
+                score = min(5, max(1, round(quality[index] + self.rng.gauss(0, 1))))
+                rows.append({'user_id': user, 'book_id': book, 'score': score})
+                counts[index] += 1
+                sums[index] += score
+            total += len(rated)
+            if len(rows) >= self.batch_size:
+                insert(Rating.__table__, rows)
+        insert(Rating.__table__, rows)
+        self.echo('%d ratings' % total)
+        return counts, sums
+
+    def comments(self, users, books, times, n):
+        first = next_id(Comment)
+        weights = zipf_weights(len(books))
+        popular = list(books)
+        self.rng.shuffle(popular)
+        per_book = Counter(popular[rank] for rank in self.rng.choices(range(len(books)), cum_weights=weights, k=n))
+        next_comment = first
+        rows = []
+        for book, count in per_book.items():
+            thread = []
+            when = datetime.utcfromtimestamp(times[book - books[0]])
+            for _ in range(count):
+                when = self.random_time(when)
+                id = next_comment
+                next_comment += 1
+                row = {'id': id, 'author_id': self.rng.choice(users), 'time': when, 'language': 'en',
+                       'body': 'I loved the part about the %s.' % self.rng.choice(WORDS)}
+                # replies hang off an earlier comment, like those posted on
+                # the comment page, and carry no book_id
+                if thread and self.rng.random() < 0.4:
+                    parent = self.rng.choice(thread)
+                    row.update(book_id=None, parent_id=parent['id'],
+                               path=parent['path'] + '.' + '{:0{}d}'.format(id, Comment._N))
+                else:
+                    row.update(book_id=book, parent_id=None, path='{:0{}d}'.format(id, Comment._N))
+                thread.append(row)
+                rows.append(row)
+            if len(rows) >= self.batch_size:
+                insert(Comment.__table__, rows)
+        insert(Comment.__table__, rows)
+        self.echo('%d comments' % n)
+        return per_book
+
+    def stats(self, books, times, counts, sums, comment_counts):
+        config = current_app.config
+        prior_count = config['LEADERBOARD_PRIOR_COUNT']
+        prior_total = prior_count * config['LEADERBOARD_PRIOR_MEAN']
+        rows = []
+        for index, book in enumerate(books):
+            # activity is dated at the book's own time, ratings carry no time
+            weight = 1 + counts[index] * config['TRENDING_RATING_WEIGHT'] + \
+                comment_counts.get(book, 0) * config['TRENDING_COMMENT_WEIGHT']
+            rows.append({'book_id': book, 'rating_count': counts[index], 'rating_sum': sums[index],
+                         'top_score': (prior_total + sums[index]) / (prior_count + counts[index]),
+                         'trending_score': BookStats.trending_weight(weight, times[index])})
+            if len(rows) == self.batch_size:
+                insert(BookStats.__table__, rows)
+        insert(BookStats.__table__, rows)
+
+    def run(self, users, books, ratings, comments, follows_per_user):
+        user_ids = self.users(users)
+        self.follows(user_ids, follows_per_user)
+        book_ids, times = self.books(user_ids, books)
+        counts, sums = self.ratings(user_ids, book_ids, ratings)
+        comment_counts = self.comments(user_ids, book_ids, times, comments)
+        self.stats(book_ids, times, counts, sums, comment_counts)
+        sync_sequences(['user', 'book', 'comment'])
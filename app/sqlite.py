@@ -0,0 +1,111 @@
+import fcntl
+import random
+import re
+import sqlite3
+import time
+from functools import wraps
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from app import db
+from app.replica import READ_METHODS
+
+
+WRITE_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.I)
+# seconds between two attempts at the writer file lock
+LOCK_POLL = 0.005
+
+
+def is_locked(error):
+    return 'locked' in str(error.orig)
+
+
+def retry_locked(func):
+    """Run func again, after a rollback and a jittered exponential backoff,
+    when sqlite reports the database as locked."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = current_app.config['SQLITE_LOCK_RETRIES']
+        backoff = current_app.config['SQLITE_LOCK_BACKOFF']
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if attempt == retries or not is_locked(e):
+                    raise
+                db.session.rollback()
+                time.sleep(random.uniform(0, backoff * 2 ** attempt))
+    return wrapper
+
+
+def lock_file(path, timeout):
+    """Take an exclusive flock on path, polling with time.sleep so that a
+    gevent worker keeps serving its other requests while it waits. Raises
+    OperationalError like a busy sqlite after timeout seconds."""
+    lock = open(path, 'a')
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                lock.close()
+                raise OperationalError(None, None, sqlite3.OperationalError('database is locked'))
+            time.sleep(LOCK_POLL)
+
+
+def writes_expected():
+    return not has_request_context() or request.method not in READ_METHODS
+
+
+def tune_engine(engine, config):
+    """Connection settings for serving a sqlite file from several workers.
+
+    With SQLITE_WAL readers no longer block the writer. In requests that
+    may write, statements run in autocommit mode until the first write,
+    which opens the transaction with BEGIN IMMEDIATE, so it waits in
+    busy_timeout for the write lock instead of failing when a read
+    transaction is upgraded. With SQLITE_SERIALIZE_WRITES it also queues on
+    a file lock first, so only one worker at a time holds the write lock.
+    The file lock is polled rather than waited for, flock() would stall
+    every greenlet of a gevent worker, and given up after busy_timeout too.
+    Reads before the first write, like the user lookup of a login and the
+    password check after it, hold neither lock.
+    """
+    lock_path = None
+    if config['SQLITE_SERIALIZE_WRITES'] and engine.url.database not in (None, '', ':memory:'):
+        lock_path = engine.url.database + '.lock'
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        # transactions are begun by begin() below instead of by pysqlite
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        if config['SQLITE_WAL']:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA mmap_size=%d' % config['SQLITE_MMAP_SIZE'])
+        cursor.execute('PRAGMA busy_timeout=%d' % config['SQLITE_BUSY_TIMEOUT'])
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        # reads get one snapshot for the whole request, a write in them
+        # upgrades the transaction
+        if not writes_expected():
+            connection.execute('BEGIN')
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        if connection.connection.connection.in_transaction or not WRITE_STATEMENT.match(statement):
+            return
+        if lock_path and 'writer_lock' not in connection.info:
+            connection.info['writer_lock'] = lock_file(lock_path, config['SQLITE_BUSY_TIMEOUT'] / 1000.0)
+        cursor.execute('BEGIN IMMEDIATE')
+
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        lock = connection_record.info.pop('writer_lock', None)
+        if lock is not None:
+            lock.close()
@@ -0,0 +1,130 @@
+// Page scripts shared by every template. Values that depend on the request
+// (urls, translated strings, the locale) come from the bibliophilia object
+// that base.html defines before loading the bundle.
+
+function translate(sourceElem, destElem, sourceLang, destLang) {
+    $(destElem).html($('<img>').attr('src', bibliophilia.loading));
+    $.post('/translate', {
+        text: $(sourceElem).text(),
+        source_language: sourceLang,
+        dest_language: destLang
+    }).done(function(response) {
+        $(destElem).text(response['text'])
+    }).fail(function() {
+        $(destElem).text(bibliophilia.translate_error);
+    });
+}
+
+function render_popup(data) {
+    var details = $('<small>');
+    if (data.about) {
+        details.append($('<p>').text(data.about));
+    }
+    if (data.last_seen) {
+        details.append($('<p>').text(data.last_seen_label + ': ' + moment(data.last_seen).format('lll')));
+    }
+    details.append($('<p>').text(data.counts));
+    if (data.follow) {
+        var form = $('<form method="post">').attr('action', data.follow.url);
+        form.append($('<input type="hidden" name="csrf_token">').val(data.follow.csrf_token));
+        form.append($('<input type="submit" name="submit" class="btn btn-default btn-sm">').val(data.follow.label));
+        details.append($('<p>').append(form));
+    }
+    var user = $('<td style="border: 0px;">').append(
+        $('<p>').append($('<a>').attr('href', data.url).text(data.username)), details);
+    var avatar = $('<td width="64" style="border: 0px;">').append($('<img>').attr('src', data.avatar));
+    return $('<table class="table">').css('font-family', bibliophilia.popup_font).append(
+        $('<tr>').append(avatar, user));
+}
+
+$(function () {
+    var timer = null;
+    var xhr = null;
+    // popups already fetched on this page, by username
+    var popups = {};
+    function show_popup(elem, data) {
+        elem.popover({
+            trigger: 'manual',
+            html: true,
+            animation: false,
+            container: elem,
+            content: render_popup(data)
+        }).popover('show');
+    }
+    $('.user_popup').hover(
+        function(event) {
+            // mouse in event handler
+            var elem = $(event.currentTarget);
+            var username = elem.first().text().trim();
+            if (popups[username]) {
+                show_popup(elem, popups[username]);
+                return;
+            }
+            timer = setTimeout(function() {
+                timer = null;
+                xhr = $.getJSON('/user/' + encodeURIComponent(username) + '/popup').done(
+                        function(data) {
+                            xhr = null;
+                            popups[username] = data;
+                            show_popup(elem, data);
+                        }
+                    );
+            }, 1000);
+        },
+        function(event) {
+            // mouse out event handler
+            var elem = $(event.currentTarget);
+            if (timer) {
+                clearTimeout(timer);
+                timer = null;
+            }
+            else if (xhr) {
+                xhr.abort();
+                xhr = null;
+            }
+            else {
+                elem.popover('destroy');
+            }
+        }
+    );
+});
+
+function set_message_count(n) {
+    $('#message_count').text(n);
+    $('#message_count').css('visibility', n ? 'visible' : 'hidden');
+}
+
+$(function() {
+    if (!bibliophilia.notifications) {
+        return;
+    }
+    var since = 0;
+    setInterval(function() {
+        $.ajax(bibliophilia.notifications + '?since=' + since).done(
+            function(notifications) {
+                for (var i = 0; i < notifications.length; i++) {
+                    if (notifications[i].name == 'unread_message_count')
+                        set_message_count(notifications[i].data);
+                    since = notifications[i].timestamp;
+                }
+            }
+        );
+    }, 10000);
+});
+
+// the rating stars of every book card on the page
+$(function() {
+    $('.starrr').each(function() {
+        var elem = $(this);
+        elem.starrr({
+            rating: elem.data('rating') || void 0,
+            change: function(e, value) {
+                $.ajax('/echo', {
+                    type: 'POST',
+                    contentType: 'application/json',
+                    data: JSON.stringify({'rating': value, 'book': elem.data('book')})
+                });
+            }
+        });
+    });
+});
@@ -1,10 +1,37 @@
 import json
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from flask import current_app
 from flask_babel import _
+from app.metrics import outbound
 
 
-def translate(text, source_language, dest_language):
-    r = requests.get('https://api.mymemory.translated.net/get?q=%s&langpair=%s|%s' %(text, source_language, dest_language))
+def fetch_translation(http, url, timeout, text, source_language, dest_language):
+    from requests import RequestException
+    try:
+        with outbound('translate', 'get'):
+            r = http.get(url, params={'q': text, 'langpair': '%s|%s' % (source_language, dest_language)},
+                         timeout=timeout)
+    except RequestException:
+        return None
     if r.status_code != 200:
-        return _('Error: the translation service failed.')
+        return None
     return json.loads(r.content.decode('utf-8-sig'))['responseData']['translatedText']
+
+
+def translate_many(texts, source_language, dest_language):
+    """Translate texts concurrently over the worker's pooled HTTP session.
+    Under the gevent workers the threads are greenlets."""
+    config = current_app.config
+    fetch = partial(fetch_translation, current_app.http.get(), config['TRANSLATE_URL'],
+                    config['TRANSLATE_TIMEOUT'], source_language=source_language, dest_language=dest_language)
+    if len(texts) > 1:
+        with ThreadPoolExecutor(min(len(texts), config['TRANSLATE_CONCURRENCY'])) as pool:
+            results = list(pool.map(fetch, texts))
+    else:
+        results = [fetch(text) for text in texts]
+    return [_('Error: the translation service failed.') if result is None else result for result in results]
+
+
+def translate(text, source_language, dest_language):
+    return translate_many([text], source_language, dest_language)[0]
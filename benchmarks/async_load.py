@@ -0,0 +1,125 @@
+"""Throughput and latency of /translate against a translation API that takes
+LATENCY seconds to answer, served by sync gunicorn workers and by gevent
+workers, at increasing numbers of concurrent clients.
+
+    python -m benchmarks.async_load [requests] [texts per request]
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from app import db
+from app.bench import percentile
+from app.models import User
+from benchmarks.utils import BenchConfig, make_app, report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LATENCY = 0.2
+WORKERS = 4
+CONCURRENCY = [4, 16, 64]
+GUNICORN = 'from gunicorn.app.wsgiapp import run; run()'
+MODES = [('sync', ['-k', 'sync']), ('gevent', ['-k', 'gevent', '--worker-connections', '1000'])]
+
+
+class SlowTranslation(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(LATENCY)
+        body = json.dumps({'responseData': {'translatedText': 'translated'}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def seed(path):
+    app = make_app(type('FileConfig', (BenchConfig,), {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path}))
+    user = User(username='reader', email='reader@example.com')
+    db.session.add(user)
+    db.session.commit()
+    cookie = app.session_interface.get_signing_serializer(app).dumps({'_user_id': str(user.id), '_fresh': True})
+    db.session.remove()
+    return app.session_cookie_name, cookie
+
+
+def start_server(args, port, environment):
+    process = subprocess.Popen([sys.executable, '-c', GUNICORN, '-w', str(WORKERS), '-b', '127.0.0.1:%d' % port]
+                               + args + ['bibliophilia:app'], env=environment, cwd=tempfile.mkdtemp(),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get('http://127.0.0.1:%d/auth/login' % port, timeout=5)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def load(url, cookie, texts, total, concurrency):
+    local = threading.local()
+
+    def post(_):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            local.session.cookies.set(*cookie)
+        start = time.perf_counter()
+        rv = local.session.post(url, data={'text': ['hello'] * texts, 'source_language': 'en',
+                                           'dest_language': 'fa'})
+        return time.perf_counter() - start, rv.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(post, range(total)))
+    elapsed = time.perf_counter() - start
+    errors = sum(1 for _, status in results if status != 200)
+    return total / elapsed, percentile([latency * 1000 for latency, _ in results], 95), errors
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    texts = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), SlowTranslation)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    cookie = seed(path)
+    environment = dict(os.environ, PYTHONPATH=ROOT, SQLALCHEMY_DATABASE_URI='sqlite:///' + path,
+                       ELASTICSEARCH_URL='', RATE_LIMIT_DB='', TRANSLATE_URL='http://127.0.0.1:%d/get' % stub.server_port)
+    environment.pop('prometheus_multiproc_dir', None)
+    rows = []
+    for name, args in MODES:
+        port = free_port()
+        server = start_server(args, port, environment)
+        try:
+            for concurrency in CONCURRENCY:
+                rps, p95, errors = load('http://127.0.0.1:%d/translate' % port, cookie, texts,
+                                        total, concurrency)
+                rows.append(('%s, %d clients' % (name, concurrency),
+                             '%6.1f req/s  p95 %7.1fms  %d errors' % (rps, p95, errors)))
+        finally:
+            server.terminate()
+            server.wait()
+    stub.shutdown()
+    report('/translate with %d workers, %d text(s) per request, upstream latency %.0fms'
+           % (WORKERS, texts, LATENCY * 1000), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Throughput and peak memory of the bulk book import.
+
+    python -m benchmarks.books_import [rows]
+"""
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from app import db
+from app.importer import import_books
+from app.models import User, Book
+from benchmarks.utils import BenchConfig, make_app, report
+
+
+def write_jsonl(path, rows):
+    with open(path, 'w') as f:
+        for i in range(rows):
+            f.write(json.dumps({'title': 'Book %d' % i, 'author': 'Author %d' % (i % 997), 'isbn': str(i),
+                                'description': 'A long and winding story, chapter %d of the saga' % i}) + '\n')
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    tmp = tempfile.mkdtemp()
+
+    class FileConfig(BenchConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+
+    make_app(FileConfig)
+    user = User(username='importer', email='importer@example.com')
+    db.session.add(user)
+    db.session.commit()
+    path = os.path.join(tmp, 'books.jsonl')
+    write_jsonl(path, rows)
+
+    start = time.perf_counter()
+    import_books(path, user, echo=lambda message: None)
+    elapsed = time.perf_counter() - start
+    report('import of %d rows' % rows, [
+        ('books in database', Book.query.count()),
+        ('seconds', '%.1f' % elapsed),
+        ('rows/sec', '%.0f' % (rows / elapsed)),
+        ('peak RSS (MB)', '%.0f' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Repeat requests with and without If-None-Match.
+
+    python -m benchmarks.conditional_get
+"""
+from app import db
+from app.models import User, Book, Rating
+from benchmarks.utils import make_app, login, timed, report
+
+REPEAT = 200
+
+
+def seed():
+    users = [User(username='user%d' % i, email='user%d@example.com' % i) for i in range(20)]
+    db.session.add_all(users)
+    books = [Book(title='book %d' % i, author='author %d' % i, description='about book %d' % i,
+                  poster=users[i % len(users)]) for i in range(100)]
+    db.session.add_all(books)
+    db.session.add_all([Rating(author=u, book=b, score=(b.id or 0) % 5 + 1) for u in users for b in books[:20]])
+    db.session.commit()
+    return users[0]
+
+
+def main():
+    app = make_app()
+    user = seed()
+    client = app.test_client()
+    login(client, user)
+    api_client = app.test_client()
+    token = user.get_token()
+    db.session.commit()
+    for url in ['/explore', '/user/user1', '/api/users/2', '/api/users?per_page=100']:
+        if url.startswith('/api'):
+            client, headers = api_client, {'Authorization': 'Bearer ' + token}
+        else:
+            headers = {}
+        first = client.get(url, headers=headers)
+        full_time, full = timed(lambda: client.get(url, headers=headers), REPEAT)
+        cached_headers = dict(headers, **{'If-None-Match': first.headers['ETag']})
+        cached_time, cached = timed(lambda: client.get(url, headers=cached_headers), REPEAT)
+        report(url, [
+            ('status (full / conditional)', '%d / %d' % (full.status_code, cached.status_code)),
+            ('bytes (full / conditional)', '%d / %d' % (len(full.data), len(cached.data))),
+            ('ms per request (full)', '%.2f' % (full_time * 1000)),
+            ('ms per request (conditional)', '%.2f' % (cached_time * 1000)),
+            ('speedup', '%.1fx' % (full_time / cached_time)),
+        ])
+
+
+if __name__ == '__main__':
+    main()
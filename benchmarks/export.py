@@ -0,0 +1,67 @@
+"""Rows/sec and peak RSS of the streaming export.
+
+    python -m benchmarks.export [ratings]
+"""
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from app import db
+from app.exporter import export_lines
+from app.models import User, Book, Rating
+from benchmarks.utils import BenchConfig, make_app, report
+
+
+def seed(ratings):
+    rnd = random.Random(42)
+    users, books = max(ratings // 100, 1), max(ratings // 50, 1)
+    db.session.execute(User.__table__.insert(), [
+        {'username': 'user%d' % i, 'email': 'user%d@example.com' % i} for i in range(users)])
+    db.session.execute(Book.__table__.insert(), [
+        {'title': 'book %d' % i, 'author': 'author', 'user_id': 1} for i in range(books)])
+    # every user rates a different run of books, so (user, book) stays unique
+    for start in range(0, ratings, 50000):
+        db.session.execute(Rating.__table__.insert(), [
+            {'user_id': i // 100 + 1, 'book_id': (i // 100 * 37 + i % 100) % books + 1,
+             'score': rnd.randrange(1, 6)}
+            for i in range(start, min(start + 50000, ratings))])
+    db.session.commit()
+
+
+def rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    ratings = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tmp = tempfile.mkdtemp()
+
+    class FileConfig(BenchConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+
+    app = make_app(FileConfig)
+    seed(ratings)
+    db.session.remove()
+    before = rss()
+    rows = []
+    for format in ['jsonl', 'csv']:
+        start = time.perf_counter()
+        size = sum(len(chunk) for chunk in export_lines('ratings', format))
+        elapsed = time.perf_counter() - start
+        rows.append(('generator, %s' % format, '%.0f rows/s, %.1f MB' % (ratings / elapsed, size / 1e6)))
+    client = app.test_client()
+    token = User.query.get(1).get_token()
+    db.session.commit()
+    start = time.perf_counter()
+    response = client.get('/api/export/ratings', headers={'Authorization': 'Bearer ' + token}, buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    elapsed = time.perf_counter() - start
+    rows.append(('HTTP, jsonl', '%.0f rows/s, %.1f MB' % (ratings / elapsed, size / 1e6)))
+    rows.append(('peak RSS before / after (MB)', '%.0f / %.0f' % (before, rss())))
+    report('export of %d ratings' % ratings, rows)
+
+
+if __name__ == '__main__':
+    main()
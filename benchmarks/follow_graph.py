@@ -0,0 +1,54 @@
+"""Follow graph lookups on a synthetic graph with 1M edges.
+
+    python -m benchmarks.follow_graph
+"""
+import random
+import sys
+import time
+from app.follow_graph import FollowGraph
+from benchmarks.utils import timed, report
+
+USERS = 100000
+EDGES = 1000000
+LOOKUPS = 100000
+
+
+def edges(seed=42):
+    rnd = random.Random(seed)
+    for _ in range(EDGES):
+        # one edge in five goes to a small set of popular accounts
+        if rnd.random() < 0.2:
+            followed = int(rnd.paretovariate(0.5)) % USERS + 1
+        else:
+            followed = rnd.randrange(1, USERS + 1)
+        yield rnd.randrange(1, USERS + 1), followed
+
+
+def main():
+    graph = FollowGraph()
+    start = time.perf_counter()
+    graph.load(edges())
+    build = time.perf_counter() - start
+    size = sum(ids.buffer_info()[1] * ids.itemsize for ids in graph.followed.values())
+    size += sum(ids.buffer_info()[1] * ids.itemsize for ids in graph.followers.values())
+    size += sys.getsizeof(graph.followed) + sys.getsizeof(graph.followers)
+
+    rnd = random.Random(1)
+    pairs = [(rnd.randrange(1, USERS + 1), rnd.randrange(1, USERS + 1)) for _ in range(LOOKUPS)]
+    it = iter(pairs * 2)
+    following, _ = timed(lambda: graph.is_following(*next(it)), LOOKUPS)
+    it = iter(pairs)
+    mutual, _ = timed(lambda: graph.is_mutual(*next(it)), LOOKUPS)
+    it = iter(pairs)
+    counts, _ = timed(lambda: graph.follower_count(next(it)[1]), LOOKUPS)
+    report('%d users, %d distinct edges' % (USERS, graph.edge_count()), [
+        ('build (s)', '%.2f' % build),
+        ('array + index memory (MB)', '%.1f' % (size / 1e6)),
+        ('is_following (us)', '%.2f' % (following * 1e6)),
+        ('is_mutual (us)', '%.2f' % (mutual * 1e6)),
+        ('follower_count (us)', '%.2f' % (counts * 1e6)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Render time of a 50 book explore page with and without the fragment cache.
+
+    python -m benchmarks.fragment_cache
+"""
+from app import db
+from app.models import User, Book, Rating, Comment
+from benchmarks.utils import BenchConfig, make_app, login, timed, report
+
+REPEAT = 50
+
+
+class PageConfig(BenchConfig):
+    POSTS_PER_PAGE = 50
+
+
+def seed():
+    users = [User(username='user%d' % i, email='user%d@example.com' % i) for i in range(10)]
+    db.session.add_all(users)
+    books = [Book(title='book %d' % i, author='author %d' % i, description='about book %d' % i,
+                  language='fa', poster=users[i % len(users)]) for i in range(50)]
+    db.session.add_all(books)
+    db.session.add_all([Rating(author=u, book=b, score=(i % 5) + 1)
+                        for i, u in enumerate(users) for b in books])
+    db.session.add_all([Comment(body='comment', author=users[0], book=b) for b in books])
+    db.session.commit()
+    return users[0]
+
+
+def main():
+    app = make_app(PageConfig)
+    client = app.test_client()
+    login(client, seed())
+    cache = app.fragment_cache
+
+    max_size = cache.max_size
+    cache.max_size = 0
+    uncached, _ = timed(lambda: client.get('/explore'), REPEAT)
+    cache.max_size = max_size
+    client.get('/explore')
+    hits, misses = cache.hits, cache.misses
+    cached, rv = timed(lambda: client.get('/explore'), REPEAT)
+    stats = cache.stats()
+    hit_rate = (cache.hits - hits) / (cache.hits - hits + cache.misses - misses)
+    report('/explore, 50 books', [
+        ('status', rv.status_code),
+        ('ms per render (no cache)', '%.2f' % (uncached * 1000)),
+        ('ms per render (warm cache)', '%.2f' % (cached * 1000)),
+        ('speedup', '%.1fx' % (uncached / cached)),
+        ('fragments cached', stats['items']),
+        ('cache size (chars)', stats['size']),
+        ('hit rate (warm)', '%.1f%%' % (hit_rate * 100)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
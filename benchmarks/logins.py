@@ -0,0 +1,67 @@
+"""Password checks per second from concurrent login requests, with the hash
+run inline on the request threads and in pools of processes, and how long a
+cheap request waits meanwhile.
+
+    python -m benchmarks.logins [threads] [seconds]
+"""
+import sys
+import threading
+import time
+from werkzeug.exceptions import HTTPException
+from werkzeug.security import generate_password_hash
+from app.bench import percentile
+from app.passwords import HashPool, verify_password
+from benchmarks.utils import make_app, report
+
+POOLS = [('inline', 0), ('1 process', 1), ('2 processes', 2), ('4 processes', 4)]
+
+
+def storm(app, password_hash, threads, seconds):
+    counts, rejected = [0] * threads, [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def login(index):
+        with app.app_context():
+            while time.perf_counter() < deadline:
+                try:
+                    verify_password(index, password_hash, 'password')
+                    counts[index] += 1
+                except HTTPException:
+                    rejected[index] += 1
+
+    workers = [threading.Thread(target=login, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    # a request that needs no hash, e.g. a page view, served by the same worker
+    delays = []
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        sum(range(1000))
+        delays.append((time.perf_counter() - start) * 1000)
+        time.sleep(0.01)
+    for worker in workers:
+        worker.join()
+    return sum(counts) / seconds, sum(rejected), percentile(delays, 99)
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    app = make_app()
+    config = app.config
+    password_hash = generate_password_hash('password', config['PASSWORD_HASH_METHOD'],
+                                           config['PASSWORD_SALT_LENGTH'])
+    rows = []
+    for name, workers in POOLS:
+        app.password_pool = HashPool(workers, threads, config['PASSWORD_HASH_PER_USER'],
+                                     config['PASSWORD_HASH_TIMEOUT'])
+        try:
+            logins, rejected, delay = storm(app, password_hash, threads, seconds)
+        finally:
+            app.password_pool.shutdown()
+        rows.append((name, '%6.1f logins/sec  %d rejected  page p99 %.2fms' % (logins, rejected, delay)))
+    report('%d threads logging in for %.0fs, %s' % (threads, seconds, config['PASSWORD_HASH_METHOD']), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Notification polls and writes with 100k users: the poll query with and
+without the (user_id, timestamp) index, and upserts against the delete and
+insert the store used before.
+
+    python -m benchmarks.notifications [users] [polls]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from app import db
+from app.bench import percentile
+from app.models import Notification
+from app.seed import Seeder
+from benchmarks.utils import BenchConfig, make_app, report
+
+NAMES = ['unread_message_count', 'task_progress', 'new_follower']
+
+
+def seed_notifications(users):
+    now = time.time()
+    rows = [{'user_id': user, 'name': name, 'timestamp': now - random.uniform(0, 86400),
+             'payload_json': json.dumps(random.randint(0, 9))}
+            for user in users for name in NAMES]
+    db.session.execute(Notification.__table__.insert(), rows)
+    db.session.commit()
+
+
+def polls(users, n):
+    latencies = []
+    for _ in range(n):
+        user = random.choice(users)
+        since = time.time() - random.uniform(0, 86400)
+        start = time.perf_counter()
+        Notification.query.filter(Notification.user_id == user, Notification.timestamp > since).order_by(
+            Notification.timestamp.asc()).all()
+        latencies.append((time.perf_counter() - start) * 1000)
+        db.session.remove()
+    return percentile(latencies, 50), percentile(latencies, 95)
+
+
+def delete_insert(user, name, data):
+    # the store before upserts: every event replaced the row
+    Notification.query.filter_by(user_id=user, name=name).delete()
+    db.session.add(Notification(user_id=user, name=name, payload_json=json.dumps(data)))
+
+
+def writes(users, write, n):
+    start = time.perf_counter()
+    for i in range(n):
+        write(random.choice(users), random.choice(NAMES), i)
+        if i % 100 == 99:
+            db.session.commit()
+    db.session.commit()
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n_polls = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    random.seed(42)
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    make_app(type('FileConfig', (BenchConfig,), {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path}))
+    users = list(Seeder(echo=lambda line: None).users(n_users))
+    seed_notifications(users)
+    rows = []
+    p50, p95 = polls(users, n_polls)
+    rows.append(('poll, (user_id, timestamp) index', 'p50 %.3fms  p95 %.3fms' % (p50, p95)))
+    db.session.execute('DROP INDEX ix_notification_user_id_timestamp')
+    db.session.commit()
+    p50, p95 = polls(users, n_polls)
+    rows.append(('poll, without it', 'p50 %.3fms  p95 %.3fms' % (p50, p95)))
+    rows.append(('writes, upsert', '%.0f/sec' % writes(users, Notification.upsert, n_polls)))
+    rows.append(('writes, delete + insert', '%.0f/sec' % writes(users, delete_insert, n_polls)))
+    rows.append(('rows', '%d for %d users' % (Notification.query.count(), n_users)))
+    report('notifications, %d users, %d polls' % (n_users, n_polls), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Build time of the item-item similarity table versus number of ratings.
+
+    python -m benchmarks.recs_build
+"""
+import time
+import numpy as np
+from app.recs import ratings_matrix, top_k
+from benchmarks.utils import report
+
+K = 20
+SIZES = [10000, 100000, 1000000]
+
+
+def synthetic(n_ratings, seed=42):
+    rnd = np.random.default_rng(seed)
+    n_users, n_books = n_ratings // 10, n_ratings // 20
+    user_ids = rnd.integers(1, n_users, n_ratings, dtype=np.int32)
+    # zipf-like popularity, most ratings go to a small share of the books
+    book_ids = (rnd.zipf(1.3, n_ratings) % n_books).astype(np.int32) + 1
+    scores = rnd.integers(1, 6, n_ratings).astype(np.float32)
+    return user_ids, book_ids, scores, n_books + 1
+
+
+def main():
+    rows = []
+    for n_ratings in SIZES:
+        user_ids, book_ids, scores, n_books = synthetic(n_ratings)
+        start = time.perf_counter()
+        matrix = ratings_matrix(user_ids, book_ids, scores, n_books)
+        loaded = time.perf_counter()
+        top_k(matrix, np.unique(book_ids), K)
+        done = time.perf_counter()
+        rows.append(('%d ratings, %d books' % (n_ratings, n_books - 1),
+                     'matrix %.2fs, top-%d %.2fs, table %.1f MB' % (
+                         loaded - start, K, done - loaded, n_books * (4 + 8 * K) / 1e6)))
+    report('recs build', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Rating writes per second from concurrent workers sharing one sqlite file,
+with the default settings, with WAL and with the serialized writer.
+
+    python -m benchmarks.sqlite_writes [workers] [seconds]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+from sqlalchemy.exc import OperationalError
+from app import db
+from app.models import User, Book
+from benchmarks.utils import BenchConfig, make_app, report
+
+BOOKS = 200
+MODES = [
+    ('default', {}),
+    ('wal', {'SQLITE_WAL': True}),
+    ('wal + serialized writer', {'SQLITE_WAL': True, 'SQLITE_SERIALIZE_WRITES': True}),
+]
+
+
+def file_config(path, options):
+    return type('FileConfig', (BenchConfig,), dict(options, SQLALCHEMY_DATABASE_URI='sqlite:///' + path))
+
+
+def seed(config, workers):
+    make_app(config)
+    users = [User(username='user%d' % i, email='user%d@example.com' % i) for i in range(workers)]
+    db.session.add_all(users)
+    db.session.commit()
+    db.session.add_all([Book(title='book %d' % i, author='a', poster=users[0]) for i in range(BOOKS)])
+    tokens = [user.get_token() for user in users]
+    db.session.commit()
+    db.session.remove()
+    return tokens
+
+
+def worker(config, token, seconds, results):
+    app = make_app(config)
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + token}
+    writes, errors = 0, 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        body = {'ratings': [{'book': random.randint(1, BOOKS), 'score': random.randint(1, 5)}]}
+        try:
+            rv = client.put('/api/ratings', json=body, headers=headers)
+            if rv.status_code == 200:
+                writes += 1
+            else:
+                errors += 1
+        except OperationalError:
+            errors += 1
+        db.session.remove()
+    results.put((writes, errors))
+
+
+def run(options, workers, seconds):
+    tmp = tempfile.mkdtemp()
+    config = file_config(os.path.join(tmp, 'bench.db'), options)
+    tokens = seed(config, workers)
+    results = Queue()
+    processes = [Process(target=worker, args=(config, token, seconds, results)) for token in tokens]
+    for process in processes:
+        process.start()
+    totals = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return sum(writes for writes, _ in totals), sum(errors for _, errors in totals)
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rows = []
+    for name, options in MODES:
+        writes, errors = run(options, workers, seconds)
+        rows.append((name, '%.0f writes/sec, %d errors' % (writes / seconds, errors)))
+    report('%d workers rating books for %.0fs' % (workers, seconds), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Import time of the app and time to its first response, measured in fresh
+interpreters and optionally saved as JSON to be tracked across commits.
+
+    python -m benchmarks.startup [runs] [output.json]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from benchmarks.utils import report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# production mode writes logs/ into the working directory
+CWD = tempfile.mkdtemp()
+
+FIRST_REQUEST = '''
+import time
+start = time.perf_counter()
+import bibliophilia
+imported = time.perf_counter()
+bibliophilia.app.test_client().get('/auth/login')
+print(imported - start, time.perf_counter() - start)
+'''
+
+
+def environment():
+    return dict(os.environ, SQLALCHEMY_DATABASE_URI='sqlite://', ELASTICSEARCH_URL='', PYTHONPATH=ROOT)
+
+
+def import_times():
+    # cumulative milliseconds of each top level package imported by the app
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import bibliophilia'],
+                            env=environment(), cwd=CWD, stderr=subprocess.PIPE, check=True).stderr.decode()
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        if '.' not in name and name not in ('app', 'bibliophilia'):
+            modules[name] = max(modules.get(name, 0), int(cumulative) / 1000)
+    return modules
+
+
+def first_request():
+    output = subprocess.run([sys.executable, '-c', FIRST_REQUEST], env=environment(), cwd=CWD,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode()
+    return [float(value) * 1000 for value in output.split()]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    timings = sorted(first_request() for _ in range(runs))
+    imported, first = timings[len(timings) // 2]
+    modules = import_times()
+    slowest = sorted(modules.items(), key=lambda item: -item[1])[:10]
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE).stdout.decode().strip()
+    report('startup, median of %d runs' % runs, [
+        ('import (ms)', '%.0f' % imported),
+        ('time to first request (ms)', '%.0f' % first),
+    ] + [('  ' + name, '%.0f ms' % ms) for name, ms in slowest])
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w') as f:
+            json.dump({'commit': commit, 'runs': runs, 'import_ms': imported, 'first_request_ms': first,
+                       'modules_ms': dict(slowest)}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
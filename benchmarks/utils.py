@@ -0,0 +1,41 @@
+import time
+from app import create_app, db
+from config import Config
+
+
+class BenchConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    ELASTICSEARCH_URL = None
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_RECORD_QUERIES = False
+    POSTS_PER_PAGE = 20
+    RATE_LIMIT_DB = None
+    PASSWORD_HASH_WORKERS = 0
+
+
+def make_app(config_class=BenchConfig):
+    app = create_app(config_class)
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    return app
+
+
+def login(client, user):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def report(title, rows):
+    print(title)
+    for name, value in rows:
+        print('  %-32s %s' % (name, value))
@@ -8,6 +8,51 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'secret_key'
     SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI') or 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_REPLICA_URI = os.environ.get('SQLALCHEMY_REPLICA_URI')
+    SQLALCHEMY_BINDS = {'replica': SQLALCHEMY_REPLICA_URI} if SQLALCHEMY_REPLICA_URI else {}
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE') or 10),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW') or 20),
+        'pool_timeout': int(os.environ.get('DATABASE_POOL_TIMEOUT') or 10),
+        'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800),
+        'pool_pre_ping': True,
+    }
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 5)
+    LAST_SEEN_INTERVAL = 60
+    SQLITE_WAL = os.environ.get('SQLITE_WAL') is not None
+    SQLITE_SERIALIZE_WRITES = os.environ.get('SQLITE_SERIALIZE_WRITES') is not None
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+    SQLITE_LOCK_RETRIES = 5
+    SQLITE_LOCK_BACKOFF = 0.05
+    SQL_PROFILING = os.environ.get('SQL_PROFILING') is not None
+    SQL_PROFILING_SAMPLE_RATE = float(os.environ.get('SQL_PROFILING_SAMPLE_RATE') or 1.0)
+    SQL_PROFILING_SLOWEST = 3
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE') or 20)
+    TRANSLATE_URL = os.environ.get('TRANSLATE_URL') or 'https://api.mymemory.translated.net/get'
+    TRANSLATE_TIMEOUT = 10
+    TRANSLATE_CONCURRENCY = 8
+    RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', os.path.join(basedir, 'ratelimit.db'))
+    # endpoint: {'client': (tokens per second, burst), 'endpoint': (tokens per second, burst)}
+    RATE_LIMITS = {
+        'main.translate_text': {'client': (0.5, 10), 'endpoint': (20, 100)},
+        'main.search': {'client': (2, 20), 'endpoint': (50, 200)},
+        'main.hello': {'client': (1, 20), 'endpoint': (50, 200)},
+        'main.avatar': {'client': (20, 200), 'endpoint': (200, 1000)},
+        'api.get_users': {'client': (5, 50), 'endpoint': (100, 500)},
+        'api.get_followers': {'client': (5, 50), 'endpoint': (100, 500)},
+        'api.get_followed': {'client': (5, 50), 'endpoint': (100, 500)},
+    }
+    SHED_MAX_QUEUE_SECONDS = float(os.environ.get('SHED_MAX_QUEUE_SECONDS') or 2.0)
+    SHED_MAX_INFLIGHT = int(os.environ.get('SHED_MAX_INFLIGHT') or 0)
+    SHED_RETRY_AFTER = 1
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = 8
+    PASSWORD_HASH_PER_USER = 2
+    PASSWORD_HASH_TIMEOUT = 5
+    SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS') or 0.5)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -17,3 +62,26 @@ class Config(object):
     POSTS_PER_PAGE=2
     LANGUAGES = ['en', 'fa']
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 16 * 1024 * 1024)
+    FOLLOW_GRAPH_TTL = int(os.environ.get('FOLLOW_GRAPH_TTL') or 60)
+    NOTIFICATION_MAX_AGE = 30 * 24 * 3600
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL') or 10)
+    POPUP_CACHE_TTL = int(os.environ.get('POPUP_CACHE_TTL') or 60)
+    POPUP_MAX_AGE = 60
+    AVATAR_PATH = os.environ.get('AVATAR_PATH') or os.path.join(basedir, 'avatars')
+    # empty to only serve identicons
+    GRAVATAR_URL = os.environ.get('GRAVATAR_URL', 'https://www.gravatar.com/avatar/')
+    GRAVATAR_TIMEOUT = 5
+    AVATAR_FETCH_WORKERS = 2
+    AVATAR_REFRESH = 7 * 24 * 3600
+    AVATAR_MAX_AGE = 7 * 24 * 3600
+    # while the Gravatar image is being fetched the identicon is served
+    AVATAR_PENDING_MAX_AGE = 60
+    RECS_PATH = os.environ.get('RECS_PATH') or os.path.join(basedir, 'recs.npy')
+    RECS_K = int(os.environ.get('RECS_K') or 20)
+    RECS_PER_BOOK = 5
+    LEADERBOARD_PRIOR_COUNT = 5
+    LEADERBOARD_PRIOR_MEAN = 3.0
+    TRENDING_HALF_LIFE = 24 * 3600
+    TRENDING_RATING_WEIGHT = 1
+    TRENDING_COMMENT_WEIGHT = 2
@@ -0,0 +1,27 @@
+import os
+import shutil
+from prometheus_client import multiprocess
+
+# /translate, /search and the user popups spend most of their time waiting on
+# the translation API and Elasticsearch, so they are served by gevent workers
+# where every request is a greenlet and a slow upstream does not hold a worker
+bind = 'localhost:8001'
+workers = 2
+worker_class = 'gevent'
+worker_connections = 1000
+# no preload: gevent patches the standard library in each worker, which has to
+# happen before ssl and the database drivers are imported
+preload_app = False
+# a greenlet per connection, so the worker sheds load itself past this many
+raw_env = ['SHED_MAX_INFLIGHT=200']
+
+
+def on_starting(server):
+    path = os.environ.get('prometheus_multiproc_dir')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
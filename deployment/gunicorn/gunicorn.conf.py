@@ -0,0 +1,35 @@
+import os
+import shutil
+from prometheus_client import multiprocess
+
+bind = 'localhost:8000'
+workers = 4
+# import the app once in the master, workers start from a forked copy
+preload_app = True
+
+
+def on_starting(server):
+    # samples left by a previous run would be added to the new totals
+    path = os.environ.get('prometheus_multiproc_dir')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def pre_fork(server, worker):
+    # connections opened in the master must not be inherited by workers
+    if server.cfg.preload_app:
+        app = server.app.wsgi()
+        with app.app_context():
+            from app import db
+            db.engine.dispose()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app import after_fork
+        after_fork(server.app.wsgi())
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
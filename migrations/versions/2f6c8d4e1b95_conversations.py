@@ -0,0 +1,66 @@
+"""conversations
+
+Revision ID: 2f6c8d4e1b95
+Revises: 8e3f1a6b2d47
+Create Date: 2026-10-19 19:24:51.402376
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f6c8d4e1b95'
+down_revision = '8e3f1a6b2d47'
+branch_labels = None
+depends_on = None
+
+LOW = 'CASE WHEN sender_id < recipient_id THEN sender_id ELSE recipient_id END'
+HIGH = 'CASE WHEN sender_id < recipient_id THEN recipient_id ELSE sender_id END'
+
+
+def upgrade():
+    op.create_table('conversation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user1_id', sa.Integer(), nullable=False),
+    sa.Column('user2_id', sa.Integer(), nullable=False),
+    sa.Column('last_message_id', sa.Integer(), nullable=True),
+    sa.Column('last_time', sa.DateTime(), nullable=True),
+    sa.Column('unread1', sa.Integer(), nullable=False),
+    sa.Column('unread2', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['last_message_id'], ['message.id'], name='fk_conversation_last_message_id'),
+    sa.ForeignKeyConstraint(['user1_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user2_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_conversation_user1_id_user2_id', 'conversation', ['user1_id', 'user2_id'], unique=True)
+    op.create_index('ix_conversation_user1_id_last_time', 'conversation', ['user1_id', 'last_time'])
+    op.create_index('ix_conversation_user2_id_last_time', 'conversation', ['user2_id', 'last_time'])
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.add_column(sa.Column('conversation_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_message_conversation_id', 'conversation', ['conversation_id'], ['id'])
+        batch_op.create_index('ix_message_conversation_id_time', ['conversation_id', 'time'])
+
+    # existing messages count as read in their conversations, the unread
+    # badge still goes by last_message_read_time
+    op.execute(
+        'INSERT INTO conversation (user1_id, user2_id, last_message_id, unread1, unread2) '
+        'SELECT %s, %s, MAX(id), 0, 0 FROM message '
+        'WHERE sender_id IS NOT NULL AND recipient_id IS NOT NULL GROUP BY %s, %s' % (LOW, HIGH, LOW, HIGH))
+    op.execute(
+        'UPDATE conversation SET last_time = '
+        '(SELECT message.time FROM message WHERE message.id = conversation.last_message_id)')
+    op.execute(
+        'UPDATE message SET conversation_id = (SELECT conversation.id FROM conversation '
+        'WHERE conversation.user1_id = %s AND conversation.user2_id = %s)' % (LOW, HIGH))
+
+
+def downgrade():
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.drop_index('ix_message_conversation_id_time')
+        batch_op.drop_constraint('fk_message_conversation_id', type_='foreignkey')
+        batch_op.drop_column('conversation_id')
+    op.drop_index('ix_conversation_user2_id_last_time', table_name='conversation')
+    op.drop_index('ix_conversation_user1_id_last_time', table_name='conversation')
+    op.drop_index('ix_conversation_user1_id_user2_id', table_name='conversation')
+    op.drop_table('conversation')
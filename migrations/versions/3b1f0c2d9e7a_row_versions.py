@@ -0,0 +1,31 @@
+"""row versions
+
+Revision ID: 3b1f0c2d9e7a
+Revises: 18dddada1b0c
+Create Date: 2026-10-19 09:12:41.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b1f0c2d9e7a'
+down_revision = '18dddada1b0c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('book', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('comment', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.drop_column('version')
+    with op.batch_alter_table('book') as batch_op:
+        batch_op.drop_column('version')
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('version')
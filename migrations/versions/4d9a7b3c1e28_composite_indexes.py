@@ -0,0 +1,56 @@
+"""composite indexes
+
+Revision ID: 4d9a7b3c1e28
+Revises: c2d8f4a6b190
+Create Date: 2026-10-19 16:41:12.503817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d9a7b3c1e28'
+down_revision = 'c2d8f4a6b190'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_book_user_id_time', 'book', ['user_id', 'time']),
+    ('ix_rating_book_id_user_id', 'rating', ['book_id', 'user_id']),
+    ('ix_comment_book_id_time', 'comment', ['book_id', 'time']),
+    ('ix_comment_parent_id', 'comment', ['parent_id']),
+    ('ix_message_recipient_id_time', 'message', ['recipient_id', 'time']),
+    ('ix_notification_user_id_name', 'notification', ['user_id', 'name']),
+]
+
+
+def copy_followers(primary_key):
+    # the table is rebuilt rather than altered so that sqlite can take the
+    # primary key too; duplicate and incomplete rows are dropped on the way
+    op.create_table('followers_tmp',
+    sa.Column('follower_id', sa.Integer(), nullable=not primary_key, primary_key=primary_key),
+    sa.Column('followed_id', sa.Integer(), nullable=not primary_key, primary_key=primary_key),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute(
+        'INSERT INTO followers_tmp (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM followers '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_tmp', 'followers')
+
+
+def upgrade():
+    copy_followers(primary_key=True)
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'])
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    copy_followers(primary_key=False)
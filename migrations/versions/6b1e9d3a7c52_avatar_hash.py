@@ -0,0 +1,46 @@
+"""avatar hash
+
+Revision ID: 6b1e9d3a7c52
+Revises: 2f6c8d4e1b95
+Create Date: 2026-10-19 21:02:17.518204
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b1e9d3a7c52'
+down_revision = '2f6c8d4e1b95'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+
+def upgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.add_column(sa.Column('avatar_hash', sa.String(length=32), nullable=True))
+
+    # the digest is computed here like app.avatars.email_digest, the
+    # migration must not depend on the application code
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                    sa.column('avatar_hash', sa.String))
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(sa.select([user.c.id, user.c.email]).where(user.c.id > last_id)
+                                  .order_by(user.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        for id, email in rows:
+            if email:
+                digest = md5(email.strip().lower().encode('utf-8')).hexdigest()
+                connection.execute(user.update().where(user.c.id == id).values(avatar_hash=digest))
+        last_id = rows[-1][0]
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('avatar_hash')
@@ -0,0 +1,47 @@
+"""book stats
+
+Revision ID: 7c4e2a91d5b3
+Revises: 3b1f0c2d9e7a
+Create Date: 2026-10-19 11:40:07.204511
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c4e2a91d5b3'
+down_revision = '3b1f0c2d9e7a'
+branch_labels = None
+depends_on = None
+
+# must match LEADERBOARD_PRIOR_COUNT and LEADERBOARD_PRIOR_MEAN
+PRIOR_COUNT = 5
+PRIOR_MEAN = 3.0
+
+
+def upgrade():
+    op.create_table('book_stats',
+    sa.Column('book_id', sa.Integer(), nullable=False),
+    sa.Column('rating_count', sa.Integer(), nullable=False),
+    sa.Column('rating_sum', sa.Integer(), nullable=False),
+    sa.Column('top_score', sa.Float(), nullable=False),
+    sa.Column('trending_score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['book_id'], ['book.id'], ),
+    sa.PrimaryKeyConstraint('book_id')
+    )
+    op.create_index(op.f('ix_book_stats_top_score'), 'book_stats', ['top_score'], unique=False)
+    op.create_index(op.f('ix_book_stats_trending_score'), 'book_stats', ['trending_score'], unique=False)
+    # trending starts empty, it only reflects activity from now on
+    op.execute(
+        'INSERT INTO book_stats (book_id, rating_count, rating_sum, top_score, trending_score) '
+        'SELECT book.id, COUNT(rating.id), COALESCE(SUM(rating.score), 0), '
+        '(%f + COALESCE(SUM(rating.score), 0)) / (%d + COUNT(rating.id)), 0 '
+        'FROM book LEFT OUTER JOIN rating ON rating.book_id = book.id GROUP BY book.id'
+        % (PRIOR_COUNT * PRIOR_MEAN, PRIOR_COUNT))
+
+
+def downgrade():
+    op.drop_index(op.f('ix_book_stats_trending_score'), table_name='book_stats')
+    op.drop_index(op.f('ix_book_stats_top_score'), table_name='book_stats')
+    op.drop_table('book_stats')
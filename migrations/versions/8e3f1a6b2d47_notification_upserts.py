@@ -0,0 +1,33 @@
+"""notification upserts
+
+Revision ID: 8e3f1a6b2d47
+Revises: 4d9a7b3c1e28
+Create Date: 2026-10-19 18:02:37.114209
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e3f1a6b2d47'
+down_revision = '4d9a7b3c1e28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep only the newest notification of each name per user, the derived
+    # table lets mysql delete from the table it reads
+    op.execute(
+        'DELETE FROM notification WHERE id NOT IN '
+        '(SELECT id FROM (SELECT MAX(id) AS id FROM notification GROUP BY user_id, name) AS newest)')
+    op.drop_index('ix_notification_user_id_name', table_name='notification')
+    op.create_index('ix_notification_user_id_name', 'notification', ['user_id', 'name'], unique=True)
+    op.create_index('ix_notification_user_id_timestamp', 'notification', ['user_id', 'timestamp'])
+
+
+def downgrade():
+    op.drop_index('ix_notification_user_id_timestamp', table_name='notification')
+    op.drop_index('ix_notification_user_id_name', table_name='notification')
+    op.create_index('ix_notification_user_id_name', 'notification', ['user_id', 'name'])
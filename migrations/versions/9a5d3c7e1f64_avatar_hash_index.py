@@ -0,0 +1,24 @@
+"""avatar hash index
+
+Revision ID: 9a5d3c7e1f64
+Revises: 6b1e9d3a7c52
+Create Date: 2026-10-19 23:41:05.172936
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a5d3c7e1f64'
+down_revision = '6b1e9d3a7c52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_user_avatar_hash'), 'user', ['avatar_hash'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_avatar_hash'), table_name='user')
@@ -0,0 +1,40 @@
+"""unique ratings
+
+Revision ID: c2d8f4a6b190
+Revises: 7c4e2a91d5b3
+Create Date: 2026-10-19 14:03:55.871346
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d8f4a6b190'
+down_revision = '7c4e2a91d5b3'
+branch_labels = None
+depends_on = None
+
+# must match LEADERBOARD_PRIOR_COUNT and LEADERBOARD_PRIOR_MEAN
+PRIOR_COUNT = 5
+PRIOR_MEAN = 3.0
+
+
+def upgrade():
+    # keep the most recent rating of every (user, book) pair; the derived
+    # table keeps MySQL from rejecting a subquery on the table being deleted
+    op.execute(
+        'DELETE FROM rating WHERE id NOT IN ('
+        'SELECT id FROM (SELECT MAX(id) AS id FROM rating GROUP BY user_id, book_id) AS keep)')
+    op.execute(
+        'UPDATE book_stats SET '
+        'rating_count = (SELECT COUNT(*) FROM rating WHERE rating.book_id = book_stats.book_id), '
+        'rating_sum = (SELECT COALESCE(SUM(score), 0) FROM rating WHERE rating.book_id = book_stats.book_id), '
+        'top_score = (%f + (SELECT COALESCE(SUM(score), 0) FROM rating WHERE rating.book_id = book_stats.book_id)) '
+        '/ (%d + (SELECT COUNT(*) FROM rating WHERE rating.book_id = book_stats.book_id))'
+        % (PRIOR_COUNT * PRIOR_MEAN, PRIOR_COUNT))
+    op.create_index('ix_rating_user_id_book_id', 'rating', ['user_id', 'book_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_rating_user_id_book_id', table_name='rating')
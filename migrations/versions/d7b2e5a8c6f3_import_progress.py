@@ -0,0 +1,29 @@
+"""import progress
+
+Revision ID: d7b2e5a8c6f3
+Revises: 9a5d3c7e1f64
+Create Date: 2026-10-20 00:12:48.305611
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7b2e5a8c6f3'
+down_revision = '9a5d3c7e1f64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('import_progress',
+    sa.Column('path', sa.String(length=255), nullable=False),
+    sa.Column('records', sa.Integer(), nullable=False),
+    sa.Column('first_id', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('path')
+    )
+
+
+def downgrade():
+    op.drop_table('import_progress')
@@ -1,8 +1,39 @@
 #!/usr/bin/env python
 from datetime import datetime, timedelta
+import fcntl
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Book 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from app import create_app, db, after_fork
+from app.models import User, Book, BookStats, Rating, Comment, Message, Notification, Conversation, \
+    ImportProgress
+from app.cache import LRUCache
+from app.fragments import book_fragment
+from app.follow_graph import FollowGraph
+from app.sqlite import retry_locked, lock_file, is_locked
+from app.metrics import outbound
+from prometheus_client import REGISTRY
+from app import bench
+from app.seed import Seeder
+from app.lazy import LazyClient
+from app.translate import translate_many
+from app.ratelimit import Buckets
+from app.passwords import HashPool
+from app.avatars import email_digest
+from app import assets
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.security import check_password_hash
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
 from config import Config
 
 
@@ -10,6 +41,26 @@ class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    WTF_CSRF_ENABLED = False
+    RATE_LIMIT_DB = None
+    PASSWORD_HASH_WORKERS = 0
+
+class AppTestCase(unittest.TestCase):
+    """An app context and an empty database for each test. Subclasses can
+    set self.config before calling setUp()."""
+    config = TestConfig
+
+    def setUp(self):
+        self.app = create_app(self.config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
 
 class UserTest(unittest.TestCase):
     def setUp(self):
@@ -31,7 +82,11 @@ class UserTest(unittest.TestCase):
 
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
-        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6?d=identicon&s=128'))
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(128), '/avatar/d4c74594d841139328695756648b6bd6?s=128')
+        u.email = 'John@Example.org'
+        self.assertEqual(u.avatar_hash, '08aff750c4586c34375a0ebd987c1a7e')
     
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -84,6 +139,1338 @@ class UserTest(unittest.TestCase):
         self.assertEqual(f3, [b3, b4])
         self.assertEqual(f4, [b4])
 
+    def test_follow_graph(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual(u2.follower_count(), 0)
+
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u2.follower_count(), 1)
+        self.assertFalse(u1.is_mutual(u2))
+        u2.follow(u1)
+        db.session.commit()
+        self.assertTrue(u1.is_mutual(u2))
+
+        u1.unfollow(u2)
+        db.session.rollback()
+        self.assertTrue(u1.is_following(u2))
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertFalse(u1.is_following(u2))
+        self.assertEqual(u1.followed_count(), 0)
+        self.assertEqual(u1.follower_count(), 1)
+
+    def test_follow_graph_arrays(self):
+        graph = FollowGraph()
+        graph.load([(1, 3), (1, 2), (2, 1), (1, 2)])
+        self.assertEqual(list(graph.followed[1]), [2, 3])
+        self.assertTrue(graph.is_mutual(1, 2))
+        graph.add(3, 1)
+        graph.remove(1, 3)
+        self.assertEqual(graph.follower_count(1), 2)
+        self.assertEqual(graph.followed_count(1), 1)
+        self.assertEqual(graph.edge_count(), 3)
+
+
+class ConditionalGetTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    def test_versions(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual((u1.version, u2.version), (1, 1))
+
+        u1.last_seen = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(u1.version, 1)
+
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual((u1.version, u2.version), (2, 2))
+
+        b = Book(title='a book', author='an author', poster=u2)
+        db.session.add(b)
+        db.session.commit()
+        self.assertEqual((b.version, u2.version), (1, 3))
+
+        db.session.add(Rating(author=u1, book=b, score=4))
+        db.session.commit()
+        self.assertEqual(b.version, 2)
+
+    def test_explore_not_modified(self):
+        u = User(username='john', email='john@example.com')
+        b = Book(title='a book', author='an author', poster=u)
+        db.session.add_all([u, b])
+        db.session.commit()
+        self.login(u)
+
+        rv = self.client.get('/explore')
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        rv = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+
+        db.session.add(Rating(author=u, book=b, score=5))
+        db.session.commit()
+        rv = self.client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def test_user_page_after_follow(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1_id, u2_id = u1.id, u2.id
+        self.login(u1)
+
+        rv = self.client.get('/user/susan')
+        self.assertIn(b'Follow', rv.data)
+        etag = rv.headers['ETag']
+        db.session.remove()
+
+        rv = self.client.post('/follow/susan')
+        self.assertEqual(rv.status_code, 302)
+        db.session.remove()
+        # the redirect is served by a worker whose graph doesn't have the edge yet
+        self.app.follow_graph.remove(u1_id, u2_id)
+        rv = self.client.get('/user/susan', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'Unfollow', rv.data)
+        self.assertIn(b'1 followers', rv.data)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+class FragmentCacheTest(AppTestCase):
+    def test_lru_eviction(self):
+        cache = LRUCache(10)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        self.assertEqual(cache.get('a'), 'xxxx')
+        cache.set('c', 'xxxx')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'xxxx')
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_book_card_invalidation(self):
+        u = User(username='john', email='john@example.com')
+        b = Book(title='a book', author='an author', poster=u)
+        db.session.add_all([u, b])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        self.assertIn(b'a book', client.get('/explore').data)
+        hits = self.app.fragment_cache.hits
+        client.get('/explore')
+        self.assertEqual(self.app.fragment_cache.hits, hits + 3)
+
+        b.title = 'another title'
+        db.session.commit()
+        self.assertIn(b'another title', client.get('/explore').data)
+
+    def test_average_from_stats(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        b = Book(title='a book', author='an author', poster=u1)
+        db.session.add_all([u1, u2, b])
+        db.session.commit()
+        db.session.add_all([Rating(author=u1, book=b, score=4), Rating(author=u2, book=b, score=5)])
+        db.session.commit()
+        self.assertEqual(b.average_rating(), 4.5)
+        id = b.id
+        db.session.remove()
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            queries = []
+            listener = lambda *args: queries.append(args[2])
+            event.listen(Engine, 'before_cursor_execute', listener)
+            try:
+                html = book_fragment(Book.query.get(id), 'details')
+            finally:
+                event.remove(Engine, 'before_cursor_execute', listener)
+        self.assertIn('4.5', html)
+        self.assertEqual([q for q in queries if 'FROM rating' in q], [])
+
+
+class RecommendationTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'recs.npy')
+        self.app.recommendations.path = self.path
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmp)
+
+    def test_build_and_refresh(self):
+        from app.recs import build, refresh
+        users = [User(username='u%d' % i, email='u%d@example.com' % i) for i in range(3)]
+        books = [Book(title='b%d' % i, author='a', poster=users[0]) for i in range(4)]
+        db.session.add_all(users + books)
+        db.session.commit()
+        b1, b2, b3, b4 = books
+        db.session.add_all([
+            Rating(author=users[0], book=b1, score=5), Rating(author=users[0], book=b2, score=5),
+            Rating(author=users[1], book=b1, score=4), Rating(author=users[1], book=b2, score=4),
+            Rating(author=users[1], book=b3, score=1), Rating(author=users[2], book=b4, score=3)])
+        db.session.commit()
+
+        self.assertEqual(build(self.path, 2), 4)
+        self.assertEqual(b1.also_liked(5), [b2, b3])
+        self.assertEqual(b4.also_liked(5), [])
+        self.assertEqual(refresh(self.path, 2), 0)
+
+        db.session.add(Rating(author=users[2], book=b1, score=3))
+        db.session.commit()
+        self.assertEqual(refresh(self.path, 2), 4)
+        self.assertEqual(b4.also_liked(5), [b1])
+        self.assertEqual(b1.also_liked(5), [b2, b3])
+
+class LeaderboardTest(AppTestCase):
+    def test_incremental_stats(self):
+        users = [User(username='u%d' % i, email='u%d@example.com' % i) for i in range(6)]
+        b1 = Book(title='one five star vote', author='a', poster=users[0])
+        b2 = Book(title='many four star votes', author='a', poster=users[0])
+        db.session.add_all(users + [b1, b2])
+        db.session.commit()
+        self.assertEqual(BookStats.query.get(b1.id).rating_count, 0)
+
+        db.session.add(Rating(author=users[0], book=b1, score=5))
+        db.session.add_all([Rating(author=u, book=b2, score=4) for u in users])
+        db.session.commit()
+        stats = BookStats.query.get(b2.id)
+        self.assertEqual((stats.rating_count, stats.rating_sum), (6, 24))
+        self.assertAlmostEqual(stats.top_score, (15.0 + 24) / 11)
+        top = Book.query.join(BookStats).order_by(BookStats.top_score.desc()).all()
+        self.assertEqual(top, [b2, b1])
+
+        rating = Rating.query.filter_by(book=b1).first()
+        rating.score = 1
+        db.session.commit()
+        self.assertEqual(BookStats.query.get(b1.id).rating_sum, 1)
+
+        trending = BookStats.query.get(b1.id).trending_score
+        Comment(body='nice', book=b1, author=users[1]).save()
+        self.assertGreater(BookStats.query.get(b1.id).trending_score, trending)
+
+    def test_explore_sort(self):
+        u = User(username='john', email='john@example.com')
+        b1 = Book(title='older but loved', author='a', poster=u, time=datetime.utcnow() - timedelta(days=1))
+        b2 = Book(title='newer', author='a', poster=u)
+        db.session.add_all([u, b1, b2])
+        db.session.commit()
+        db.session.add(Rating(author=u, book=b1, score=5))
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        data = client.get('/explore').get_data(as_text=True)
+        self.assertLess(data.index('newer'), data.index('older but loved'))
+        data = client.get('/explore?sort=top').get_data(as_text=True)
+        self.assertLess(data.index('older but loved'), data.index('newer'))
+
+class ImportTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmp)
+
+    def test_import_csv(self):
+        from app.importer import import_books, Checkpoint
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        path = os.path.join(self.tmp, 'books.csv')
+        with open(path, 'w') as f:
+            f.write('title,author,isbn,description\n')
+            for i in range(7):
+                f.write('book %d,author %d,%d,the story of book number %d\n' % (i, i, i, i))
+            f.write(',no title,,\n')
+
+        result = import_books(path, u, batch_size=3, workers=0, dry_run=True, echo=lambda m: None)
+        self.assertEqual(result, {'read': 8, 'imported': 7, 'skipped': 1})
+        self.assertEqual(Book.query.count(), 0)
+
+        checkpoint = Checkpoint(path)
+        checkpoint.records = 3
+        checkpoint.save()
+        db.session.commit()
+        result = import_books(path, u, batch_size=3, workers=0, resume=True, echo=lambda m: None)
+        self.assertEqual(result, {'read': 5, 'imported': 4, 'skipped': 1})
+        self.assertEqual([b.title for b in Book.query.order_by(Book.id)], ['book %d' % i for i in range(3, 7)])
+        self.assertEqual(BookStats.query.count(), 4)
+        self.assertEqual(u.books.first().language, 'en')
+        self.assertIsNone(ImportProgress.query.get(checkpoint.path))
+
+    def test_resume_after_crash(self):
+        from app.importer import import_books
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        path = os.path.join(self.tmp, 'books.jsonl')
+        with open(path, 'w') as f:
+            for i in range(5):
+                f.write(json.dumps({'title': 'book %d' % i, 'author': 'author %d' % i}) + '\n')
+
+        def crash(message):
+            raise KeyboardInterrupt
+
+        # the first batch and its progress are committed, the import dies after
+        with self.assertRaises(KeyboardInterrupt):
+            import_books(path, u, batch_size=2, workers=0, echo=crash)
+        self.assertEqual(ImportProgress.query.get(os.path.abspath(path)).records, 2)
+        result = import_books(path, u, batch_size=2, workers=0, resume=True, echo=lambda m: None)
+        self.assertEqual(result['imported'], 3)
+        self.assertEqual([b.title for b in Book.query.order_by(Book.id)], ['book %d' % i for i in range(5)])
+
+class ExportTest(AppTestCase):
+    def test_export_endpoint(self):
+        import json
+        u = User(username='john', email='john@example.com')
+        books = [Book(title='book %d' % i, author='a', poster=u) for i in range(3)]
+        db.session.add_all([u] + books)
+        db.session.commit()
+        db.session.add_all([Rating(author=u, book=b, score=i + 1) for i, b in enumerate(books)])
+        token = u.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': 'Bearer ' + token}
+
+        rv = client.get('/api/export/ratings', headers=headers)
+        self.assertTrue(rv.is_streamed)
+        rows = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+        self.assertEqual([r['score'] for r in rows], [1, 2, 3])
+        self.assertEqual(set(rows[0]), {'id', 'user_id', 'book_id', 'score'})
+
+        rv = client.get('/api/export/books?format=csv', headers=headers)
+        lines = rv.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'id,isbn,title,author,description,language,time,user_id')
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(client.get('/api/export/users', headers=headers).status_code, 400)
+
+class RatingUpsertTest(AppTestCase):
+    def test_batch_upsert(self):
+        u = User(username='john', email='john@example.com')
+        b1 = Book(title='one', author='a', poster=u)
+        b2 = Book(title='two', author='a', poster=u)
+        db.session.add_all([u, b1, b2])
+        db.session.commit()
+        db.session.add(Rating(author=u, book=b1, score=2))
+        headers = {'Authorization': 'Bearer ' + u.get_token()}
+        db.session.commit()
+        client = self.app.test_client()
+        body = {'ratings': [{'book': b1.id, 'score': 5}, {'book': b2.id, 'score': 3}]}
+
+        rv = client.put('/api/ratings', json=body, headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(sorted(rv.get_json()['changed']), [b1.id, b2.id])
+        rv = client.put('/api/ratings', json=body, headers=headers)
+        self.assertEqual(rv.get_json()['changed'], [])
+
+        self.assertEqual(Rating.query.count(), 2)
+        self.assertEqual(Rating.query.filter_by(book_id=b1.id).one().score, 5)
+        stats = BookStats.query.get(b1.id)
+        self.assertEqual((stats.rating_count, stats.rating_sum), (1, 5))
+        self.assertEqual(Book.query.get(b2.id).version, 2)
+
+        rv = client.put('/api/ratings', json={'ratings': [{'book': 999, 'score': 3}]}, headers=headers)
+        self.assertEqual(rv.status_code, 400)
+        rv = client.put('/api/ratings', json={'ratings': [{'book': b1.id, 'score': 9}]}, headers=headers)
+        self.assertEqual(rv.status_code, 400)
+
+    def test_echo_validation(self):
+        u = User(username='john', email='john@example.com')
+        b = Book(title='one', author='a', poster=u)
+        db.session.add_all([u, b])
+        db.session.commit()
+        id = b.id
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+            session['_fresh'] = True
+        db.session.remove()
+        for body in [{'rating': 3}, {'book': 'x', 'rating': 3}, {'book': id, 'rating': 9}, [id, 3]]:
+            self.assertEqual(client.post('/echo', json=body).status_code, 400)
+            db.session.remove()
+        self.assertEqual(client.post('/echo', data='not json').status_code, 400)
+        db.session.remove()
+        self.assertEqual(client.post('/echo', json={'book': 999, 'rating': 3}).status_code, 404)
+        db.session.remove()
+        self.assertEqual(client.post('/echo', json={'book': str(id), 'rating': 4}).status_code, 302)
+        db.session.remove()
+        self.assertEqual(Rating.query.filter_by(book_id=id).one().score, 4)
+
+
+class QueryCounter(object):
+    def __enter__(self):
+        self.count = 0
+        db.event.listen(db.engine, 'before_cursor_execute', self.count_query)
+        return self
+
+    def __exit__(self, *args):
+        db.event.remove(db.engine, 'before_cursor_execute', self.count_query)
+
+    def count_query(self, *args):
+        self.count += 1
+
+
+class BooksAPITest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.books = [Book(title='book %d' % i, author='a', poster=self.user) for i in range(12)]
+        db.session.add_all(self.books)
+        db.session.commit()
+        for book in self.books:
+            db.session.add(Rating(author=self.user, book=book, score=4))
+            db.session.add(Comment(body='hi', author=self.user, book=book))
+        self.headers = {'Authorization': 'Bearer ' + self.user.get_token()}
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def get(self, url):
+        db.session.remove()
+        with QueryCounter() as counter:
+            rv = self.client.get(url, headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        return rv.get_json(), counter.count
+
+    def test_item(self):
+        data, queries = self.get('/api/books/%d' % self.books[0].id)
+        self.assertEqual(data['title'], 'book 0')
+        self.assertEqual((data['rating_average'], data['comment_count']), (4, 1))
+        # token lookup, book with its stats, comment count
+        self.assertEqual(queries, 3)
+
+    def test_collection(self):
+        small, small_queries = self.get('/api/books?per_page=2')
+        data, queries = self.get('/api/books?per_page=10')
+        self.assertEqual(len(data['items']), 10)
+        self.assertEqual(data['_meta']['total_items'], 12)
+        self.assertEqual(data['items'][0]['comment_count'], 1)
+        self.assertEqual(queries, small_queries)
+        self.assertEqual(queries, 4)
+
+    def test_batch_and_fields(self):
+        ids = [self.books[3].id, self.books[1].id, 999]
+        data, queries = self.get('/api/books?ids=%s&fields=title,rating_count' % ','.join(map(str, ids)))
+        self.assertEqual([b['title'] for b in data['items']], ['book 3', 'book 1'])
+        self.assertEqual(set(data['items'][0]), {'id', 'title', 'rating_count'})
+        # no comment count query when it was not asked for
+        self.assertEqual(queries, 2)
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
     
+
+
+class ReplicaConfig(TestConfig):
+    SQLALCHEMY_BINDS = {'replica': 'sqlite://'}
+
+
+class ReplicaRoutingTest(AppTestCase):
+    def setUp(self):
+        self.config = ReplicaConfig
+        super().setUp()
+        self.replica = db.get_engine(self.app, bind='replica')
+        db.Model.metadata.create_all(self.replica)
+
+    def tearDown(self):
+        super().tearDown()
+        db.Model.metadata.drop_all(self.replica)
+
+    def replicate(self):
+        for table in db.Model.metadata.sorted_tables:
+            rows = [dict(row) for row in db.engine.execute(table.select())]
+            self.replica.execute(table.delete())
+            if rows:
+                self.replica.execute(table.insert(), rows)
+
+    def test_read_your_writes(self):
+        u = User(username='john', email='john@example.com')
+        b = Book(title='primary', author='a', poster=u)
+        db.session.add_all([u, b])
+        headers = {'Authorization': 'Bearer ' + u.get_token()}
+        db.session.commit()
+        self.replicate()
+        self.replica.execute(Book.__table__.update().values(title='replica'))
+        url = '/api/books/%d' % b.id
+        body = {'ratings': [{'book': b.id, 'score': 4}]}
+        client = self.app.test_client()
+
+        # the requests share the test's app context, so each starts with a
+        # fresh session like a real request would
+        db.session.remove()
+        self.assertEqual(client.get(url, headers=headers).get_json()['title'], 'replica')
+        db.session.remove()
+        self.assertEqual(client.put('/api/ratings', json=body, headers=headers).status_code, 200)
+        db.session.remove()
+        rv = client.get(url, headers=headers)
+        self.assertEqual(rv.get_json()['title'], 'primary')
+        self.assertEqual(rv.get_json()['rating_count'], 1)
+
+        with client.session_transaction() as sess:
+            sess['_primary_until'] = 0
+        db.session.remove()
+        self.assertEqual(client.get(url, headers=headers).get_json()['title'], 'replica')
+
+
+class SQLiteProfileTest(AppTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+        class FileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.tmp, 'app.db')
+            SQLITE_WAL = True
+            SQLITE_SERIALIZE_WRITES = True
+            SQLITE_LOCK_BACKOFF = 0
+
+        self.config = FileConfig
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmp)
+
+    def test_pragmas(self):
+        self.assertEqual(db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(db.session.execute('PRAGMA synchronous').scalar(), 1)
+        self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(), 5000)
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'app.db.lock')))
+        self.assertEqual(User.query.count(), 1)
+
+    def test_write_lock_on_first_write(self):
+        lock_path = os.path.join(self.tmp, 'app.db.lock')
+
+        def writer_lock_free():
+            with open(lock_path, 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                return True
+
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        db.session.remove()
+        with self.app.test_request_context('/auth/login', method='POST'):
+            # a read only prefix, like the user lookup of a login
+            self.assertEqual(User.query.filter_by(username='john').count(), 1)
+            self.assertFalse(db.session.connection().connection.connection.in_transaction)
+            self.assertTrue(writer_lock_free())
+            other = sqlite3.connect(os.path.join(self.tmp, 'app.db'), timeout=0)
+            other.execute('BEGIN IMMEDIATE')
+            other.rollback()
+            other.close()
+
+            db.session.add(User(username='susan', email='susan@example.com'))
+            db.session.flush()
+            self.assertTrue(db.session.connection().connection.connection.in_transaction)
+            self.assertFalse(writer_lock_free())
+            db.session.commit()
+            db.session.remove()
+        self.assertTrue(writer_lock_free())
+        self.assertEqual(User.query.count(), 2)
+
+    def test_writer_lock_timeout(self):
+        lock_path = os.path.join(self.tmp, 'app.db.lock')
+        held = open(lock_path, 'a')
+        fcntl.flock(held, fcntl.LOCK_EX)
+        with self.assertRaises(OperationalError) as cm:
+            lock_file(lock_path, 0.05)
+        self.assertTrue(is_locked(cm.exception))
+
+        threading.Timer(0.05, held.close).start()
+        lock = lock_file(lock_path, 5)
+        self.assertTrue(held.closed)
+        lock.close()
+
+    def test_retry_locked(self):
+        calls = []
+
+        @retry_locked
+        def write():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('INSERT', {}, sqlite3.OperationalError('database is locked'))
+            return 'done'
+
+        self.assertEqual(write(), 'done')
+        self.assertEqual(len(calls), 3)
+
+        @retry_locked
+        def broken():
+            calls.append(1)
+            raise OperationalError('INSERT', {}, sqlite3.OperationalError('no such table: x'))
+
+        del calls[:]
+        self.assertRaises(OperationalError, broken)
+        self.assertEqual(len(calls), 1)
+
+
+class QueryPlanTest(AppTestCase):
+    # queries that read a whole table on purpose
+    FULL_SCANS_ALLOWED = [
+        # the follow graph load
+        'SELECT followers.follower_id AS followers_follower_id, followers.followed_id AS followers_followed_id '
+        'FROM followers',
+    ]
+
+    def capture(self, conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().split()[0].upper() in ('SELECT', 'UPDATE', 'DELETE'):
+            self.statements.append((statement, parameters))
+
+    def full_scans(self, statement, parameters):
+        tables = set(db.Model.metadata.tables)
+        scans = []
+        for row in db.engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters):
+            words = row[-1].split()
+            # 'SCAN book' on new versions of sqlite, 'SCAN TABLE book' on old ones
+            if words[0] == 'SCAN' and words[1] == 'TABLE':
+                del words[1]
+            if words[0] == 'SCAN' and words[1] in tables and 'USING' not in words:
+                scans.append(words[1])
+        return scans
+
+    def test_main_routes_use_indexes(self):
+        users = [User(username='user%d' % i, email='user%d@example.com' % i) for i in range(3)]
+        db.session.add_all(users)
+        users[0].follow(users[1])
+        users[1].follow(users[0])
+        books = [Book(title='book %d' % i, author='a', poster=users[i % 3]) for i in range(6)]
+        db.session.add_all(books)
+        db.session.commit()
+        comment = Comment(body='hi', author=users[1], book=books[0])
+        db.session.add_all([Rating(author=users[1], book=books[0], score=4), comment,
+                            Message(author=users[1], recipient=users[2], body='hi')])
+        db.session.add(Comment(body='reply', author=users[0], parent=comment))
+        Conversation.send(users[1], users[0], 'hello')
+        users[0].add_notification('unread_message_count', 1)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(users[0].id)
+            sess['_fresh'] = True
+        urls = ['/index', '/explore', '/explore?sort=top', '/explore?sort=trending', '/user/user1',
+                '/user/user1/popup', '/book/%d' % books[0].id, '/comment/%d' % comment.id,
+                '/messages', '/messages/user1', '/notifications', '/send_message/user1', '/edit_profile']
+
+        self.statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', self.capture)
+        try:
+            for url in urls:
+                db.session.remove()
+                self.assertEqual(client.get(url).status_code, 200, url)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', self.capture)
+
+        failures = []
+        for statement, parameters in self.statements:
+            if ' '.join(statement.split()) in self.FULL_SCANS_ALLOWED:
+                continue
+            scans = self.full_scans(statement, parameters)
+            if scans:
+                failures.append('%s: %s' % (', '.join(scans), ' '.join(statement.split())))
+        self.assertTrue(self.statements)
+        self.assertEqual(failures, [])
+
+
+class SQLProfilingTest(AppTestCase):
+    def setUp(self):
+        class ProfilingConfig(TestConfig):
+            SQL_PROFILING = True
+            SLOW_REQUEST_SECONDS = 0
+
+        self.config = ProfilingConfig
+        super().setUp()
+
+    def test_server_timing(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Book(title='one', author='a', poster=u)])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+            sess['_fresh'] = True
+
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            rv = client.get('/explore')
+        self.assertRegex(rv.headers['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=[\d.]+$')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['endpoint'], record['status']), ('main.explore', 200))
+        self.assertGreater(record['queries'], 0)
+        self.assertLessEqual(len(record['slowest']), 3)
+
+        self.app.config['SQL_PROFILING_SAMPLE_RATE'] = 0
+        rv = client.get('/explore')
+        self.assertNotIn('Server-Timing', rv.headers)
+
+
+class MetricsTest(AppTestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_metrics(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Book(title='one', author='a', poster=u)])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(u.id)
+            sess['_fresh'] = True
+        requests = self.sample('bibliophilia_requests_total', endpoint='main.explore', method='GET', status='200')
+        hits = self.sample('bibliophilia_cache_requests_total', cache='fragments', result='hit')
+
+        client.get('/explore')
+        client.get('/explore?page=1')
+        self.assertEqual(self.sample('bibliophilia_requests_total', endpoint='main.explore', method='GET',
+                                     status='200'), requests + 2)
+        self.assertGreater(self.sample('bibliophilia_request_db_queries_sum', endpoint='main.explore'), 0)
+        self.assertGreater(self.sample('bibliophilia_cache_requests_total', cache='fragments', result='hit'), hits)
+
+        errors = self.sample('bibliophilia_outbound_errors_total', service='translate', operation='get')
+        with self.assertRaises(ValueError):
+            with outbound('translate', 'get'):
+                raise ValueError
+        self.assertEqual(self.sample('bibliophilia_outbound_errors_total', service='translate', operation='get'),
+                         errors + 1)
+
+        rv = client.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'bibliophilia_request_duration_seconds_bucket{endpoint="main.explore"', rv.data)
+
+
+class BenchTest(AppTestCase):
+    def test_seed_and_run(self):
+        Seeder(seed=1, batch_size=100, echo=lambda message: None).run(
+            users=30, books=50, ratings=400, comments=80, follows_per_user=5)
+        self.assertEqual((User.query.count(), Book.query.count(), Comment.query.count()), (30, 50, 80))
+        pairs = db.session.query(Rating.user_id, Rating.book_id).all()
+        self.assertEqual(len(pairs), len(set(pairs)))
+        stats = BookStats.query.get(Rating.query.first().book_id)
+        self.assertEqual(stats.rating_count, Rating.query.filter_by(book_id=stats.book_id).count())
+        for reply in Comment.query.filter(Comment.parent_id.isnot(None)):
+            self.assertIsNone(reply.book_id)
+            self.assertTrue(reply.path.startswith(reply.parent.path + '.'))
+
+        results = bench.run(['book', 'api_user'], requests=5, warmup=1, echo=lambda message: None)
+        self.assertEqual(results['dataset']['book'], 50)
+        for result in results['endpoints'].values():
+            self.assertEqual(result['errors'], 0)
+            self.assertGreater(result['queries_per_request'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+
+class LazyInitTest(unittest.TestCase):
+    def test_lazy_client(self):
+        built = []
+
+        def factory():
+            built.append(1)
+            return LRUCache(100)
+
+        client = LazyClient(factory)
+        self.assertEqual(built, [])
+        client.set('a', 'b')
+        self.assertEqual(client.get().get('a'), 'b')
+        self.assertEqual(len(built), 1)
+        client.reset()
+        self.assertIsNone(client.get().get('a'))
+        self.assertEqual(len(built), 2)
+
+    def test_after_fork(self):
+        class SearchConfig(TestConfig):
+            ELASTICSEARCH_URL = 'http://localhost:9200'
+
+        app = create_app(SearchConfig)
+        client = app.elasticsearch.get()
+        self.assertIs(app.elasticsearch.get(), client)
+        after_fork(app)
+        self.assertIsNot(app.elasticsearch.get(), client)
+
+
+class SlowTranslation(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(0.2)
+        text = parse_qs(urlparse(self.path).query)['q'][0]
+        if text == 'fail':
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = json.dumps({'responseData': {'translatedText': text.upper()}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TranslateTest(AppTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SlowTranslation)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        class StubConfig(TestConfig):
+            TRANSLATE_URL = 'http://127.0.0.1:%d/get' % self.server.server_port
+
+        self.config = StubConfig
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fan_out(self):
+        start = time.perf_counter()
+        with self.app.test_request_context():
+            texts = translate_many(['one', 'two', 'fail', 'four'], 'en', 'fa')
+        # four calls of 200ms each, made concurrently
+        self.assertLess(time.perf_counter() - start, 0.6)
+        self.assertEqual(texts[:2] + texts[3:], ['ONE', 'TWO', 'FOUR'])
+        self.assertTrue(texts[2].startswith('Error'))
+
+    def test_translate_route(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+            session['_fresh'] = True
+        rv = client.post('/translate', data={'text': 'hello', 'source_language': 'en', 'dest_language': 'fa'})
+        self.assertEqual(rv.get_json(), {'text': 'HELLO', 'texts': ['HELLO']})
+        rv = client.post('/translate', data={'text': ['a', 'b'], 'source_language': 'en',
+                                             'dest_language': 'fa'})
+        self.assertEqual(rv.get_json()['texts'], ['A', 'B'])
+        rv = client.post('/translate', data={'source_language': 'en', 'dest_language': 'fa'})
+        self.assertEqual(rv.status_code, 400)
+
+
+class AdmissionTest(AppTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+        class LimitConfig(TestConfig):
+            RATE_LIMIT_DB = os.path.join(self.tmp, 'ratelimit.db')
+            RATE_LIMITS = {'api.get_users': {'client': (1, 20), 'endpoint': (100, 1000)}}
+
+        self.config = LimitConfig
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.tmp)
+
+    def test_buckets(self):
+        buckets = Buckets(os.path.join(self.tmp, 'buckets.db'))
+        limits = [('a', 1, 2), ('total', 10, 3)]
+        self.assertEqual(buckets.take(limits, 1, now=100), 0)
+        self.assertEqual(buckets.take(limits, 1, now=100), 0)
+        self.assertEqual(buckets.take(limits, 1, now=100), 1)
+        # a refused request takes nothing, from any bucket
+        self.assertEqual(buckets.take([('b', 1, 2), ('total', 10, 3)], 1, now=100), 0)
+        self.assertGreater(buckets.take([('c', 1, 2), ('total', 10, 3)], 1, now=100), 0)
+        self.assertEqual(buckets.take(limits, 1, now=101), 0)
+
+    def test_rate_limit(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': 'Bearer ' + token}
+        # a budget of 20 tokens, a page costs one token per ten users
+        self.assertEqual(client.get('/api/users?per_page=100', headers=headers).status_code, 200)
+        self.assertEqual(client.get('/api/users?per_page=50', headers=headers).status_code, 200)
+        db.session.remove()
+
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        event.listen(Engine, 'before_cursor_execute', listener)
+        try:
+            rv = client.get('/api/users?per_page=100', headers=headers)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', listener)
+        self.assertEqual(rv.status_code, 429)
+        self.assertGreaterEqual(int(rv.headers['Retry-After']), 1)
+        self.assertEqual(queries, [])
+        # made up credentials from the same address share its budget
+        rv = client.get('/api/users?per_page=100', headers={'Authorization': 'Bearer made-up'})
+        self.assertEqual(rv.status_code, 429)
+        # small pages still fit in the budget
+        self.assertEqual(client.get('/api/users?per_page=20', headers=headers).status_code, 200)
+
+    def test_shedding(self):
+        client = self.app.test_client()
+        rv = client.get('/auth/login', headers={'X-Request-Start': 't=%.3f' % (time.time() - 10)})
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(rv.headers['Retry-After'], '1')
+        rv = client.get('/auth/login', headers={'X-Request-Start': 't=%.3f' % time.time()})
+        self.assertEqual(rv.status_code, 200)
+        self.app.config['SHED_MAX_INFLIGHT'] = 1
+        self.assertEqual(client.get('/auth/login').status_code, 200)
+
+
+class PasswordHashTest(AppTestCase):
+    def test_rehash_on_login(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(username='john', email='john@example.com')
+        u.set_password('axolotl')
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertFalse(u.check_password('wrong'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        rv = self.app.test_client().post('/auth/login', data={'username': 'john', 'password': 'axolotl'})
+        self.assertEqual(rv.status_code, 302)
+        db.session.remove()
+        u = User.query.filter_by(username='john').first()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('axolotl'))
+
+    def test_limits(self):
+        pool = HashPool(0, 2, 1, 0.1)
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return True
+
+        worker = threading.Thread(target=pool.run, args=(1, slow))
+        worker.start()
+        started.wait(5)
+        # one check per account at a time
+        with self.assertRaises(TooManyRequests):
+            pool.run(1, slow)
+        other = threading.Thread(target=pool.run, args=(2, slow))
+        other.start()
+        # both slots are taken
+        with self.assertRaises(ServiceUnavailable):
+            pool.run(3, slow)
+        release.set()
+        worker.join()
+        other.join()
+        self.assertEqual(pool.running, {})
+        self.assertTrue(pool.run(1, slow))
+
+    def test_process_pool(self):
+        pool = HashPool(1, 2, 2, 5)
+        u = User(username='john', email='john@example.com')
+        u.set_password('axolotl')
+        try:
+            self.assertTrue(pool.run(u.id, check_password_hash, u.password_hash, 'axolotl'))
+            self.assertFalse(pool.run(u.id, check_password_hash, u.password_hash, 'axolotol'))
+        finally:
+            pool.shutdown()
+
+
+class IdentityCacheTest(AppTestCase):
+    def user_queries(self, client, url):
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        event.listen(Engine, 'before_cursor_execute', listener)
+        try:
+            rv = client.get(url)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', listener)
+        db.session.remove()
+        self.assertEqual(rv.status_code, 200)
+        return [q for q in queries if 'FROM user' in q]
+
+    def test_identity_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+            session['_fresh'] = True
+        db.session.remove()
+        self.assertEqual(len(self.user_queries(client, '/index')), 1)
+        self.assertEqual(self.user_queries(client, '/index'), [])
+
+        rv = client.post('/edit_profile', data={'username': 'johnny', 'about': 'reader'})
+        self.assertEqual(rv.status_code, 302)
+        db.session.remove()
+        self.assertEqual(self.app.identity_cache.get(u.id), None)
+        rv = client.get('/index')
+        self.assertIn(b'/user/johnny', rv.data)
+        db.session.remove()
+
+        u = User.query.get(u.id)
+        self.assertIsNotNone(self.app.identity_cache.get(u.id))
+        u.set_password('axolotl')
+        db.session.commit()
+        self.assertIsNone(self.app.identity_cache.get(u.id))
+
+
+class PopupTest(AppTestCase):
+    def get(self, client, url, **kwargs):
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        event.listen(Engine, 'before_cursor_execute', listener)
+        try:
+            rv = client.get(url, **kwargs)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', listener)
+        db.session.remove()
+        return rv, [q for q in queries if 'FROM user' in q]
+
+    def test_popup(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com', about='reader')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        id1 = u1.id
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(id1)
+            session['_fresh'] = True
+        db.session.remove()
+
+        rv, _ = self.get(client, '/user/susan/popup')
+        self.assertEqual(rv.status_code, 200)
+        data = rv.get_json()
+        self.assertEqual(data['username'], 'susan')
+        self.assertEqual(data['about'], 'reader')
+        self.assertEqual(data['url'], '/user/susan')
+        self.assertEqual(data['counts'], '1 followers, 0 following')
+        self.assertEqual(data['follow']['url'], '/unfollow/susan')
+        self.assertEqual(data['follow']['label'], 'Unfollow')
+        self.assertIn('private', rv.headers['Cache-Control'])
+        self.assertIn('max-age=60', rv.headers['Cache-Control'])
+        etag = rv.headers['ETag']
+
+        rv, queries = self.get(client, '/user/susan/popup', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+        self.assertEqual(queries, [])
+
+        rv, _ = self.get(client, '/user/john/popup')
+        self.assertIsNone(rv.get_json()['follow'])
+
+        u2 = User.query.filter_by(username='susan').first()
+        u2.about = 'writer'
+        db.session.commit()
+        db.session.remove()
+        rv, _ = self.get(client, '/user/susan/popup', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.get_json()['about'], 'writer')
+
+
+class AssetsTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.static = tempfile.mkdtemp()
+        for sources in assets.BUNDLES.values():
+            for source in sources:
+                os.makedirs(os.path.dirname(os.path.join(self.static, source)), exist_ok=True)
+                shutil.copy(os.path.join(self.app.static_folder, source), os.path.join(self.static, source))
+
+    def tearDown(self):
+        shutil.rmtree(self.static)
+        super().tearDown()
+
+    def test_minify(self):
+        self.assertEqual(assets.minify_css('/* x */ a  b { color: red ; }\n'), 'a b{color:red}\n')
+        js = 'var a = "// not a comment";  // comment\n\n  /* block */ var b = a.replace(/\\/ +/g, \' \');\n'
+        self.assertEqual(assets.minify_js(js),
+                         'var a="// not a comment";\nvar b=a.replace(/\\/ +/g,\' \');\n')
+        self.assertEqual(assets.minify_js('x = a - -b / c\nreturn a\n'), 'x=a - -b / c\nreturn a\n')
+
+    def test_build(self):
+        manifest = assets.build(self.static, echo=lambda message: None)
+        self.assertEqual(set(manifest), set(assets.BUNDLES))
+        self.assertEqual(assets.load_manifest(self.static), manifest)
+        path = os.path.join(self.static, manifest['app.js'])
+        with open(path, 'rb') as f:
+            data = f.read()
+        with gzip.open(path + '.gz') as f:
+            self.assertEqual(f.read(), data)
+        self.assertIn(b'function render_popup(data){', data)
+        self.assertLess(len(data), sum(os.path.getsize(os.path.join(self.static, source))
+                                       for source in assets.BUNDLES['app.js']))
+
+        # the same sources give the same names, a change gives a new one and
+        # the files of the build before are kept
+        self.assertEqual(assets.build(self.static, echo=lambda message: None), manifest)
+        with open(os.path.join(self.static, 'js/bibliophilia.js'), 'a') as f:
+            f.write('var changed = true;\n')
+        second = assets.build(self.static, echo=lambda message: None)
+        self.assertNotEqual(second['app.js'], manifest['app.js'])
+        self.assertTrue(os.path.exists(path))
+        assets.build(self.static, echo=lambda message: None)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + '.gz'))
+
+    def test_asset_urls(self):
+        manifest = assets.build(self.static, echo=lambda message: None)
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+            session['_fresh'] = True
+        rv = client.get('/index')
+        self.assertIn(b'src="/static/js/bibliophilia.js"', rv.data)
+        self.assertIn(b'href="/static/starrr.css"', rv.data)
+        self.assertIn(b'"notifications": "/notifications"', rv.data)
+        db.session.remove()
+        self.app.asset_manifest = manifest
+        rv = client.get('/index')
+        self.assertIn(('src="/static/%s"' % manifest['app.js']).encode(), rv.data)
+        self.assertNotIn(b'src="/static/js/bibliophilia.js"', rv.data)
+
+
+class StubGravatar(BaseHTTPRequestHandler):
+    image = b'\x89PNG\r\n\x1a\n' + b'\0' * 32
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        digest = url.path.rsplit('/', 1)[1]
+        StubGravatar.requests.append((digest, parse_qs(url.query)))
+        if digest != email_digest('susan@example.com'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.image)))
+        self.end_headers()
+        self.wfile.write(self.image)
+
+    def log_message(self, *args):
+        pass
+
+
+class AvatarTest(AppTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubGravatar)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        StubGravatar.requests = []
+        self.path = tempfile.mkdtemp()
+
+        class StubConfig(TestConfig):
+            AVATAR_PATH = self.path
+            GRAVATAR_URL = 'http://127.0.0.1:%d/avatar/' % self.server.server_port
+
+        self.config = StubConfig
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def wait_for_fetch(self):
+        for _ in range(100):
+            if not self.app.avatars.pending:
+                return
+            time.sleep(0.02)
+        self.fail('the avatar was not fetched')
+
+    def test_gravatar(self):
+        db.session.add(User(username='susan', email='susan@example.com'))
+        db.session.commit()
+        digest = email_digest('susan@example.com')
+        client = self.app.test_client()
+        rv = client.get('/avatar/%s?s=70' % digest)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'image/svg+xml')
+        self.assertIn(b'<svg', rv.data)
+        self.assertIn('max-age=60', rv.headers['Cache-Control'])
+        self.assertIn('public', rv.headers['Cache-Control'])
+        self.wait_for_fetch()
+        self.assertEqual(StubGravatar.requests, [(digest, {'s': ['70'], 'd': ['404']})])
+
+        rv = client.get('/avatar/%s?s=70' % digest)
+        self.assertEqual(rv.mimetype, 'image/png')
+        self.assertEqual(rv.data, StubGravatar.image)
+        self.assertIn('max-age=%d' % self.app.config['AVATAR_MAX_AGE'], rv.headers['Cache-Control'])
+        rv = client.get('/avatar/%s?s=70' % digest, headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+        # sizes are rounded up, another size is another fetch
+        client.get('/avatar/%s?s=100' % digest)
+        self.wait_for_fetch()
+        self.assertEqual(StubGravatar.requests[-1], (digest, {'s': ['128'], 'd': ['404']}))
+        self.assertEqual(len(StubGravatar.requests), 2)
+
+    def test_identicon(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with self.app.test_request_context():
+            url = u.avatar(64)
+        first = client.get(url)
+        self.wait_for_fetch()
+        rv = client.get(url)
+        self.assertEqual(rv.mimetype, 'image/svg+xml')
+        self.assertEqual(rv.data, first.data)
+        self.assertIn('max-age=%d' % self.app.config['AVATAR_MAX_AGE'], rv.headers['Cache-Control'])
+        # Gravatar said it has no image, it is not asked again
+        client.get(url)
+        self.assertEqual(len(StubGravatar.requests), 1)
+
+        # until the marker is stale, then the identicon may still be replaced
+        self.app.avatars.refresh = -1
+        rv = client.get(url)
+        self.assertIn('max-age=%d' % self.app.config['AVATAR_PENDING_MAX_AGE'], rv.headers['Cache-Control'])
+        self.wait_for_fetch()
+        self.assertEqual(len(StubGravatar.requests), 2)
+        self.assertEqual(client.get('/avatar/not-a-digest').status_code, 404)
+
+    def test_unknown_digest(self):
+        digest = email_digest('nobody@example.com')
+        client = self.app.test_client()
+        rv = client.get('/avatar/%s?s=70' % digest)
+        self.assertEqual(rv.mimetype, 'image/svg+xml')
+        self.assertIn(b'<svg', rv.data)
+        self.assertIn('max-age=%d' % self.app.config['AVATAR_MAX_AGE'], rv.headers['Cache-Control'])
+        rv = client.get('/avatar/%s?s=70' % digest, headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        # nothing is fetched or written for a digest no user has
+        self.assertEqual(StubGravatar.requests, [])
+        self.assertEqual(os.listdir(self.path), [])
+
+
+class NotificationTest(AppTestCase):
+    def test_upsert_and_poll(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        for count in range(3):
+            u1.add_notification('unread_message_count', count)
+        u2.add_notification('unread_message_count', 7)
+        db.session.commit()
+        ids = u1.id, u2.id
+        self.assertEqual(Notification.query.filter_by(user_id=u1.id).count(), 1)
+        since = Notification.query.filter_by(user_id=u1.id).one().timestamp
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(ids[0])
+            session['_fresh'] = True
+        rv = client.get('/notifications')
+        self.assertEqual([(n['name'], n['data']) for n in rv.get_json()], [('unread_message_count', 2)])
+        self.assertEqual(client.get('/notifications?since=%r' % since).get_json(), [])
+
+        with client.session_transaction() as session:
+            session['_user_id'] = str(ids[1])
+        rv = client.post('/send_message/john', data={'message': 'hi'})
+        self.assertEqual(rv.status_code, 302)
+        db.session.remove()
+        notification = Notification.query.filter_by(user_id=ids[0]).one()
+        self.assertGreater(notification.timestamp, since)
+        self.assertEqual(notification.get_data(), 1)
+
+    def test_purge(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('old', 1)
+        u.add_notification('new', 2)
+        db.session.commit()
+        Notification.query.filter_by(name='old').update({'timestamp': time.time() - 100})
+        db.session.commit()
+        self.assertEqual(Notification.purge(50, batch_size=1), 1)
+        self.assertEqual([n.name for n in Notification.query.all()], ['new'])
+
+
+class ConversationTest(AppTestCase):
+    def setUp(self):
+        class PagedConfig(TestConfig):
+            POSTS_PER_PAGE = 2
+
+        self.config = PagedConfig
+        super().setUp()
+
+    def test_send(self):
+        john, susan, mary = [User(username=name, email='%s@example.com' % name)
+                             for name in ('john', 'susan', 'mary')]
+        db.session.add_all([john, susan, mary])
+        db.session.commit()
+        Conversation.send(susan, john, 'one')
+        Conversation.send(john, susan, 'two')
+        Conversation.send(susan, john, 'three')
+        db.session.commit()
+        self.assertEqual(Conversation.query.count(), 1)
+        c = Conversation.between(john.id, susan.id)
+        self.assertEqual((c.unread(john.id), c.unread(susan.id)), (2, 1))
+        self.assertEqual(c.last_message.body, 'three')
+        self.assertEqual(c.messages.count(), 3)
+        c.mark_read(john.id)
+        db.session.commit()
+        self.assertEqual((c.unread(john.id), c.unread(susan.id)), (0, 1))
+
+    def test_inbox(self):
+        users = [User(username='user%d' % i, email='user%d@example.com' % i) for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        Conversation.send(users[1], users[0], 'a')
+        Conversation.send(users[0], users[2], 'b')
+        Conversation.send(users[3], users[0], 'c')
+        Conversation.send(users[1], users[0], 'd')
+        db.session.commit()
+        ids = [u.id for u in users]
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(ids[0])
+            session['_fresh'] = True
+        db.session.remove()
+
+        rv = client.get('/messages')
+        html = rv.get_data(as_text=True)
+        self.assertLess(html.index('user1'), html.index('user3'))
+        self.assertNotIn('user2', html)
+        next_url = '/messages?before=' + Conversation.find(ids[0], ids[3]).one().last_time.isoformat()
+        db.session.remove()
+        self.assertIn(next_url.replace(':', '%3A'), html)
+        html = client.get(next_url).get_data(as_text=True)
+        self.assertIn('user2', html)
+        self.assertNotIn('user1', html.split('Messages')[-1])
+
+        rv = client.get('/messages/user1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('>d</p>', rv.get_data(as_text=True))
+        db.session.remove()
+        self.assertEqual(Conversation.find(ids[0], ids[1]).one().unread(ids[0]), 0)
+        self.assertEqual(client.get('/messages/user2').status_code, 200)
+        db.session.remove()
+        self.assertEqual(client.get('/messages/nobody').status_code, 404)
+